@@ -0,0 +1,249 @@
+"""Uncertainty-ordered serving from a locally trained hate / non-hate model.
+
+A logistic regression over hashed features (word unigrams and bigrams plus
+character 4-grams of the normalised text, 2**20 buckets with signed hashing)
+is trained with per-feature AdaGrad on the annotations saved since the last
+run, so retraining only costs the new labels. Everything is NumPy on the CPU.
+
+Scores are cached in comment_scores together with the model version (a hash of
+the weights). Scoring a batch streams its unannotated comments page by page in
+original_index order and only fetches those whose cached score is missing or
+from another model version, so an unchanged model re-scores nothing.
+
+--order-sections then rebuilds the batch's section map so the most uncertain
+comments come first: section 1 holds the most uncertain comments and every
+section is served most uncertain first. The app shows the cached prediction as
+the default label.
+
+    python active_learning.py --batch <batch id> --order-sections
+"""
+import argparse
+import hashlib
+import json
+import os
+import zlib
+
+import numpy as np
+from dotenv import load_dotenv
+from supabase import create_client
+
+from dedup import PROPAGATION_USER_ID, normalize
+from export_annotations import iter_annotation_pages
+from repository import LABELS, SupabaseRepository
+
+DEFAULT_MODEL_PATH = os.path.join("models", "hate_model.npz")
+N_FEATURES = 2 ** 20
+CHAR_NGRAM = 4
+POSITIVE_LABEL = 'hate'
+LEARNING_RATE = 0.5
+EPOCHS = 2
+MINIBATCH_SIZE = 256
+PAGE_SIZE = 1000
+
+
+def text_features(text):
+    """CRC32 hashes of the word uni/bigrams and character n-grams of one text."""
+    text = normalize(text)
+    words = text.split()
+    grams = set(words)
+    grams.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    padded = f" {text} "
+    grams.update(f"#{padded[i:i + CHAR_NGRAM]}" for i in range(len(padded) - CHAR_NGRAM + 1))
+    return [zlib.crc32(gram.encode('utf-8')) for gram in grams]
+
+
+def vectorize(texts, n_features=N_FEATURES):
+    """Sparse, L2-normalised rows as flat (row ids, feature indexes, values) arrays."""
+    rows, hashes = [], []
+    for row, text in enumerate(texts):
+        features = text_features(text)
+        rows.append(np.full(len(features), row, dtype=np.int64))
+        hashes.append(np.array(features, dtype=np.uint32))
+    if not hashes:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    row_ids = np.concatenate(rows)
+    hashes = np.concatenate(hashes)
+    indexes = (hashes & np.uint32(n_features - 1)).astype(np.int64)
+    # The top bit picks the sign, so colliding features tend to cancel out
+    signs = np.where(hashes >> np.uint32(31), -1.0, 1.0).astype(np.float32)
+    norms = np.sqrt(np.bincount(row_ids, minlength=len(texts))).astype(np.float32)
+    return row_ids, indexes, signs / norms[row_ids]
+
+
+class HashedLogisticModel:
+    """Binary logistic regression on hashed features, trained incrementally with AdaGrad."""
+
+    def __init__(self, n_features=N_FEATURES):
+        self.n_features = n_features
+        self.weights = np.zeros(n_features, dtype=np.float32)
+        self.squared_gradients = np.zeros(n_features, dtype=np.float32)
+        self.bias = 0.0
+        self.bias_squared_gradient = 0.0
+        self.trained_examples = 0
+        # (created_at, annotation id) of the last annotation trained on
+        self.cursor = None
+        self._version = None
+
+    @property
+    def version(self):
+        """Content hash of the parameters; cached scores are only reused for the same version."""
+        if self._version is None:
+            digest = hashlib.blake2b(self.weights.tobytes(), digest_size=8)
+            digest.update(np.float64(self.bias).tobytes())
+            self._version = digest.hexdigest()
+        return self._version
+
+    def _decision(self, row_ids, indexes, values, n_rows):
+        return np.bincount(row_ids, weights=self.weights[indexes] * values, minlength=n_rows) + self.bias
+
+    def predict_proba(self, texts):
+        """Probability of POSITIVE_LABEL for each text."""
+        row_ids, indexes, values = vectorize(texts, self.n_features)
+        return 1.0 / (1.0 + np.exp(-self._decision(row_ids, indexes, values, len(texts))))
+
+    def partial_fit(self, texts, labels, epochs=EPOCHS, learning_rate=LEARNING_RATE, seed=0):
+        """Update the model with new (text, 0/1 label) examples."""
+        if not len(texts):
+            return
+        targets = np.asarray(labels, dtype=np.float64)
+        rng = np.random.default_rng(seed + self.trained_examples)
+        for _ in range(epochs):
+            order = rng.permutation(len(texts))
+            for start in range(0, len(order), MINIBATCH_SIZE):
+                batch = order[start:start + MINIBATCH_SIZE]
+                row_ids, indexes, values = vectorize([texts[i] for i in batch], self.n_features)
+                predictions = 1.0 / (1.0 + np.exp(-self._decision(row_ids, indexes, values, len(batch))))
+                errors = (predictions - targets[batch]) / len(batch)
+                touched, inverse = np.unique(indexes, return_inverse=True)
+                gradient = np.bincount(inverse, weights=errors[row_ids] * values, minlength=len(touched))
+                self.squared_gradients[touched] += (gradient ** 2).astype(np.float32)
+                self.weights[touched] -= (
+                    learning_rate * gradient / (np.sqrt(self.squared_gradients[touched]) + 1e-8)
+                ).astype(np.float32)
+                bias_gradient = errors.sum()
+                self.bias_squared_gradient += bias_gradient ** 2
+                self.bias -= learning_rate * bias_gradient / (np.sqrt(self.bias_squared_gradient) + 1e-8)
+        self.trained_examples += len(texts)
+        self._version = None
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        meta = {
+            'bias': self.bias,
+            'bias_squared_gradient': self.bias_squared_gradient,
+            'trained_examples': self.trained_examples,
+            'cursor': self.cursor,
+        }
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, weights=self.weights, squared_gradients=self.squared_gradients,
+                            meta=json.dumps(meta))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved model, or return an untrained one if the file does not exist."""
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            model = cls(n_features=len(data['weights']))
+            model.weights = data['weights'].astype(np.float32)
+            model.squared_gradients = data['squared_gradients'].astype(np.float32)
+            meta = json.loads(str(data['meta']))
+        model.bias = meta['bias']
+        model.bias_squared_gradient = meta['bias_squared_gradient']
+        model.trained_examples = meta['trained_examples']
+        model.cursor = tuple(meta['cursor']) if meta['cursor'] else None
+        return model
+
+
+def train(client, model, page_size=PAGE_SIZE, log=print):
+    """Train on annotations created after model.cursor. Returns the number of examples used."""
+    used = 0
+    for rows in iter_annotation_pages(client, since=model.cursor, page_size=page_size):
+        # Copies of a leader's label would count the same decision many times
+        examples = [row for row in rows if row['user_id'] != PROPAGATION_USER_ID and row['label'] in LABELS]
+        model.partial_fit(
+            [row['comment_text'] for row in examples],
+            [row['label'] == POSITIVE_LABEL for row in examples],
+        )
+        model.cursor = (rows[-1]['created_at'], rows[-1]['annotation_id'])
+        used += len(examples)
+        log(f"{used} annotations trained on")
+    return used
+
+
+def score_batch(client, model, batch_id, page_size=PAGE_SIZE, log=print):
+    """Score the batch's unannotated comments that have no score from this model version. Returns the count."""
+    scored = 0
+    after_index, after_id = -1, None
+    while True:
+        rows = client.rpc('get_unscored_comments', {
+            'p_batch_id': batch_id,
+            'p_model_version': model.version,
+            'p_after_index': after_index,
+            'p_after_id': after_id,
+            'p_limit': page_size,
+        }).execute().data or []
+        if not rows:
+            return scored
+        probabilities = model.predict_proba([row['comment_text'] for row in rows])
+        client.rpc('upsert_comment_scores', {
+            'p_model_version': model.version,
+            'p_scores': [
+                {'comment_id': row['id'], 'hate_probability': round(float(p), 6)}
+                for row, p in zip(rows, probabilities)
+            ],
+        }).execute()
+        after_index, after_id = rows[-1]['original_index'], rows[-1]['id']
+        scored += len(rows)
+        log(f"{scored} comments scored")
+
+
+def order_sections_by_uncertainty(client, batch_id, section_size=None, force=False):
+    """Rebuild the batch's sections with the most uncertain comments first. Returns the number of sections."""
+    if not force:
+        started = client.table('annotations').select('id').eq('batch_id', batch_id).limit(1).execute().data
+        if started:
+            raise RuntimeError(f"Batch {batch_id} already has annotations; rebuilding its sections would "
+                               "move comments under annotators' feet (use --force to do it anyway)")
+    return SupabaseRepository(client).build_sections(batch_id, section_size, order='uncertainty')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Train the suggestion model on new annotations and score batches for uncertainty-ordered serving."
+    )
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH, help="Model file, updated in place")
+    parser.add_argument('--batch', action='append', default=[], help="Batch id to score (repeatable)")
+    parser.add_argument('--order-sections', action='store_true',
+                        help="Rebuild the scored batches' sections, most uncertain comments first")
+    parser.add_argument('--section-size', type=int, help="Comments per section when rebuilding")
+    parser.add_argument('--force', action='store_true', help="Rebuild sections even if annotation has started")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set.")
+    client = create_client(url, key)
+
+    model = HashedLogisticModel.load(args.model)
+    used = train(client, model, page_size=args.page_size)
+    model.save(args.model)
+    print(f"Trained on {used} new annotation(s); model version {model.version} "
+          f"({model.trained_examples} examples in total)")
+
+    for batch_id in args.batch:
+        scored = score_batch(client, model, batch_id, page_size=args.page_size)
+        print(f"Batch {batch_id}: {scored} comment(s) scored")
+        if args.order_sections:
+            sections = order_sections_by_uncertainty(client, batch_id, args.section_size, force=args.force)
+            print(f"Batch {batch_id}: {sections} section(s) rebuilt by uncertainty")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""Inter-annotator agreement on overlapping sections.
+
+Annotations are read page by page (keyset pagination on (created_at, id), as
+in export_annotations.py) into a LabelMatrix, a sparse comment x annotator
+matrix: one (comment, annotator, label code, category bitmask) entry per
+rating, so memory grows with the number of annotations rather than with
+comments x annotators. Category bitmasks are uint16 while there are at most 16
+categories. The matrix remembers the cursor of the last row it read, so a
+refresh only fetches annotations created since then. It can be saved to and
+loaded from an .npz file between runs.
+
+All statistics are computed with array operations. Only the comments rated by
+at least two annotators are expanded into dense label rows for them:
+
+* Cohen's kappa for every annotator pair with enough shared comments;
+* Fleiss' kappa (generalised to a varying number of raters per comment);
+* Krippendorff's alpha (nominal);
+* per-category Fleiss' kappa / alpha / raw agreement on the category bits.
+
+Comments with a single rating take part in nothing.
+
+    python agreement.py --cache exports/.agreement_cache.npz
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+from supabase import create_client
+
+from repository import CATEGORIES, LABELS
+
+PAGE_SIZE = 1000
+DEFAULT_CACHE_PATH = os.path.join("exports", ".agreement_cache.npz")
+MIN_PAIR_OVERLAP = 10
+MISSING = -1
+MAX_CATEGORIES = 64
+
+
+def iter_label_pages(client, since=None, page_size=PAGE_SIZE):
+    """Yield pages of (id, comment_id, user_id, label, categories, created_at) in (created_at, id) order."""
+    cursor = since
+    while True:
+        # Labels copied to near-duplicates (dedup.py) are not independent ratings
+        query = client.table('annotations').select(
+            'id, comment_id, user_id, label, categories, created_at'
+        ).is_('propagated_from', 'null')
+        if cursor:
+            created_at, annotation_id = cursor
+            query = query.or_(
+                f'created_at.gt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.gt."{annotation_id}")'
+            )
+        response = query.order('created_at').order('id').limit(page_size).execute()
+        rows = response.data or []
+        if not rows:
+            return
+        yield rows
+        cursor = (rows[-1]['created_at'], rows[-1]['id'])
+
+
+def _mask_dtype(n_categories):
+    """Smallest unsigned type with a bit per category."""
+    for dtype in (np.uint16, np.uint32, np.uint64):
+        if n_categories <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f"More than {MAX_CATEGORIES} categories")
+
+
+class LabelMatrix:
+    """Sparse comment x annotator ratings: label codes (int8) and category bitmasks (uint16 for up to 16 categories).
+
+    Ratings are kept as parallel arrays of comment position, annotator
+    position, label code and mask, sorted by (comment, annotator) with one
+    entry per pair. Pages added since the last read are merged lazily.
+    """
+
+    def __init__(self):
+        self.comment_ids = []
+        self.annotator_ids = []
+        # Known vocabularies keep codes stable; anything else is appended on first sight.
+        self.label_names = list(LABELS)
+        self.category_names = list(CATEGORIES)
+        self.cursor = None
+        self._comment_index = {}
+        self._annotator_index = {}
+        self._comments = np.zeros(0, dtype=np.int32)
+        self._raters = np.zeros(0, dtype=np.int32)
+        self._codes = np.zeros(0, dtype=np.int8)
+        self._masks = np.zeros(0, dtype=_mask_dtype(len(self.category_names)))
+        self._pending = []
+
+    def _merge_pending(self):
+        if not self._pending:
+            return
+        mask_dtype = _mask_dtype(len(self.category_names))
+        comments = np.concatenate([self._comments] + [page[0] for page in self._pending])
+        raters = np.concatenate([self._raters] + [page[1] for page in self._pending])
+        codes = np.concatenate([self._codes] + [page[2] for page in self._pending])
+        masks = np.concatenate([self._masks.astype(mask_dtype)] + [page[3].astype(mask_dtype) for page in self._pending])
+        self._pending = []
+        # A later annotation by the same annotator wins: np.unique on the reversed keys
+        # finds the last occurrence of each (comment, annotator), in key order.
+        keys = (comments.astype(np.int64) << 32) | raters.astype(np.int64)
+        _, last_reversed = np.unique(keys[::-1], return_index=True)
+        keep = len(keys) - 1 - last_reversed
+        self._comments, self._raters = comments[keep], raters[keep]
+        self._codes, self._masks = codes[keep], masks[keep]
+
+    def ratings(self):
+        """(comment positions, annotator positions, label codes, category masks), one entry per rating."""
+        self._merge_pending()
+        return self._comments, self._raters, self._codes, self._masks
+
+    def overlapping(self, min_raters=2):
+        """Dense (comments, annotators) label codes and masks for comments rated by at least `min_raters`.
+
+        Unrated cells are MISSING / 0. Returns (comment positions, codes, masks).
+        """
+        comments, raters, codes, masks = self.ratings()
+        per_comment = np.bincount(comments, minlength=len(self.comment_ids))
+        kept = np.flatnonzero(per_comment >= min_raters)
+        row_of = np.full(len(self.comment_ids), -1, dtype=np.int64)
+        row_of[kept] = np.arange(len(kept))
+        selected = row_of[comments] >= 0
+        rows, cols = row_of[comments[selected]], raters[selected]
+        dense_codes = np.full((len(kept), len(self.annotator_ids)), MISSING, dtype=np.int8)
+        dense_masks = np.zeros((len(kept), len(self.annotator_ids)), dtype=masks.dtype)
+        dense_codes[rows, cols] = codes[selected]
+        dense_masks[rows, cols] = masks[selected]
+        return kept, dense_codes, dense_masks
+
+    @staticmethod
+    def _code(names, value, limit):
+        try:
+            return names.index(value)
+        except ValueError:
+            if len(names) >= limit:
+                raise ValueError(f"More than {limit} distinct values; cannot encode {value!r}")
+            names.append(value)
+            return len(names) - 1
+
+    def _index(self, index, ids, key):
+        position = index.get(key)
+        if position is None:
+            position = index[key] = len(ids)
+            ids.append(key)
+        return position
+
+    def add(self, rows):
+        """Fold a page of annotation rows into the matrix. A later annotation by the same annotator wins."""
+        if not rows:
+            return 0
+        row_idx, col_idx, codes, masks = [], [], [], []
+        for row in rows:
+            if row.get('label') is None:
+                continue
+            row_idx.append(self._index(self._comment_index, self.comment_ids, str(row['comment_id'])))
+            col_idx.append(self._index(self._annotator_index, self.annotator_ids, row['user_id']))
+            codes.append(self._code(self.label_names, row['label'], np.iinfo(np.int8).max))
+            mask = 0
+            for category in row.get('categories') or []:
+                mask |= 1 << self._code(self.category_names, category, MAX_CATEGORIES)
+            masks.append(mask)
+        self._pending.append((
+            np.array(row_idx, dtype=np.int32), np.array(col_idx, dtype=np.int32),
+            np.array(codes, dtype=np.int8), np.array(masks, dtype=np.uint64),
+        ))
+        self.cursor = (rows[-1]['created_at'], str(rows[-1]['id']))
+        return len(codes)
+
+    def refresh(self, client, page_size=PAGE_SIZE):
+        """Read annotations created after the stored cursor. Returns the number of annotations added."""
+        added = 0
+        for rows in iter_label_pages(client, since=self.cursor, page_size=page_size):
+            added += self.add(rows)
+        self._merge_pending()
+        return added
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        meta = {
+            'format': 'sparse',
+            'comment_ids': self.comment_ids,
+            'annotator_ids': self.annotator_ids,
+            'label_names': self.label_names,
+            'category_names': self.category_names,
+            'cursor': self.cursor,
+        }
+        comments, raters, codes, masks = self.ratings()
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, comments=comments, raters=raters, codes=codes, masks=masks,
+                            meta=json.dumps(meta))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved matrix, or return an empty one if the file does not exist."""
+        matrix = cls()
+        if not os.path.exists(path):
+            return matrix
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            mask_dtype = _mask_dtype(len(meta['category_names']))
+            if meta.get('format') == 'sparse':
+                matrix._comments = data['comments'].astype(np.int32)
+                matrix._raters = data['raters'].astype(np.int32)
+                matrix._codes = data['codes'].astype(np.int8)
+                matrix._masks = data['masks'].astype(mask_dtype)
+            else:
+                # Caches written by the dense version: keep the rated cells
+                labels = data['labels']
+                comments, raters = np.nonzero(labels != MISSING)
+                matrix._comments, matrix._raters = comments.astype(np.int32), raters.astype(np.int32)
+                matrix._codes = labels[comments, raters].astype(np.int8)
+                matrix._masks = data['categories'][comments, raters].astype(mask_dtype)
+        matrix.comment_ids = meta['comment_ids']
+        matrix.annotator_ids = meta['annotator_ids']
+        matrix.label_names = meta['label_names']
+        matrix.category_names = meta['category_names']
+        matrix.cursor = tuple(meta['cursor']) if meta['cursor'] else None
+        matrix._comment_index = {key: i for i, key in enumerate(matrix.comment_ids)}
+        matrix._annotator_index = {key: i for i, key in enumerate(matrix.annotator_ids)}
+        return matrix
+
+
+def category_counts(codes, n_categories):
+    """(items, K) count of raters per category from an (items, raters) code matrix with -1 for missing."""
+    one_hot = codes[:, :, None] == np.arange(n_categories)
+    return one_hot.sum(axis=1)
+
+
+def fleiss_kappa(counts):
+    """Fleiss' kappa for an (items, K) count matrix; items may have different numbers of raters (>= 2)."""
+    counts = np.asarray(counts, dtype=np.float64)
+    raters = counts.sum(axis=1)
+    counts, raters = counts[raters >= 2], raters[raters >= 2]
+    if not len(raters):
+        return float('nan')
+    p_item = ((counts ** 2).sum(axis=1) - raters) / (raters * (raters - 1))
+    p_category = counts.sum(axis=0) / raters.sum()
+    p_observed = p_item.mean()
+    p_expected = (p_category ** 2).sum()
+    if p_expected >= 1:
+        return float('nan')
+    return float((p_observed - p_expected) / (1 - p_expected))
+
+
+def krippendorff_alpha(counts):
+    """Nominal Krippendorff's alpha from an (items, K) count matrix of pairable values."""
+    counts = np.asarray(counts, dtype=np.float64)
+    raters = counts.sum(axis=1)
+    counts, raters = counts[raters >= 2], raters[raters >= 2]
+    if not len(raters):
+        return float('nan')
+    weighted = counts / (raters - 1)[:, None]
+    # Coincidence matrix: o[c, k] = sum_u n_uc * (n_uk - [c == k]) / (m_u - 1)
+    coincidences = weighted.T @ counts - np.diag(weighted.sum(axis=0))
+    marginals = coincidences.sum(axis=1)
+    total = marginals.sum()
+    disagreement_observed = total - np.trace(coincidences)
+    disagreement_expected = total ** 2 - (marginals ** 2).sum()
+    if disagreement_expected <= 0:
+        return float('nan')
+    return float(1 - (total - 1) * disagreement_observed / disagreement_expected)
+
+
+def cohen_kappa_matrix(codes, n_categories):
+    """Pairwise Cohen's kappa between annotators.
+
+    Returns (kappa, overlap): (raters, raters) arrays, kappa NaN where a pair
+    shares no comments or chance agreement is total.
+    """
+    rated = (codes != MISSING).astype(np.float64)
+    overlap = rated.T @ rated
+    agree = np.zeros_like(overlap)
+    expected = np.zeros_like(overlap)
+    for k in range(n_categories):
+        said_k = (codes == k).astype(np.float64)
+        agree += said_k.T @ said_k
+        # marginal[a, b]: comments both rated on which a said k
+        marginal = said_k.T @ rated
+        expected += marginal * marginal.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_observed = agree / overlap
+        p_expected = expected / overlap ** 2
+        kappa = (p_observed - p_expected) / (1 - p_expected)
+    return kappa, overlap
+
+
+def category_agreement(matrix, min_raters=2):
+    """Per-category agreement on the presence/absence bit, for comments with at least `min_raters` ratings."""
+    comments, _, _, masks = matrix.ratings()
+    per_comment = np.bincount(comments, minlength=len(matrix.comment_ids))
+    selected = per_comment[comments] >= min_raters
+    # Works on the rating entries directly; no comment x annotator x category array
+    _, item = np.unique(comments[selected], return_inverse=True)
+    raters = np.bincount(item)
+    bits = (masks[selected, None] >> np.arange(len(matrix.category_names), dtype=masks.dtype)) & 1
+    present = np.zeros((len(raters), len(matrix.category_names)), dtype=np.int64)
+    np.add.at(present, item, bits)
+    results = []
+    for i, name in enumerate(matrix.category_names):
+        counts = np.stack([raters - present[:, i], present[:, i]], axis=1)
+        results.append({
+            'category': name,
+            'comments_flagged': int((present[:, i] > 0).sum()),
+            'unanimous': float(((present[:, i] == 0) | (present[:, i] == raters)).mean()) if len(raters) else float('nan'),
+            'fleiss_kappa': fleiss_kappa(counts),
+            'krippendorff_alpha': krippendorff_alpha(counts),
+        })
+    return results
+
+
+def agreement_report(matrix, min_pair_overlap=MIN_PAIR_OVERLAP):
+    """All agreement statistics for the matrix as a JSON-serialisable dict."""
+    _, overlapping, _ = matrix.overlapping(min_raters=2)
+    n_labels = len(matrix.label_names)
+    counts = category_counts(overlapping, n_labels)
+
+    kappa, overlap = cohen_kappa_matrix(overlapping, n_labels)
+    first, second = np.triu_indices(len(matrix.annotator_ids), k=1)
+    pairs = [
+        {
+            'annotator_a': matrix.annotator_ids[a],
+            'annotator_b': matrix.annotator_ids[b],
+            'shared_comments': int(overlap[a, b]),
+            'cohen_kappa': float(kappa[a, b]),
+        }
+        for a, b in zip(first, second) if overlap[a, b] >= min_pair_overlap
+    ]
+    pair_kappas = [pair['cohen_kappa'] for pair in pairs if not np.isnan(pair['cohen_kappa'])]
+    return {
+        'comments': len(matrix.comment_ids),
+        'annotators': len(matrix.annotator_ids),
+        'overlapping_comments': int(len(overlapping)),
+        'label_distribution': dict(zip(matrix.label_names, counts.sum(axis=0).tolist())),
+        'fleiss_kappa': fleiss_kappa(counts),
+        'krippendorff_alpha': krippendorff_alpha(counts),
+        'mean_pairwise_cohen_kappa': float(np.mean(pair_kappas)) if pair_kappas else float('nan'),
+        'pairs': pairs,
+        'categories': category_agreement(matrix),
+        'cursor': matrix.cursor,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute inter-annotator agreement on overlapping comments.")
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH,
+                        help="Matrix cache file; only annotations newer than it are fetched")
+    parser.add_argument('--rebuild', action='store_true', help="Ignore the cache and read every annotation")
+    parser.add_argument('--min-overlap', type=int, default=MIN_PAIR_OVERLAP,
+                        help="Shared comments needed before a pair's Cohen's kappa is reported")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set.")
+    client = create_client(url, key)
+
+    matrix = LabelMatrix() if args.rebuild else LabelMatrix.load(args.cache)
+    added = matrix.refresh(client, page_size=args.page_size)
+    matrix.save(args.cache)
+    report = agreement_report(matrix, min_pair_overlap=args.min_overlap)
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+        return
+
+    print(f"Read {added} new annotation(s); {report['comments']} comments, {report['annotators']} annotators, "
+          f"{report['overlapping_comments']} rated by two or more")
+    print(f"Fleiss' kappa:              {report['fleiss_kappa']:.3f}")
+    print(f"Krippendorff's alpha:       {report['krippendorff_alpha']:.3f}")
+    print(f"Mean pairwise Cohen's kappa: {report['mean_pairwise_cohen_kappa']:.3f} ({len(report['pairs'])} pairs)")
+    print(f"{'category':<16}{'flagged':>9}{'unanimous':>11}{'kappa':>8}{'alpha':>8}")
+    for row in report['categories']:
+        print(f"{row['category']:<16}{row['comments_flagged']:>9}{row['unanimous']:>11.3f}"
+              f"{row['fleiss_kappa']:>8.3f}{row['krippendorff_alpha']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Throughput analytics for batch owners.
+
+Reads only the throughput_hourly and batch_progress_hourly rollups (kept up to
+date by triggers on annotations and skip_events) and the per-batch counters,
+then derives the dashboard figures with pandas:
+
+* comments per active hour, average seconds per comment and skip rate per annotator;
+* annotations and skips per hour;
+* label mix per batch;
+* projected completion per batch from the rate at which comments are newly annotated.
+"""
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+ROLLUP_COLUMNS = [
+    'hour', 'batch_id', 'user_id', 'label', 'annotations', 'skips', 'timed_events', 'total_duration_ms',
+]
+
+
+def fetch_throughput(client, since, batch_id=None):
+    """Rollup rows since `since` (a timezone-aware datetime) as a DataFrame."""
+    response = client.rpc('get_throughput', {
+        'p_since': since.isoformat(),
+        'p_batch_id': batch_id,
+    }).execute()
+    frame = pd.DataFrame(response.data or [], columns=ROLLUP_COLUMNS)
+    frame['hour'] = pd.to_datetime(frame['hour'], utc=True)
+    return frame
+
+
+def fetch_batch_projections(client, window_hours=24):
+    response = client.rpc('get_batch_projections', {'p_window_hours': window_hours}).execute()
+    return response.data or []
+
+
+def since_hours_ago(hours):
+    return datetime.now(timezone.utc) - timedelta(hours=hours)
+
+
+def annotator_summary(rollups):
+    """One row per annotator: volume, pace and skip rate."""
+    if rollups.empty:
+        return pd.DataFrame(columns=['user_id', 'annotations', 'skips', 'active_hours',
+                                     'comments_per_hour', 'seconds_per_comment', 'skip_rate'])
+    per_user = rollups.groupby('user_id').agg(
+        annotations=('annotations', 'sum'),
+        skips=('skips', 'sum'),
+        active_hours=('hour', 'nunique'),
+        timed_events=('timed_events', 'sum'),
+        total_duration_ms=('total_duration_ms', 'sum'),
+    )
+    handled = per_user['annotations'] + per_user['skips']
+    per_user['comments_per_hour'] = (handled / per_user['active_hours']).round(1)
+    per_user['seconds_per_comment'] = (
+        per_user['total_duration_ms'] / per_user['timed_events'].where(per_user['timed_events'] > 0) / 1000
+    ).round(1)
+    per_user['skip_rate'] = (per_user['skips'] / handled.where(handled > 0)).round(3)
+    return per_user.drop(columns=['timed_events', 'total_duration_ms']) \
+                   .sort_values('annotations', ascending=False) \
+                   .reset_index()
+
+
+def hourly_totals(rollups):
+    """Annotations and skips per hour, indexed by hour."""
+    return rollups.groupby('hour')[['annotations', 'skips']].sum().sort_index()
+
+
+def label_mix(rollups):
+    """Annotation counts per batch (rows) and label (columns)."""
+    labelled = rollups[rollups['label'] != '']
+    if labelled.empty:
+        return pd.DataFrame()
+    return labelled.pivot_table(index='batch_id', columns='label', values='annotations', aggfunc='sum', fill_value=0)
+
+
+def batch_projections(rows):
+    """Remaining comments, recent rate and projected hours to completion per batch.
+
+    The rate counts comments annotated for the first time, the same unit as
+    annotated_count, so extra labels on overlapping sections do not make a
+    batch look closer to done than it is.
+    """
+    frame = pd.DataFrame(rows, columns=['id', 'name', 'comment_count', 'annotated_count',
+                                        'recent_annotated', 'window_hours'])
+    frame['remaining'] = (frame['comment_count'].fillna(0) - frame['annotated_count']).clip(lower=0)
+    rate = frame['recent_annotated'] / frame['window_hours']
+    frame['per_hour'] = rate.round(1)
+    frame['hours_to_complete'] = (frame['remaining'] / rate.where(rate > 0)).round(1)
+    return frame.drop(columns=['window_hours'])
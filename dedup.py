@@ -0,0 +1,299 @@
+"""Near-duplicate clustering of comments.
+
+Retweets, copypasta and spelling variants of the same comment survive the
+exact-text dedup in ingest.py. This module groups them so each group is
+annotated once:
+
+* texts are normalised (case, URLs, @mentions, "RT" prefixes, punctuation and
+  repeated letters, so "sooo acchha" and "so acha" compare equal) and cut into
+  character shingles;
+* a 128-permutation MinHash signature is computed per comment with NumPy and
+  split into 16 LSH bands of 8 rows, which finds pairs above ~0.7 Jaccard
+  similarity; candidates are then checked against THRESHOLD;
+* a comment that matches an existing cluster leader joins that cluster,
+  otherwise it becomes a leader itself. Leaders never change, so adding a
+  batch only hashes the new comments.
+
+The index (signatures and band buckets of the leaders) lives in a local SQLite
+file and clusters are written to comment_clusters with add_comment_clusters.
+ingest.py updates the index as it loads (--dedup-index); this CLI indexes
+comments that are already in the database, resuming where it stopped:
+
+    python dedup.py --index near_duplicates.sqlite3
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import unicodedata
+import zlib
+
+import numpy as np
+from dotenv import load_dotenv
+from supabase import create_client
+
+DEFAULT_INDEX_PATH = "near_duplicates.sqlite3"
+NUM_PERM = 128
+BANDS = 16
+SHINGLE_SIZE = 4
+THRESHOLD = 0.8
+PAGE_SIZE = 1000
+SEED = 1
+# user_id of the annotations that propagate_cluster_labels copies to cluster members
+PROPAGATION_USER_ID = 'near-duplicate-propagation'
+# Mersenne-style prime below 2**32: (a * x + b) % PRIME never overflows uint64 for a, x, b < PRIME
+PRIME = np.uint64(4294967291)
+
+_URL = re.compile(r'https?://\S+|www\.\S+')
+_MENTION = re.compile(r'[@#]\w+')
+_RETWEET = re.compile(r'^\s*rt\b[:\s]*')
+_NON_WORD = re.compile(r'[\W_]+')
+_REPEATS = re.compile(r'(.)\1+')
+
+
+def normalize(text):
+    """Canonical form used for shingling."""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = _URL.sub(' ', text)
+    text = _RETWEET.sub('', text)
+    text = _MENTION.sub(' ', text)
+    text = _NON_WORD.sub(' ', text)
+    text = _REPEATS.sub(r'\1', text)
+    return ' '.join(text.split())
+
+
+def shingle_hashes(text, k=SHINGLE_SIZE):
+    """CRC32 of every k-character shingle of the normalised text, or an empty array if nothing is left."""
+    text = normalize(text)
+    if not text:
+        return np.empty(0, dtype=np.uint64)
+    if len(text) <= k:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + k] for i in range(len(text) - k + 1)}
+    return np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles))
+
+
+class MinHasher:
+    """MinHash signatures from universal hash functions (a * x + b) mod PRIME."""
+
+    def __init__(self, num_perm=NUM_PERM, seed=SEED):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, int(PRIME), size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, int(PRIME), size=num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        """uint32 signature of the text, or None if it has no content left after normalisation."""
+        hashes = shingle_hashes(text) % PRIME
+        if not len(hashes):
+            return None
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % PRIME).min(axis=1).astype(np.uint32)
+
+
+def band_keys(signature, bands=BANDS):
+    """One signed 64-bit bucket key per band."""
+    return [
+        int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8).digest(), 'big', signed=True)
+        for band in np.split(signature, bands)
+    ]
+
+
+class NearDuplicateIndex:
+    """Local LSH index of cluster leaders.
+
+    Only leaders are bucketed: members are matched against leaders, so a chain
+    of small edits cannot drift a cluster away from its first comment.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, threshold=THRESHOLD, num_perm=NUM_PERM, bands=BANDS, seed=SEED):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.hasher = MinHasher(num_perm, seed)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS comments (
+                comment_id TEXT PRIMARY KEY,
+                leader_id TEXT,
+                similarity REAL,
+                signature BLOB
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                comment_id TEXT NOT NULL,
+                PRIMARY KEY (band, bucket, comment_id)
+            ) WITHOUT ROWID;
+        """)
+        params = f"{num_perm}/{bands}/{seed}/{SHINGLE_SIZE}"
+        stored = self.get_meta('params')
+        if stored is None:
+            self.set_meta('params', params)
+        elif stored != params:
+            raise ValueError(f"Index {path} was built with parameters {stored}, not {params}")
+
+    def get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _best_leader(self, signature, keys):
+        # One primary-key lookup per band
+        lookups = ' UNION '.join(['SELECT comment_id FROM buckets WHERE band = ? AND bucket = ?'] * len(keys))
+        params = [value for band, key in enumerate(keys) for value in (band, key)]
+        candidates = self._conn.execute(
+            f"""SELECT c.comment_id, c.signature FROM ({lookups}) b
+                JOIN comments c ON c.comment_id = b.comment_id""",
+            params,
+        ).fetchall()
+        if not candidates:
+            return None, 0.0
+        signatures = np.frombuffer(b''.join(sig for _, sig in candidates), dtype=np.uint32).reshape(len(candidates), -1)
+        similarities = (signatures == signature).mean(axis=1)
+        best = int(similarities.argmax())
+        return candidates[best][0], float(similarities[best])
+
+    def add(self, comments):
+        """Index [{'id', 'comment_text'}, ...]. Returns cluster rows for the comments that are near-duplicates.
+
+        Comments already in the index return their stored cluster row again, so
+        replaying a chunk after a crash re-sends the same clusters.
+        """
+        clusters = []
+        with self._conn:
+            for comment in comments:
+                comment_id = str(comment['id'])
+                known = self._conn.execute(
+                    "SELECT leader_id, similarity FROM comments WHERE comment_id = ?", (comment_id,)
+                ).fetchone()
+                if known:
+                    if known[0]:
+                        clusters.append({'comment_id': comment_id, 'leader_id': known[0], 'similarity': known[1]})
+                    continue
+                signature = self.hasher.signature(comment['comment_text'])
+                if signature is None:
+                    # Nothing but links / emoji: too little text to call it a duplicate.
+                    self._conn.execute("INSERT INTO comments (comment_id) VALUES (?)", (comment_id,))
+                    continue
+                keys = band_keys(signature, self.bands)
+                leader_id, similarity = self._best_leader(signature, keys)
+                if leader_id is not None and similarity >= self.threshold:
+                    self._conn.execute(
+                        "INSERT INTO comments (comment_id, leader_id, similarity) VALUES (?, ?, ?)",
+                        (comment_id, leader_id, similarity),
+                    )
+                    clusters.append({'comment_id': comment_id, 'leader_id': leader_id, 'similarity': similarity})
+                else:
+                    self._conn.execute(
+                        "INSERT INTO comments (comment_id, signature) VALUES (?, ?)",
+                        (comment_id, signature.tobytes()),
+                    )
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO buckets (band, bucket, comment_id) VALUES (?, ?, ?)",
+                        [(band, key, comment_id) for band, key in enumerate(keys)],
+                    )
+        return clusters
+
+    def close(self):
+        self._conn.close()
+
+
+def write_clusters(client, clusters):
+    """Record cluster members in comment_clusters and copy any existing leader labels to them."""
+    if not clusters:
+        return 0
+    response = client.rpc('add_comment_clusters', {'p_clusters': clusters}).execute()
+    return response.data or 0
+
+
+def list_cluster_members(client, limit=50, unreviewed_only=True):
+    """Cluster members with their copied label, least similar first (the likeliest to need an override)."""
+    response = client.rpc('list_cluster_members', {'p_limit': limit, 'p_unreviewed_only': unreviewed_only}).execute()
+    return response.data or []
+
+
+def override_cluster_label(client, comment_id, label, categories, reviewer):
+    """Replace the label copied to a cluster member. Returns False if no label has been copied yet."""
+    response = client.rpc('override_propagated_label', {
+        'p_comment_id': str(comment_id),
+        'p_label': label,
+        'p_categories': categories,
+        'p_reviewer': reviewer,
+    }).execute()
+    return bool(response.data)
+
+
+def iter_comment_pages(client, since=None, page_size=PAGE_SIZE):
+    """Yield pages of {id, comment_text, created_at} in (created_at, id) order, after the `since` cursor.
+
+    Comments are keyed by random UUIDs, so paging on id alone would put new
+    comments behind a saved cursor; created_at only grows.
+    """
+    cursor = since
+    while True:
+        query = client.table('comments').select('id, comment_text, created_at')
+        if cursor:
+            created_at, comment_id = cursor
+            query = query.or_(
+                f'created_at.gt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.gt."{comment_id}")'
+            )
+        rows = query.order('created_at').order('id').limit(page_size).execute().data or []
+        if not rows:
+            return
+        yield rows
+        cursor = (rows[-1]['created_at'], rows[-1]['id'])
+
+
+def backfill(client, index, page_size=PAGE_SIZE, log=print):
+    """Index every comment created after the previous run's last one. Returns (comments read, near-duplicates found).
+
+    Indexes written before the cursor was a (created_at, id) pair are read from
+    the start once; comments they already hold are not hashed again.
+    """
+    read = found = 0
+    stored = index.get_meta('backfill_position')
+    for rows in iter_comment_pages(client, tuple(json.loads(stored)) if stored else None, page_size):
+        clusters = index.add(rows)
+        write_clusters(client, clusters)
+        index.set_meta('backfill_position', json.dumps([rows[-1]['created_at'], str(rows[-1]['id'])]))
+        read += len(rows)
+        found += len(clusters)
+        if read % (page_size * 10) == 0:
+            log(f"{read} comments indexed, {found} near-duplicates")
+    return read, found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index existing comments for near-duplicate clustering.")
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH, help="Local SQLite index file")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="Estimated Jaccard similarity needed to join a cluster")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set.")
+    client = create_client(url, key)
+
+    index = NearDuplicateIndex(args.index, threshold=args.threshold)
+    try:
+        read, found = backfill(client, index, page_size=args.page_size)
+    finally:
+        index.close()
+    print(f"Done: {read} comments indexed, {found} near-duplicates clustered")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Streaming annotation export.
+
+Pages through `annotations` with keyset pagination on (created_at, id) and
+writes every page straight to disk as CSV or Parquet, so memory use is bounded
+by the page size rather than the size of the corpus.
+
+Nightly / incremental dumps from the command line:
+
+    python export_annotations.py --format parquet --output exports/annotations.parquet --since-last
+"""
+import argparse
+import csv
+import json
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+from supabase import create_client
+
+PAGE_SIZE = 1000
+DEFAULT_WATERMARK_PATH = os.path.join("exports", ".export_watermark.json")
+EXPORT_COLUMNS = [
+    'annotation_id', 'comment_id', 'batch_id', 'user_id', 'label',
+    'categories', 'notes', 'created_at', 'comment_text',
+]
+
+
+def iter_annotation_pages(client, since=None, page_size=PAGE_SIZE):
+    """Yield pages of export rows in (created_at, id) order, starting after the `since` cursor."""
+    cursor = since
+    while True:
+        query = client.table('annotations').select(
+            'id, comment_id, batch_id, user_id, label, categories, notes, created_at, comments (comment_text)'
+        )
+        if cursor:
+            created_at, annotation_id = cursor
+            query = query.or_(
+                f'created_at.gt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.gt."{annotation_id}")'
+            )
+        response = query.order('created_at').order('id').limit(page_size).execute()
+        rows = response.data or []
+        # Stop only on an empty page: the API may cap pages below page_size.
+        if not rows:
+            return
+        yield [_to_export_row(row) for row in rows]
+        cursor = (rows[-1]['created_at'], rows[-1]['id'])
+
+
+def _to_export_row(annotation):
+    comment = annotation.get('comments') or {}
+    return {
+        'annotation_id': annotation['id'],
+        'comment_id': annotation['comment_id'],
+        'batch_id': annotation.get('batch_id'),
+        'user_id': annotation['user_id'],
+        'label': annotation.get('label'),
+        'categories': list(annotation.get('categories') or []),
+        'notes': annotation.get('notes') or '',
+        'created_at': annotation['created_at'],
+        'comment_text': comment.get('comment_text', ''),
+    }
+
+
+class CsvSink:
+    """Appends export rows to a CSV file; categories are joined with ', '."""
+
+    def __init__(self, path):
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=EXPORT_COLUMNS)
+        self._writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            self._writer.writerow({**row, 'categories': ', '.join(row['categories'])})
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSink:
+    """Appends export rows to a Parquet file, one row group per page.
+
+    Categories are stored as a list of dictionary-encoded strings and the label
+    as a dictionary-encoded column, which keeps the file small for a closed
+    vocabulary.
+    """
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export requires pyarrow. Install it with `pip install pyarrow`.")
+        self._pa = pa
+        self._schema = pa.schema([
+            ('annotation_id', pa.string()),
+            ('comment_id', pa.string()),
+            ('batch_id', pa.string()),
+            ('user_id', pa.string()),
+            ('label', pa.dictionary(pa.int32(), pa.string())),
+            ('categories', pa.list_(pa.dictionary(pa.int32(), pa.string()))),
+            ('notes', pa.string()),
+            ('created_at', pa.timestamp('us', tz='UTC')),
+            ('comment_text', pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema, compression='zstd')
+
+    def write(self, rows):
+        pa = self._pa
+        columns = {name: [row[name] for row in rows] for name in EXPORT_COLUMNS}
+        columns['created_at'] = [datetime.fromisoformat(value) for value in columns['created_at']]
+        for name in ('annotation_id', 'comment_id', 'batch_id'):
+            columns[name] = [None if value is None else str(value) for value in columns[name]]
+        table = pa.Table.from_pydict(
+            {name: pa.array(columns[name], type=self._schema.field(name).type) for name in EXPORT_COLUMNS},
+            schema=self._schema,
+        )
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+
+SINKS = {'csv': CsvSink, 'parquet': ParquetSink}
+
+
+def export_annotations(client, output_path, fmt='csv', since=None, page_size=PAGE_SIZE, max_rows=None):
+    """Stream annotations created after `since` into output_path.
+
+    With max_rows, stops at the first page boundary at or past that many rows;
+    exporting again from the returned cursor continues with the next part.
+    Returns (row_count, last_cursor). last_cursor is the (created_at, id) of the
+    final exported row, or `since` if nothing new was found.
+    """
+    if fmt not in SINKS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    sink = SINKS[fmt](output_path)
+    row_count, cursor = 0, since
+    try:
+        for rows in iter_annotation_pages(client, since=since, page_size=page_size):
+            sink.write(rows)
+            row_count += len(rows)
+            cursor = (rows[-1]['created_at'], rows[-1]['annotation_id'])
+            if max_rows and row_count >= max_rows:
+                break
+    finally:
+        sink.close()
+    return row_count, cursor
+
+
+def load_watermark(path=DEFAULT_WATERMARK_PATH):
+    """Read the (created_at, id) cursor saved by the last export, if any."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return data['created_at'], data['id']
+    except FileNotFoundError:
+        return None
+
+
+def save_watermark(cursor, path=DEFAULT_WATERMARK_PATH):
+    """Persist the cursor atomically so an interrupted write never loses the previous one."""
+    if cursor is None:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'created_at': cursor[0], 'id': cursor[1]}, f)
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export annotations to CSV or Parquet.")
+    parser.add_argument('--format', choices=sorted(SINKS), default='csv')
+    parser.add_argument('--output', help="Output file (defaults to exports/annotations_<timestamp>.<format>)")
+    parser.add_argument('--since-last', action='store_true',
+                        help="Only export annotations created after the stored watermark, then advance it")
+    parser.add_argument('--watermark', default=DEFAULT_WATERMARK_PATH, help="Watermark file used by --since-last")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set.")
+    client = create_client(url, key)
+
+    output = args.output or os.path.join(
+        "exports", f"annotations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{args.format}"
+    )
+    since = load_watermark(args.watermark) if args.since_last else None
+    row_count, cursor = export_annotations(client, output, fmt=args.format, since=since, page_size=args.page_size)
+    if args.since_last:
+        save_watermark(cursor, args.watermark)
+    print(f"Exported {row_count} annotation(s) to {output}")
+
+
+if __name__ == "__main__":
+    main()
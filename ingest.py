@@ -0,0 +1,296 @@
+"""Bulk corpus ingestion.
+
+Streams a CSV or JSONL corpus into `comments`, `batches` and `comment_batches`
+without loading it into memory:
+
+* each text is hashed (SHA-256 of the stripped text) and exact duplicates are
+  dropped, both within the corpus and against comments already in the database.
+  The database is asked about a chunk's worth of hashes at a time, before any
+  of them is numbered (the unique index on comments.text_hash still guards
+  against concurrent loads);
+* surviving comments get consecutive `original_index` values and are split
+  into batches of exactly --batch-size comments;
+* chunks are written with the ingest_comment_chunk RPC, which inserts the
+  comments, links them to their batch and bumps `batches.comment_count` in one
+  transaction, with at most --concurrency chunks in flight.
+
+With --dedup-index, every chunk is also run through the near-duplicate index
+(dedup.py) and its cluster members are recorded before the section maps are
+built, so only cluster leaders are served to annotators. A chunk is indexed
+only after it and every chunk before it have been written, so a cluster never
+points at a leader that is not in the database yet.
+
+Progress is checkpointed to a local SQLite file after every chunk, so an
+interrupted load resumes where it stopped when re-run with the same arguments:
+
+    python ingest.py corpus.csv --name "Hinglish tweets" --text-column text
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from supabase import create_client
+
+from dedup import NearDuplicateIndex, write_clusters
+
+# replit.md: comments are organised in batches of roughly 2500
+DEFAULT_BATCH_SIZE = 2500
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CONCURRENCY = 4
+
+# Namespace for deterministic ids, so replaying a chunk writes the same rows
+INGEST_NAMESPACE = uuid.UUID('6f1d3c52-8d0e-4f4e-9a53-2b0c1e7a4d10')
+
+
+def text_hash(text):
+    return hashlib.sha256(text.strip().encode('utf-8')).hexdigest()
+
+
+def read_texts(path, text_column):
+    """Yield comment texts from a CSV or JSONL file, one record at a time."""
+    if path.endswith('.jsonl') or path.endswith('.ndjson'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield (json.loads(line).get(text_column) or '')
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                yield row.get(text_column) or ''
+
+
+class Checkpoint:
+    """Local SQLite record of which texts were seen and which chunks were written.
+
+    Every planned chunk is stored with the reader state *after* it. On resume
+    the load restarts after the last chunk whose predecessors were all written,
+    and hashes planned for later chunks are forgotten so they get planned again.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS seen (hash TEXT PRIMARY KEY, chunk_seq INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS chunks (
+                seq INTEGER PRIMARY KEY,
+                records_consumed INTEGER NOT NULL,
+                next_index INTEGER NOT NULL,
+                batch_number INTEGER NOT NULL,
+                batch_fill INTEGER NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        self._conn.commit()
+
+    def resume_state(self):
+        """Return (last_seq, records_consumed, next_index, batch_number, batch_fill) to continue from."""
+        first_pending = self._conn.execute("SELECT MIN(seq) FROM chunks WHERE done = 0").fetchone()[0]
+        query = "SELECT seq, records_consumed, next_index, batch_number, batch_fill FROM chunks WHERE done = 1"
+        params = ()
+        if first_pending is not None:
+            query += " AND seq < ?"
+            params = (first_pending,)
+        row = self._conn.execute(query + " ORDER BY seq DESC LIMIT 1", params).fetchone()
+        state = row or (0, 0, 0, 0, 0)
+        self._conn.execute("DELETE FROM seen WHERE chunk_seq > ?", (state[0],))
+        self._conn.execute("DELETE FROM chunks WHERE seq > ?", (state[0],))
+        self._conn.commit()
+        return state
+
+    def is_new(self, digest, chunk_seq):
+        """Record a hash; returns False if it was already seen."""
+        cursor = self._conn.execute("INSERT OR IGNORE INTO seen (hash, chunk_seq) VALUES (?, ?)", (digest, chunk_seq))
+        return cursor.rowcount == 1
+
+    def plan_chunk(self, seq, records_consumed, next_index, batch_number, batch_fill):
+        self._conn.execute(
+            "INSERT INTO chunks (seq, records_consumed, next_index, batch_number, batch_fill) VALUES (?, ?, ?, ?, ?)",
+            (seq, records_consumed, next_index, batch_number, batch_fill),
+        )
+        self._conn.commit()
+
+    def mark_done(self, seq):
+        self._conn.execute("UPDATE chunks SET done = 1 WHERE seq = ?", (seq,))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def batch_id_for(corpus_name, batch_number):
+    return str(uuid.uuid5(INGEST_NAMESPACE, f"batch:{corpus_name}:{batch_number}"))
+
+
+def ensure_batch(client, corpus_name, batch_number, description):
+    """Create the batch row (idempotent). Returns its id."""
+    batch_id = batch_id_for(corpus_name, batch_number)
+    client.table('batches').upsert({
+        'id': batch_id,
+        'name': f"{corpus_name} #{batch_number}",
+        'description': description,
+        'comment_count': 0,
+    }, on_conflict='id', ignore_duplicates=True).execute()
+    return batch_id
+
+
+def build_sections(client, batch_id, section_size=None):
+    response = client.rpc('build_batch_sections', {'p_batch_id': batch_id, 'p_section_size': section_size}).execute()
+    return response.data
+
+
+def existing_hashes(client, digests):
+    """{text_hash: batch_id} for the given hashes that are already in comments."""
+    response = client.rpc('existing_comment_hashes', {'p_hashes': list(digests)}).execute()
+    return {row['text_hash']: row['batch_id'] for row in response.data or []}
+
+
+def write_chunk(client, batch_id, comments):
+    response = client.rpc('ingest_comment_chunk', {'p_batch_id': batch_id, 'p_comments': comments}).execute()
+    return response.data or 0
+
+
+def ingest(client, path, corpus_name, text_column='comment_text', batch_size=DEFAULT_BATCH_SIZE,
+           chunk_size=DEFAULT_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY, checkpoint_path=None,
+           description='', section_size=None, dedup_index=None, log=print):
+    """Load a corpus file. Returns (comments planned, duplicates skipped) for this run.
+
+    dedup_index is an optional NearDuplicateIndex to cluster near-duplicates with.
+    """
+    checkpoint = Checkpoint(checkpoint_path or f"{path}.ingest-checkpoint.sqlite3")
+    seq, records_consumed, next_index, batch_number, batch_fill = checkpoint.resume_state()
+    if seq:
+        log(f"Resuming after {records_consumed} records (batch {batch_number}, {batch_fill} comments in it)")
+
+    planned = duplicates = 0
+    first_batch_number = max(batch_number, 1)
+    in_flight = deque()
+    batch_id = ensure_batch(client, corpus_name, batch_number, description) if batch_number else None
+    chunk = []
+
+    def drain(limit):
+        # Checkpoints advance strictly in order, even if later chunks finish first.
+        while len(in_flight) > limit:
+            chunk_seq, written, future = in_flight.popleft()
+            future.result()
+            if dedup_index:
+                # Leaders are in this chunk or an earlier one, all written by now. A replayed
+                # chunk gets its stored clusters back, and add_comment_clusters ignores repeats.
+                write_clusters(client, dedup_index.add(written))
+            checkpoint.mark_done(chunk_seq)
+
+    def submit(consumed):
+        # consumed: records read up to and including the last comment in the chunk
+        nonlocal chunk
+        checkpoint.plan_chunk(seq, consumed, next_index, batch_number, batch_fill)
+        in_flight.append((seq, chunk, executor.submit(write_chunk, client, batch_id, chunk)))
+        chunk = []
+        drain(concurrency)
+
+    def plan(candidates):
+        """Number and batch (consumed, text, digest) candidates in reading order."""
+        nonlocal seq, next_index, batch_number, batch_fill, batch_id, planned, duplicates
+        stored = existing_hashes(client, {digest for _, _, digest in candidates})
+        # Rows this corpus wrote before an interruption are planned again exactly as
+        # before (ingest_comment_chunk skips them); anything else is a duplicate.
+        own_batches = {batch_id_for(corpus_name, n) for n in range(1, batch_number + 2)}
+        for consumed, text, digest in candidates:
+            if (digest in stored and str(stored[digest]) not in own_batches) \
+                    or not checkpoint.is_new(digest, seq + 1):
+                duplicates += 1
+                continue
+            if batch_id is None or batch_fill >= batch_size:
+                batch_number += 1
+                batch_fill = 0
+                batch_id = ensure_batch(client, corpus_name, batch_number, description)
+            chunk.append({
+                'id': str(uuid.uuid5(INGEST_NAMESPACE, digest)),
+                'comment_text': text,
+                'original_index': next_index,
+                'text_hash': digest,
+            })
+            next_index += 1
+            batch_fill += 1
+            planned += 1
+            # Chunks never straddle batches
+            if len(chunk) >= chunk_size or batch_fill >= batch_size:
+                seq += 1
+                submit(consumed)
+            if planned % 10000 == 0:
+                log(f"{planned} comments planned, {duplicates} duplicates skipped")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            texts = read_texts(path, text_column)
+            for _ in range(records_consumed):
+                next(texts, None)
+            candidates = []
+            for text in texts:
+                records_consumed += 1
+                text = text.strip()
+                if not text:
+                    continue
+                candidates.append((records_consumed, text, text_hash(text)))
+                if len(candidates) >= chunk_size:
+                    plan(candidates)
+                    candidates = []
+            if candidates:
+                plan(candidates)
+            if chunk:
+                seq += 1
+                submit(records_consumed)
+            drain(0)
+        finally:
+            checkpoint.close()
+    # Section maps are built once a batch is complete, so they cover every comment
+    for number in range(first_batch_number, batch_number + 1):
+        build_sections(client, batch_id_for(corpus_name, number), section_size)
+    return planned, duplicates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a CSV/JSONL corpus into comments, batches and comment_batches.")
+    parser.add_argument('path', help="CSV file, or .jsonl/.ndjson with one JSON object per line")
+    parser.add_argument('--name', required=True, help="Corpus name; batches are called '<name> #<n>'")
+    parser.add_argument('--description', default='')
+    parser.add_argument('--text-column', default='comment_text', help="CSV column / JSON field holding the text")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--section-size', type=int,
+                        help="Comments per section (default: a tenth of the batch, remainder in a final section)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--checkpoint', help="Checkpoint file (defaults to <path>.ingest-checkpoint.sqlite3)")
+    parser.add_argument('--dedup-index', help="Near-duplicate index file (see dedup.py); clusters near-duplicates")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set.")
+    client = create_client(url, key)
+
+    csv.field_size_limit(sys.maxsize)
+    dedup_index = NearDuplicateIndex(args.dedup_index) if args.dedup_index else None
+    try:
+        planned, duplicates = ingest(
+            client, args.path, args.name, text_column=args.text_column, batch_size=args.batch_size,
+            chunk_size=args.chunk_size, concurrency=args.concurrency, checkpoint_path=args.checkpoint,
+            description=args.description, section_size=args.section_size, dedup_index=dedup_index,
+        )
+    finally:
+        if dedup_index:
+            dedup_index.close()
+    print(f"Done: {planned} comments written, {duplicates} duplicates skipped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Per-rerun timing of repository calls.
+
+An InstrumentedRepository wraps every AnnotationRepository method and records
+its duration, row count and JSON payload size into the RerunTrace of the
+Streamlit rerun that made the call. Backend work that does not go through the
+repository (auth admin calls, exports, agreement and dedup queries, analytics
+RPCs) is timed into the same trace with traced(), which also runs it through
+the ResilientRepository underneath. Finished traces are kept in a
+small ring buffer for the developer panel and can be appended to a JSONL file
+for offline analysis.
+
+Nothing is wrapped unless a trace is started, so the cost is zero when the
+panel is off.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+from repository import AnnotationRepository
+from resilience import ResilientRepository
+
+RING_BUFFER_SIZE = 20
+
+_jsonl_lock = threading.Lock()
+
+
+class RerunTrace:
+    """Timings collected during one execution of the script."""
+
+    def __init__(self, label=None):
+        self.label = label
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.calls = []
+
+    def record(self, operation, duration, rows, payload_bytes, error=None):
+        # list.append is atomic, so prefetch / worker threads can record too
+        self.calls.append({
+            'operation': operation,
+            'duration_ms': round(duration * 1000, 3),
+            'rows': rows,
+            'payload_bytes': payload_bytes,
+            'error': error,
+        })
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+        return self
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'started_at': self.started_at,
+            'duration_ms': None if self.duration is None else round(self.duration * 1000, 3),
+            'calls': list(self.calls),
+        }
+
+
+def _measure(result):
+    if result is None:
+        return 0, 0
+    if hasattr(result, 'to_json') and hasattr(result, 'shape'):
+        # pandas objects from the analytics queries
+        return len(result), len(result.to_json(date_format='iso'))
+    rows = len(result) if isinstance(result, list) else 1
+    try:
+        payload_bytes = len(json.dumps(result, default=str))
+    except (TypeError, ValueError):
+        payload_bytes = None
+    return rows, payload_bytes
+
+
+@AnnotationRepository.register
+class InstrumentedRepository:
+    """Repository proxy that times every operation into a RerunTrace."""
+
+    def __init__(self, repository, trace):
+        self.repository = repository
+        self.trace = trace
+        for name, member in vars(AnnotationRepository).items():
+            if callable(member) and not name.startswith('_'):
+                setattr(self, name, self._wrap(name, getattr(repository, name)))
+
+    def call(self, operation, func, *args, **kwargs):
+        """Run func(*args, **kwargs) and record it in the current trace as `operation`."""
+        # Looked up per call: fragment reruns point the wrapper at a new trace
+        trace = self.trace
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            trace.record(operation, time.perf_counter() - start, 0, 0, error=str(e))
+            raise
+        duration = time.perf_counter() - start
+        rows, payload_bytes = _measure(result)
+        trace.record(operation, duration, rows, payload_bytes)
+        return result
+
+    def _wrap(self, operation, method):
+        def timed(*args, **kwargs):
+            return self.call(operation, method, *args, **kwargs)
+
+        return timed
+
+
+def instrument(repository, trace):
+    """Wrap repository for the given trace, or return it untouched when tracing is off."""
+    if trace is None:
+        return repository
+    return InstrumentedRepository(repository, trace)
+
+
+def traced(repository, operation, func, *args, **kwargs):
+    """Call a backend function that bypasses the repository through the same proxies as a repository call.
+
+    The call lands in the trace of `repository` when it is instrumented, and
+    gets retries, the circuit breaker and stale reads (ResilientRepository.call)
+    when a ResilientRepository is underneath. Otherwise it is simply called.
+    """
+    if isinstance(repository, InstrumentedRepository):
+        return repository.call(operation, traced, repository.repository, operation, func, *args, **kwargs)
+    if isinstance(repository, ResilientRepository):
+        return repository.call(operation, func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def new_ring_buffer():
+    return deque(maxlen=RING_BUFFER_SIZE)
+
+
+def append_jsonl(path, record):
+    """Append one trace record as a JSON line."""
+    line = json.dumps(record, default=str)
+    with _jsonl_lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
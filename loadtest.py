@@ -0,0 +1,292 @@
+"""Concurrency load test for the annotation hot paths.
+
+Simulates N annotators, each on its own thread, running the app's loop
+against a repository backend: list batches -> assign section -> fetch section
+comments -> (save annotation + update progress) per comment -> read stats.
+Alongside them, --claimers threads work a separate pool batch through the
+comment claiming path: claim_comments (one lease for a block of comments) ->
+annotate -> renew_leases -> claim_next_comment. Reports overall throughput and
+p50/p99 latency per operation, and checks that no section and no comment was
+handed to two annotators.
+
+    python loadtest.py --annotators 20 --batches 4 --batch-size 2500
+
+--fault-rate makes that fraction of backend calls fail with a connection error
+(half of them after the call went through, as when a response is lost) and
+runs the annotators through ResilientRepository, to check that retries keep
+the run going without duplicating annotations or sections.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from repository import CATEGORIES, LABELS, AnnotationRepository, SQLiteRepository
+from resilience import CircuitBreaker, ResilientRepository
+
+OPERATIONS = [
+    'list_batches', 'assign_section', 'get_section_comments',
+    'save_annotation', 'update_progress', 'get_user_stats',
+    'claim_comments', 'renew_leases', 'claim_next_comment',
+]
+CLAIM_POOL_NAME = "claim pool"
+
+
+class LatencyRecorder:
+    """Thread-safe collection of per-operation latencies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def timed(self, operation, func, *args):
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            with self._lock:
+                self.errors[operation] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples[operation].append(elapsed)
+        return result
+
+
+@AnnotationRepository.register
+class FlakyRepository:
+    """Backend proxy that fails a fraction of calls with ConnectionError."""
+
+    def __init__(self, repository, fault_rate, seed=0):
+        self.repository = repository
+        self.fault_rate = fault_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        for name, member in vars(AnnotationRepository).items():
+            if callable(member) and not name.startswith('_'):
+                setattr(self, name, self._wrap(name, getattr(repository, name)))
+
+    def _fault(self):
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.fault_rate / 2:
+            return 'before'
+        if roll < self.fault_rate:
+            return 'after'
+        return None
+
+    def _wrap(self, operation, method):
+        def flaky(*args, **kwargs):
+            fault = self._fault()
+            if fault == 'before':
+                raise ConnectionError(f"injected fault before {operation}")
+            result = method(*args, **kwargs)
+            if fault == 'after':
+                raise ConnectionError(f"injected fault after {operation}")
+            return result
+
+        return flaky
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def simulate_annotator(repo, recorder, user_id, sections_per_annotator, comments_per_section, assignments, rng):
+    try:
+        annotate_sections(repo, recorder, user_id, sections_per_annotator, comments_per_section, assignments, rng)
+    except Exception:
+        # Counted by the recorder; this annotator gives up like a user seeing an error would
+        pass
+
+
+def random_annotation(comment_id, batch_id, user_id, rng):
+    return {
+        'comment_id': comment_id,
+        'batch_id': batch_id,
+        'user_id': user_id,
+        'label': rng.choice(LABELS),
+        'categories': rng.sample(CATEGORIES, rng.randint(0, 2)),
+        'notes': '',
+    }
+
+
+def annotate_sections(repo, recorder, user_id, sections_per_annotator, comments_per_section, assignments, rng):
+    for _ in range(sections_per_annotator):
+        # The claim pool is worked only through comment claims
+        batches = [batch for batch in recorder.timed('list_batches', repo.list_batches)
+                   if batch['name'] != CLAIM_POOL_NAME]
+        if not batches:
+            return
+        batch = rng.choice(batches)
+        assignment = recorder.timed('assign_section', repo.assign_section, batch['id'], user_id)
+        if assignment is None:
+            continue
+        section_number = assignment['assigned_section_number']
+        assignments.append((batch['id'], section_number, user_id))
+        comments = recorder.timed('get_section_comments', repo.get_section_comments, batch['id'], section_number)
+        progress = assignment['saved_progress_index']
+        for comment in comments[progress:progress + comments_per_section if comments_per_section else None]:
+            recorder.timed('save_annotation', repo.save_annotation,
+                           random_annotation(comment['id'], batch['id'], user_id, rng))
+            progress += 1
+            recorder.timed('update_progress', repo.update_progress, batch['id'], user_id, progress)
+        recorder.timed('get_user_stats', repo.get_user_stats, user_id)
+
+
+def simulate_claimer(repo, recorder, user_id, pool_batch_id, claim_size, claim_rounds, claims, rng):
+    try:
+        claim_and_annotate(repo, recorder, user_id, pool_batch_id, claim_size, claim_rounds, claims, rng)
+    except Exception:
+        pass
+
+
+def claim_and_annotate(repo, recorder, user_id, pool_batch_id, claim_size, claim_rounds, claims, rng):
+    for _ in range(claim_rounds):
+        claimed = recorder.timed('claim_comments', repo.claim_comments, pool_batch_id, user_id, claim_size)
+        if not claimed:
+            return
+        claims.extend((comment['id'], user_id) for comment in claimed)
+        for position, comment in enumerate(claimed):
+            recorder.timed('save_annotation', repo.save_annotation,
+                           random_annotation(comment['id'], pool_batch_id, user_id, rng))
+            if position == len(claimed) // 2:
+                # An annotator half-way through a block keeps its lease alive
+                recorder.timed('renew_leases', repo.renew_leases, pool_batch_id, user_id)
+        comment = recorder.timed('claim_next_comment', repo.claim_next_comment, pool_batch_id, user_id)
+        if comment is None:
+            return
+        claims.append((comment['id'], user_id))
+        recorder.timed('save_annotation', repo.save_annotation,
+                       random_annotation(comment['id'], pool_batch_id, user_id, rng))
+
+
+def run_load_test(repo, annotators, sections_per_annotator=1, comments_per_section=0, seed=0,
+                  claimers=0, pool_batch_id=None, claim_size=10, claim_rounds=5):
+    """Run the simulated annotators against `repo` and return (wall seconds, recorder, assignments, claims).
+
+    comments_per_section=0 annotates each section to the end. claimers > 0
+    also runs that many claim-path annotators against pool_batch_id.
+    """
+    recorder = LatencyRecorder()
+    assignments = []
+    claims = []
+    threads = [
+        threading.Thread(
+            target=simulate_annotator,
+            args=(repo, recorder, f"annotator{i}@example.com", sections_per_annotator,
+                  comments_per_section, assignments, random.Random(seed + i)),
+        )
+        for i in range(annotators)
+    ]
+    threads += [
+        threading.Thread(
+            target=simulate_claimer,
+            args=(repo, recorder, f"claimer{i}@example.com", pool_batch_id, claim_size, claim_rounds,
+                  claims, random.Random(seed + annotators + i)),
+        )
+        for i in range(claimers if pool_batch_id else 0)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, recorder, assignments, claims
+
+
+def report(wall_seconds, recorder, assignments, claims=()):
+    total_ops = sum(len(samples) for samples in recorder.samples.values())
+    print(f"Wall time: {wall_seconds:.2f}s, {total_ops} operations, {total_ops / wall_seconds:.1f} ops/s")
+    print(f"{'operation':<22}{'count':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for operation in OPERATIONS:
+        samples = sorted(recorder.samples.get(operation, []))
+        if not samples:
+            continue
+        print(f"{operation:<22}{len(samples):>8}{len(samples) / wall_seconds:>10.1f}"
+              f"{percentile(samples, 0.50) * 1000:>10.2f}{percentile(samples, 0.99) * 1000:>10.2f}")
+
+    owners = defaultdict(set)
+    for batch_id, section_number, user_id in assignments:
+        owners[(batch_id, section_number)].add(user_id)
+    conflicts = [key for key, users in owners.items() if len(users) > 1]
+    print(f"Sections assigned: {len(owners)}, double-assigned: {len(conflicts)}")
+
+    claimers = defaultdict(set)
+    for comment_id, user_id in claims:
+        claimers[comment_id].add(user_id)
+    double_claimed = [comment_id for comment_id, users in claimers.items() if len(users) > 1]
+    if claims:
+        print(f"Comments claimed: {len(claimers)}, double-claimed: {len(double_claimed)}")
+    if recorder.errors:
+        print("Failed calls: " + ", ".join(f"{op} {count}" for op, count in sorted(recorder.errors.items())))
+    return not conflicts and not double_claimed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent annotators against a local SQLite backend.")
+    parser.add_argument('--annotators', type=int, default=10)
+    parser.add_argument('--batches', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=500, help="Comments per batch")
+    parser.add_argument('--section-size', type=int, help="Comments per section (default: a tenth of the batch)")
+    parser.add_argument('--sections-per-annotator', type=int, default=1)
+    parser.add_argument('--comments-per-section', type=int, default=0,
+                        help="Annotate at most this many comments per section (0 = whole section)")
+    parser.add_argument('--claimers', type=int, default=2,
+                        help="Annotators working the claim pool batch through claim_comments (0 = none)")
+    parser.add_argument('--claim-size', type=int, default=10, help="Comments leased per claim_comments call")
+    parser.add_argument('--claim-rounds', type=int, default=5,
+                        help="claim_comments + claim_next_comment rounds per claimer")
+    parser.add_argument('--db', help="SQLite file to use (defaults to a temporary file)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fault-rate', type=float, default=0.0,
+                        help="Fraction of backend calls that fail, exercising the retry layer")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        repo = SQLiteRepository(args.db or os.path.join(tmp_dir, "loadtest.sqlite3"))
+        rng = random.Random(args.seed)
+        for b in range(args.batches):
+            texts = [f"comment {b}-{i} {rng.random():.6f}" for i in range(args.batch_size)]
+            repo.load_batch(f"batch {b + 1}", texts, section_size=args.section_size)
+        pool_batch_id = None
+        if args.claimers:
+            pool_size = args.claimers * args.claim_rounds * (args.claim_size + 1)
+            pool_batch_id = repo.load_batch(
+                CLAIM_POOL_NAME, [f"pool comment {i} {rng.random():.6f}" for i in range(pool_size)]
+            )
+        backend = repo
+        if args.fault_rate:
+            backend = ResilientRepository(
+                FlakyRepository(repo, args.fault_rate, args.seed),
+                base_delay=0.01, max_delay=0.1, breaker=CircuitBreaker(reset_timeout=1),
+            )
+        wall_seconds, recorder, assignments, claims = run_load_test(
+            backend, args.annotators, args.sections_per_annotator, args.comments_per_section, args.seed,
+            args.claimers, pool_batch_id, args.claim_size, args.claim_rounds
+        )
+        ok = report(wall_seconds, recorder, assignments, claims)
+        if args.fault_rate:
+            stats = backend.stats()
+            stats.pop('per_operation')
+            print("Request layer: " + ", ".join(f"{name} {value}" for name, value in stats.items()))
+            with sqlite3.connect(repo.path) as conn:
+                duplicates = conn.execute(
+                    "SELECT COUNT(*) - COUNT(DISTINCT comment_id || '/' || user_id) FROM annotations"
+                ).fetchone()[0]
+            print(f"Duplicate annotations: {duplicates}")
+            ok = ok and not duplicates
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,762 @@
+"""Data-access layer for the annotation workflow.
+
+The app talks to an AnnotationRepository instead of the Supabase client
+directly. SupabaseRepository is the production backend; SQLiteRepository
+implements the same semantics (including the section assignment and comment
+claiming RPCs) on a local SQLite file, so the hot paths can be benchmarked and
+regression-tested without a live project (see loadtest.py).
+
+Repository methods raise on failure; callers decide how to surface errors.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+
+# Comment claims expire after this long (matches claim_next_comment_in_batch)
+CLAIM_LOCK_SECONDS = 30 * 60
+# Expired claims released per sweep call (matches release_expired_locks)
+SWEEP_CHUNK_SIZE = 1000
+# Unused next-section reservations expire after this long (matches reserve_next_section)
+RESERVATION_TTL_SECONDS = 2 * 60 * 60
+# Section map orders accepted by build_sections (p_order of build_batch_sections)
+SECTION_ORDERS = ('original', 'uncertainty')
+# Annotation vocabulary. agreement.py codes labels and categories by their
+# position here and section packs carry it, so only ever append to these.
+LABELS = ['hate', 'non-hate']
+CATEGORIES = [
+    'none', 'religion', 'race', 'caste', 'regionalism', 'terrorism', 'language', 'body shaming',
+    'addiction', 'disability', 'age', 'gender', 'sexual', 'political', 'privacy', 'cyber bully',
+]
+
+
+def default_section_size(total_batch_size):
+    """Ten sections per batch (one for tiny batches); any remainder becomes an extra final section."""
+    if total_batch_size < 10:
+        return max(total_batch_size, 1)
+    return total_batch_size // 10
+
+
+def _timestamp(iso_time):
+    """Epoch seconds for an ISO 8601 time, as stored by SQLiteRepository; None stays None."""
+    return datetime.fromisoformat(iso_time).timestamp() if iso_time else None
+
+
+class AnnotationRepository(ABC):
+    """Operations the annotation app needs from its backend.
+
+    Proxies that forward every operation to another repository (instrumentation,
+    retries, fault injection) register as virtual subclasses instead of
+    inheriting, since they bind the operations per instance.
+    """
+
+    @abstractmethod
+    def list_batches(self):
+        """Every batch as a dict with id, name, description, comment_count and annotated_count."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_batch(self, batch_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def assign_section(self, batch_id, user_id):
+        """Return the user's current section, assigning the next free one if needed.
+
+        Result is a dict with assigned_section_number and saved_progress_index,
+        or None when the batch has no sections left.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def build_sections(self, batch_id, section_size=None, order='original'):
+        """(Re)build the section map of a batch. Returns the number of sections.
+
+        order is 'original' (original_index) or 'uncertainty' (most uncertain
+        suggestion score first, unscored comments last).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_section_comments(self, batch_id, section_number):
+        """Comments of one section (id, comment_text, original_index, hate_probability) in serving order."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_annotation(self, annotation):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_annotations(self, annotations):
+        """Bulk insert; rows whose idempotency_key already exists are skipped."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_skip_events(self, events):
+        """Record "Skip For Now" events; rows whose idempotency_key already exists are skipped."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_progress(self, batch_id, user_id, progress_index, section_number=None):
+        """Set the user's progress in a section (their current one when section_number is None)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def import_section_results(self, batch_id, user_id, section_number, annotations, skips, progress_index):
+        """Bulk-load work done offline on one section and advance its progress, in one transaction.
+
+        Rows whose idempotency_key is already stored, annotations of comments the
+        user has already labelled and comments outside the section are ignored;
+        progress only moves forward, and only if the section was assigned to the
+        user. Rows are stored as created now, with the offline time (each row's
+        offline_at) kept separately. Returns a dict with imported_annotations,
+        imported_skips and progress_index (None when the progress was not touched).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user_stats(self, user_id):
+        """Return (total, label counts, category counts) for one annotator."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def reserve_next_section(self, batch_id, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_section_reservation(self, batch_id, user_id):
+        """Turn a live reservation into the user's assignment; same shape as assign_section, or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_section_reservation(self, batch_id, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_next_comment(self, batch_id, user_id):
+        """Atomically claim the lowest unassigned comment in a batch, or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_comments(self, batch_id, user_id, count, lease_seconds=CLAIM_LOCK_SECONDS):
+        """Atomically lease up to `count` of the lowest unassigned comments with one expiry."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def renew_leases(self, batch_id, user_id, lease_seconds=CLAIM_LOCK_SECONDS):
+        """Extend the user's live leases in a batch. Returns how many were renewed."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_expired_locks(self, limit=SWEEP_CHUNK_SIZE):
+        """Release at most `limit` expired claims. Returns how many were released."""
+        raise NotImplementedError
+
+
+class SupabaseRepository(AnnotationRepository):
+    """Backend that talks to the Supabase tables and RPCs in supabase_rpc.sql."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def list_batches(self):
+        response = self.client.rpc('get_batch_dashboard').execute()
+        return response.data or []
+
+    def get_batch(self, batch_id):
+        response = self.client.table('batches').select('*').eq('id', batch_id).single().execute()
+        return response.data
+
+    def assign_section(self, batch_id, user_id):
+        # RPC returns a list with a dictionary
+        response = self.client.rpc('assign_section_to_user', {
+            'p_batch_id': batch_id,
+            'p_user_id': user_id
+        }).execute()
+        return response.data[0] if response.data else None
+
+    def build_sections(self, batch_id, section_size=None, order='original'):
+        response = self.client.rpc('build_batch_sections', {
+            'p_batch_id': batch_id,
+            'p_section_size': section_size,
+            'p_order': order
+        }).execute()
+        return response.data
+
+    def get_section_comments(self, batch_id, section_number):
+        response = self.client.rpc('get_section_comments', {
+            'p_batch_id': batch_id,
+            'p_section_number': section_number
+        }).execute()
+        return response.data or []
+
+    def save_annotation(self, annotation):
+        self.client.table('annotations').insert(annotation).execute()
+
+    def save_annotations(self, annotations):
+        self.client.table('annotations') \
+                   .upsert(annotations, on_conflict='idempotency_key', ignore_duplicates=True) \
+                   .execute()
+
+    def save_skip_events(self, events):
+        self.client.table('skip_events') \
+                   .upsert(events, on_conflict='idempotency_key', ignore_duplicates=True) \
+                   .execute()
+
+    def update_progress(self, batch_id, user_id, progress_index, section_number=None):
+        if section_number is None:
+            # section_assignments keeps a row per section; the latest one is current
+            current = self.client.table('section_assignments') \
+                                 .select('assigned_section_number') \
+                                 .eq('batch_id', batch_id) \
+                                 .eq('user_id', user_id) \
+                                 .order('assigned_at', desc=True) \
+                                 .limit(1) \
+                                 .execute()
+            if not current.data:
+                return
+            section_number = current.data[0]['assigned_section_number']
+        self.client.table('section_assignments') \
+                   .update({'progress_index': progress_index}) \
+                   .eq('batch_id', batch_id) \
+                   .eq('user_id', user_id) \
+                   .eq('assigned_section_number', section_number) \
+                   .execute()
+
+    def import_section_results(self, batch_id, user_id, section_number, annotations, skips, progress_index):
+        response = self.client.rpc('import_section_pack', {
+            'p_batch_id': batch_id,
+            'p_user_id': user_id,
+            'p_section_number': section_number,
+            'p_annotations': annotations,
+            'p_skips': skips,
+            'p_progress_index': progress_index
+        }).execute()
+        return response.data[0]
+
+    def get_user_stats(self, user_id):
+        response = self.client.table('user_annotation_stats') \
+                              .select('total_annotations, label_counts, category_counts') \
+                              .eq('user_id', user_id) \
+                              .limit(1) \
+                              .execute()
+        row = response.data[0] if response.data else {}
+        return (
+            row.get('total_annotations') or 0,
+            row.get('label_counts') or {},
+            row.get('category_counts') or {},
+        )
+
+    def reserve_next_section(self, batch_id, user_id):
+        response = self.client.rpc('reserve_next_section', {
+            'p_batch_id': batch_id,
+            'p_user_id': user_id
+        }).execute()
+        return response.data
+
+    def claim_section_reservation(self, batch_id, user_id):
+        response = self.client.rpc('claim_section_reservation', {
+            'p_batch_id': batch_id,
+            'p_user_id': user_id
+        }).execute()
+        return response.data[0] if response.data else None
+
+    def release_section_reservation(self, batch_id, user_id):
+        self.client.rpc('release_section_reservation', {
+            'p_batch_id': batch_id,
+            'p_user_id': user_id
+        }).execute()
+
+    def claim_next_comment(self, batch_id, user_id):
+        response = self.client.rpc('claim_next_comment_in_batch', {
+            'p_user_id': user_id,
+            'p_batch_id': batch_id
+        }).execute()
+        return response.data[0] if response.data else None
+
+    def claim_comments(self, batch_id, user_id, count, lease_seconds=CLAIM_LOCK_SECONDS):
+        response = self.client.rpc('claim_comments_in_batch', {
+            'p_user_id': user_id,
+            'p_batch_id': batch_id,
+            'p_count': count,
+            'p_lease_seconds': lease_seconds
+        }).execute()
+        return response.data or []
+
+    def renew_leases(self, batch_id, user_id, lease_seconds=CLAIM_LOCK_SECONDS):
+        response = self.client.rpc('renew_comment_leases', {
+            'p_user_id': user_id,
+            'p_batch_id': batch_id,
+            'p_lease_seconds': lease_seconds
+        }).execute()
+        return response.data
+
+    def release_expired_locks(self, limit=SWEEP_CHUNK_SIZE):
+        return self.client.rpc('release_expired_locks', {'p_limit': limit}).execute().data
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT,
+    comment_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS comments (
+    id TEXT PRIMARY KEY,
+    comment_text TEXT NOT NULL,
+    original_index INTEGER NOT NULL,
+    batch_id TEXT,
+    status TEXT NOT NULL DEFAULT 'unassigned',
+    assigned_to TEXT,
+    claimed_at REAL,
+    lock_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS comments_claim_idx ON comments (batch_id, status, original_index)
+    WHERE status = 'unassigned';
+CREATE INDEX IF NOT EXISTS comments_expiry_idx ON comments (lock_expires_at) WHERE status = 'claimed';
+CREATE TABLE IF NOT EXISTS comment_batches (
+    batch_id TEXT NOT NULL,
+    comment_id TEXT NOT NULL,
+    section_number INTEGER,
+    section_position INTEGER,
+    PRIMARY KEY (batch_id, comment_id)
+);
+CREATE INDEX IF NOT EXISTS comment_batches_section_idx ON comment_batches (batch_id, section_number);
+CREATE TABLE IF NOT EXISTS batch_sections (
+    batch_id TEXT NOT NULL,
+    section_number INTEGER NOT NULL,
+    first_original_index INTEGER NOT NULL,
+    last_original_index INTEGER NOT NULL,
+    comment_count INTEGER NOT NULL,
+    first_position INTEGER,
+    last_position INTEGER,
+    PRIMARY KEY (batch_id, section_number)
+);
+CREATE TABLE IF NOT EXISTS comment_scores (
+    comment_id TEXT PRIMARY KEY,
+    model_version TEXT NOT NULL,
+    hate_probability REAL NOT NULL,
+    uncertainty REAL GENERATED ALWAYS AS (1 - ABS(2 * hate_probability - 1)) VIRTUAL
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    id TEXT PRIMARY KEY,
+    comment_id TEXT NOT NULL,
+    batch_id TEXT,
+    user_id TEXT NOT NULL,
+    label TEXT,
+    categories TEXT NOT NULL DEFAULT '[]',
+    notes TEXT,
+    duration_ms INTEGER,
+    idempotency_key TEXT UNIQUE,
+    created_at REAL NOT NULL,
+    offline_at REAL
+);
+CREATE INDEX IF NOT EXISTS annotations_user_idx ON annotations (user_id);
+CREATE INDEX IF NOT EXISTS annotations_batch_comment_idx ON annotations (batch_id, comment_id);
+CREATE TABLE IF NOT EXISTS skip_events (
+    id TEXT PRIMARY KEY,
+    comment_id TEXT NOT NULL,
+    batch_id TEXT,
+    user_id TEXT NOT NULL,
+    duration_ms INTEGER,
+    idempotency_key TEXT UNIQUE,
+    created_at REAL NOT NULL,
+    offline_at REAL
+);
+CREATE TABLE IF NOT EXISTS section_assignments (
+    batch_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    assigned_section_number INTEGER NOT NULL,
+    progress_index INTEGER NOT NULL DEFAULT 0,
+    assigned_at REAL NOT NULL,
+    PRIMARY KEY (batch_id, assigned_section_number)
+);
+CREATE INDEX IF NOT EXISTS section_assignments_user_idx ON section_assignments (batch_id, user_id);
+CREATE TABLE IF NOT EXISTS section_reservations (
+    batch_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    section_number INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (batch_id, user_id),
+    UNIQUE (batch_id, section_number)
+);
+"""
+
+
+class SQLiteRepository(AnnotationRepository):
+    """Local backend with the same semantics as the Supabase one.
+
+    Each thread gets its own connection to a WAL-mode database file, and every
+    read-modify-write runs under BEGIN IMMEDIATE, which plays the role of the
+    row locks (FOR UPDATE / SKIP LOCKED) used by the Postgres RPCs: two
+    concurrent annotators can never be handed the same section or comment.
+
+    Sections are kept one row per assigned section, so a section counts as
+    taken once anybody has been assigned it, and the user's current section is
+    their most recent assignment.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def load_batch(self, name, comment_texts, batch_id=None, description='', section_size=None):
+        """Create a batch from a list of texts and build its section map. Returns the batch id."""
+        batch_id = batch_id or str(uuid.uuid4())
+        rows = [(str(uuid.uuid4()), text, index, batch_id) for index, text in enumerate(comment_texts)]
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO batches (id, name, description, comment_count) VALUES (?, ?, ?, ?)",
+                (batch_id, name, description, len(rows)),
+            )
+            conn.executemany(
+                "INSERT INTO comments (id, comment_text, original_index, batch_id) VALUES (?, ?, ?, ?)", rows
+            )
+            conn.executemany(
+                "INSERT INTO comment_batches (batch_id, comment_id) VALUES (?, ?)",
+                [(batch_id, row[0]) for row in rows],
+            )
+        self.build_sections(batch_id, section_size)
+        return batch_id
+
+    def build_sections(self, batch_id, section_size=None, order='original'):
+        if order not in SECTION_ORDERS:
+            raise ValueError(f"Unknown section order: {order}")
+        with self._transaction() as conn:
+            ordered = conn.execute("""
+                SELECT cb.comment_id, c.original_index
+                FROM comment_batches cb
+                JOIN comments c ON c.id = cb.comment_id
+                LEFT JOIN comment_scores s ON s.comment_id = cb.comment_id
+                WHERE cb.batch_id = ?
+                ORDER BY CASE WHEN ? = 'uncertainty' THEN s.uncertainty END DESC NULLS LAST, c.original_index, c.id
+            """, (batch_id, order)).fetchall()
+            size = section_size or default_section_size(len(ordered))
+            conn.executemany(
+                "UPDATE comment_batches SET section_number = ?, section_position = ? WHERE batch_id = ? AND comment_id = ?",
+                [(position // size + 1, position, batch_id, comment_id)
+                 for position, (comment_id, _) in enumerate(ordered)],
+            )
+            conn.execute("DELETE FROM batch_sections WHERE batch_id = ?", (batch_id,))
+            conn.execute("""
+                INSERT INTO batch_sections (
+                    batch_id, section_number, first_original_index, last_original_index, comment_count,
+                    first_position, last_position
+                )
+                SELECT cb.batch_id, cb.section_number, MIN(c.original_index), MAX(c.original_index), COUNT(*),
+                       MIN(cb.section_position), MAX(cb.section_position)
+                FROM comment_batches cb
+                JOIN comments c ON c.id = cb.comment_id
+                WHERE cb.batch_id = ?
+                GROUP BY cb.batch_id, cb.section_number
+            """, (batch_id,))
+            return -(-len(ordered) // size)
+
+    def list_batches(self):
+        rows = self._connection().execute("""
+            SELECT b.id, b.name, b.description, b.comment_count,
+                   (SELECT COUNT(DISTINCT a.comment_id) FROM annotations a WHERE a.batch_id = b.id) AS annotated_count
+            FROM batches b
+            ORDER BY b.name
+        """).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_batch(self, batch_id):
+        row = self._connection().execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _current_assignment(self, conn, batch_id, user_id):
+        return conn.execute("""
+            SELECT assigned_section_number, progress_index
+            FROM section_assignments
+            WHERE batch_id = ? AND user_id = ?
+            ORDER BY assigned_at DESC
+            LIMIT 1
+        """, (batch_id, user_id)).fetchone()
+
+    def _section_size(self, conn, batch_id, section_number):
+        row = conn.execute(
+            "SELECT comment_count FROM batch_sections WHERE batch_id = ? AND section_number = ?",
+            (batch_id, section_number),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _free_section(self, conn, batch_id, now):
+        sections = [row[0] for row in conn.execute(
+            "SELECT section_number FROM batch_sections WHERE batch_id = ? ORDER BY section_number", (batch_id,)
+        )]
+        taken = {row[0] for row in conn.execute(
+            "SELECT assigned_section_number FROM section_assignments WHERE batch_id = ?", (batch_id,)
+        )}
+        taken |= {row[0] for row in conn.execute(
+            "SELECT section_number FROM section_reservations WHERE batch_id = ? AND expires_at >= ?", (batch_id, now)
+        )}
+        for section_number in sections:
+            if section_number not in taken:
+                return section_number
+        return None
+
+    def assign_section(self, batch_id, user_id):
+        now = time.time()
+        with self._transaction() as conn:
+            current = self._current_assignment(conn, batch_id, user_id)
+            if current and current['progress_index'] < self._section_size(conn, batch_id, current['assigned_section_number']):
+                return {
+                    'assigned_section_number': current['assigned_section_number'],
+                    'saved_progress_index': current['progress_index'],
+                }
+            section_number = self._free_section(conn, batch_id, now)
+            if section_number is None:
+                return None
+            conn.execute(
+                "INSERT INTO section_assignments (batch_id, user_id, assigned_section_number, progress_index, assigned_at) "
+                "VALUES (?, ?, ?, 0, ?)",
+                (batch_id, user_id, section_number, now),
+            )
+            return {'assigned_section_number': section_number, 'saved_progress_index': 0}
+
+    def get_section_comments(self, batch_id, section_number):
+        rows = self._connection().execute("""
+            SELECT c.id, c.comment_text, c.original_index, s.hate_probability
+            FROM comment_batches cb
+            JOIN comments c ON c.id = cb.comment_id
+            LEFT JOIN comment_scores s ON s.comment_id = cb.comment_id
+            WHERE cb.batch_id = ? AND cb.section_number = ?
+            ORDER BY cb.section_position, c.original_index
+        """, (batch_id, section_number)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _annotation_row(self, annotation, now):
+        return (
+            str(uuid.uuid4()), annotation['comment_id'], annotation.get('batch_id'), annotation['user_id'],
+            annotation.get('label'), json.dumps(list(annotation.get('categories') or [])),
+            annotation.get('notes'), annotation.get('duration_ms'), annotation.get('idempotency_key'), now,
+        )
+
+    def save_annotation(self, annotation):
+        self.save_annotations([annotation])
+
+    def save_annotations(self, annotations):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT INTO annotations (
+                    id, comment_id, batch_id, user_id, label, categories, notes, duration_ms, idempotency_key, created_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (idempotency_key) DO NOTHING
+            """, [self._annotation_row(annotation, now) for annotation in annotations])
+
+    def save_skip_events(self, events):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT INTO skip_events (id, comment_id, batch_id, user_id, duration_ms, idempotency_key, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (idempotency_key) DO NOTHING
+            """, [
+                (str(uuid.uuid4()), event['comment_id'], event.get('batch_id'), event['user_id'],
+                 event.get('duration_ms'), event.get('idempotency_key'), now)
+                for event in events
+            ])
+
+    def update_progress(self, batch_id, user_id, progress_index, section_number=None):
+        with self._transaction() as conn:
+            if section_number is not None:
+                conn.execute("""
+                    UPDATE section_assignments
+                    SET progress_index = ?
+                    WHERE batch_id = ? AND user_id = ? AND assigned_section_number = ?
+                """, (progress_index, batch_id, user_id, section_number))
+                return
+            conn.execute("""
+                UPDATE section_assignments
+                SET progress_index = ?
+                WHERE rowid = (
+                    SELECT rowid FROM section_assignments
+                    WHERE batch_id = ? AND user_id = ?
+                    ORDER BY assigned_at DESC
+                    LIMIT 1
+                )
+            """, (progress_index, batch_id, user_id))
+
+    def import_section_results(self, batch_id, user_id, section_number, annotations, skips, progress_index):
+        now = time.time()
+        with self._transaction() as conn:
+            in_section = {row[0] for row in conn.execute(
+                "SELECT comment_id FROM comment_batches WHERE batch_id = ? AND section_number = ?",
+                (batch_id, section_number),
+            )}
+            labelled = {row[0] for row in conn.execute(
+                "SELECT comment_id FROM annotations WHERE batch_id = ? AND user_id = ?", (batch_id, user_id)
+            )}
+            imported_annotations = imported_skips = 0
+            for annotation in annotations:
+                if annotation['comment_id'] not in in_section or annotation['comment_id'] in labelled:
+                    continue
+                row = self._annotation_row({**annotation, 'batch_id': batch_id, 'user_id': user_id}, now)
+                imported_annotations += conn.execute("""
+                    INSERT INTO annotations (
+                        id, comment_id, batch_id, user_id, label, categories, notes, duration_ms, idempotency_key,
+                        created_at, offline_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (idempotency_key) DO NOTHING
+                """, (*row, _timestamp(annotation.get('offline_at')))).rowcount
+                labelled.add(annotation['comment_id'])
+            for skip in skips:
+                if skip['comment_id'] not in in_section:
+                    continue
+                imported_skips += conn.execute("""
+                    INSERT INTO skip_events (
+                        id, comment_id, batch_id, user_id, duration_ms, idempotency_key, created_at, offline_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (idempotency_key) DO NOTHING
+                """, (str(uuid.uuid4()), skip['comment_id'], batch_id, user_id, skip.get('duration_ms'),
+                      skip.get('idempotency_key'), now, _timestamp(skip.get('offline_at')))).rowcount
+            assignment = conn.execute(
+                "SELECT progress_index FROM section_assignments "
+                "WHERE batch_id = ? AND user_id = ? AND assigned_section_number = ?",
+                (batch_id, user_id, section_number),
+            ).fetchone()
+            new_progress = None
+            if assignment:
+                new_progress = max(assignment['progress_index'], progress_index)
+                conn.execute(
+                    "UPDATE section_assignments SET progress_index = ? WHERE batch_id = ? AND assigned_section_number = ?",
+                    (new_progress, batch_id, section_number),
+                )
+        return {
+            'imported_annotations': imported_annotations,
+            'imported_skips': imported_skips,
+            'progress_index': new_progress,
+        }
+
+    def get_user_stats(self, user_id):
+        conn = self._connection()
+        labels = {row[0] or 'unknown': row[1] for row in conn.execute(
+            "SELECT label, COUNT(*) FROM annotations WHERE user_id = ? GROUP BY label", (user_id,)
+        )}
+        categories = {row[0]: row[1] for row in conn.execute("""
+            SELECT category.value, COUNT(*)
+            FROM annotations a, json_each(a.categories) AS category
+            WHERE a.user_id = ?
+            GROUP BY category.value
+        """, (user_id,))}
+        return sum(labels.values()), labels, categories
+
+    def reserve_next_section(self, batch_id, user_id):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM section_reservations WHERE batch_id = ? AND expires_at < ?", (batch_id, now))
+            existing = conn.execute(
+                "SELECT section_number FROM section_reservations WHERE batch_id = ? AND user_id = ?", (batch_id, user_id)
+            ).fetchone()
+            if existing:
+                conn.execute(
+                    "UPDATE section_reservations SET expires_at = ? WHERE batch_id = ? AND user_id = ?",
+                    (now + RESERVATION_TTL_SECONDS, batch_id, user_id),
+                )
+                return existing[0]
+            section_number = self._free_section(conn, batch_id, now)
+            if section_number is None:
+                return None
+            conn.execute(
+                "INSERT INTO section_reservations (batch_id, user_id, section_number, expires_at) VALUES (?, ?, ?, ?)",
+                (batch_id, user_id, section_number, now + RESERVATION_TTL_SECONDS),
+            )
+            return section_number
+
+    def claim_section_reservation(self, batch_id, user_id):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT section_number FROM section_reservations WHERE batch_id = ? AND user_id = ? AND expires_at >= ?",
+                (batch_id, user_id, now),
+            ).fetchone()
+            conn.execute("DELETE FROM section_reservations WHERE batch_id = ? AND user_id = ?", (batch_id, user_id))
+            if row is None:
+                return None
+            conn.execute(
+                "INSERT INTO section_assignments (batch_id, user_id, assigned_section_number, progress_index, assigned_at) "
+                "VALUES (?, ?, ?, 0, ?)",
+                (batch_id, user_id, row[0], now),
+            )
+            return {'assigned_section_number': row[0], 'saved_progress_index': 0}
+
+    def release_section_reservation(self, batch_id, user_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM section_reservations WHERE batch_id = ? AND user_id = ?", (batch_id, user_id))
+
+    def claim_next_comment(self, batch_id, user_id):
+        claimed = self.claim_comments(batch_id, user_id, 1)
+        return claimed[0] if claimed else None
+
+    def claim_comments(self, batch_id, user_id, count, lease_seconds=CLAIM_LOCK_SECONDS):
+        now = time.time()
+        with self._transaction() as conn:
+            ids = [row[0] for row in conn.execute("""
+                SELECT id FROM comments
+                WHERE batch_id = ? AND status = 'unassigned'
+                ORDER BY original_index
+                LIMIT ?
+            """, (batch_id, count))]
+            conn.executemany("""
+                UPDATE comments
+                SET status = 'claimed', assigned_to = ?, claimed_at = ?, lock_expires_at = ?
+                WHERE id = ?
+            """, [(user_id, now, now + lease_seconds, comment_id) for comment_id in ids])
+            rows = conn.execute(
+                f"SELECT * FROM comments WHERE id IN ({', '.join('?' * len(ids))}) ORDER BY original_index", ids
+            ).fetchall() if ids else []
+            return [dict(row) for row in rows]
+
+    def renew_leases(self, batch_id, user_id, lease_seconds=CLAIM_LOCK_SECONDS):
+        now = time.time()
+        with self._transaction() as conn:
+            return conn.execute("""
+                UPDATE comments
+                SET lock_expires_at = ?
+                WHERE batch_id = ? AND status = 'claimed' AND assigned_to = ? AND lock_expires_at >= ?
+            """, (now + lease_seconds, batch_id, user_id, now)).rowcount
+
+    def release_expired_locks(self, limit=SWEEP_CHUNK_SIZE):
+        with self._transaction() as conn:
+            return conn.execute("""
+                UPDATE comments
+                SET status = 'unassigned', assigned_to = NULL, claimed_at = NULL, lock_expires_at = NULL
+                WHERE id IN (
+                    SELECT id FROM comments
+                    WHERE status = 'claimed' AND lock_expires_at < ?
+                    ORDER BY lock_expires_at
+                    LIMIT ?
+                )
+            """, (time.time(), limit)).rowcount
@@ -0,0 +1,336 @@
+"""Retries, request coalescing and a circuit breaker around a repository.
+
+One ResilientRepository is shared by every session of the server process:
+
+* transient failures (dropped connections, timeouts, 5xx responses, lock and
+  serialization errors) of reads and idempotent writes are retried with
+  exponential backoff and full jitter, so a blip does not fail a save and a
+  reconnect storm does not retry in lockstep;
+* identical concurrent reads collapse into one in-flight request
+  (single-flight): when every page reloads after a blip, the batch dashboard
+  is fetched once instead of once per session;
+* a circuit breaker opens after repeated transient failures. While it is open
+  calls fail fast with CircuitOpenError, and reads are answered from the last
+  successful result for the same arguments when there is one. After
+  RESET_TIMEOUT_SECONDS a single trial call decides whether it closes again.
+
+Errors that are not transient (bad input, constraint violations) are raised
+at once and do not count against the backend. stats() exposes the counters
+for the developer panel. Any AnnotationRepository can sit underneath, so the
+layer runs against SQLiteRepository in loadtest.py --fault-rate.
+
+Backend calls the app makes outside the repository (auth, exports, agreement,
+near-duplicate review, analytics) go through call() and share the breaker and
+counters; DIRECT_RETRYABLE_OPERATIONS and DIRECT_READ_OPERATIONS say which of
+them are retried, coalesced and served stale.
+"""
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import httpx
+
+from repository import AnnotationRepository
+
+# Results may be served to several sessions at once, so callers treat them as read-only
+READ_OPERATIONS = {'list_batches', 'get_batch', 'get_section_comments', 'get_user_stats'}
+# Last good results kept for serving while the breaker is open. Section comments
+# are left out: section_cache.py already keeps them in memory.
+STALE_OPERATIONS = READ_OPERATIONS - {'get_section_comments'}
+# Writes that are safe to repeat: keyed upserts, absolute or forward-only progress updates and
+# RPCs that return the caller's existing row when it already exists
+IDEMPOTENT_WRITES = {
+    'save_annotation', 'save_annotations', 'save_skip_events', 'update_progress',
+    'assign_section', 'release_section_reservation', 'renew_leases', 'import_section_results',
+}
+# Calls outside the repository (see call()) that are safe to repeat: reads, an export that rewrites
+# its file, a matrix refresh that resumes from its cursor and absolute metadata / label writes
+DIRECT_RETRYABLE_OPERATIONS = {
+    'auth_get_user', 'auth_update_user', 'export_annotations', 'refresh_agreement',
+    'list_cluster_members', 'override_cluster_label', 'get_throughput', 'get_batch_projections',
+}
+# ...and the reads among them whose arguments repeat, so they are coalesced and served stale like
+# repository reads. get_throughput is keyed by a moving start time and is only retried.
+DIRECT_READ_OPERATIONS = {'auth_get_user', 'list_cluster_members', 'get_batch_projections'}
+MAX_ATTEMPTS = 3
+BASE_DELAY_SECONDS = 0.2
+MAX_DELAY_SECONDS = 2.0
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT_SECONDS = 30
+STALE_CACHE_ENTRIES = 256
+
+# PostgREST connection errors and Postgres SQLSTATEs worth retrying
+_TRANSIENT_CODES = {
+    'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003',
+    '40001',  # serialization_failure
+    '40P01',  # deadlock_detected
+    '55P03',  # lock_not_available
+    '57014',  # query_canceled (statement timeout)
+    '53300',  # too_many_connections
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the backend while the circuit breaker is open."""
+
+
+def is_transient(error):
+    """Whether a failed call may succeed if repeated."""
+    if isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, sqlite3.OperationalError):
+        # "database is locked" / "database is busy"
+        return 'locked' in str(error) or 'busy' in str(error)
+    code = str(getattr(error, 'code', '') or '')
+    return code in _TRANSIENT_CODES or code.startswith('08') or (code.startswith('5') and len(code) == 3)
+
+
+def backoff_delay(attempt, base_delay=BASE_DELAY_SECONDS, max_delay=MAX_DELAY_SECONDS, rng=random):
+    """Full-jitter delay before retry number `attempt` (1-based)."""
+    return rng.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one execution of a function."""
+
+    class _Call:
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Return (result, shared). shared is True when another caller's request was reused."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open trial call."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT_SECONDS,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def retry_in(self):
+        """Seconds until an open breaker lets a trial call through."""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - self._clock())
+
+    def allow(self):
+        """Whether a call may go to the backend now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and self._clock() >= self._opened_at + self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        """Count a transient failure. Returns True if this failure opened the breaker."""
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                opened = self._state != self.OPEN
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self._trial_in_flight = False
+                if opened:
+                    self.times_opened += 1
+                return opened
+            return False
+
+
+@AnnotationRepository.register
+class ResilientRepository:
+    """Repository proxy adding retries, single-flight reads and a circuit breaker."""
+
+    def __init__(self, repository, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY_SECONDS,
+                 max_delay=MAX_DELAY_SECONDS, breaker=None, stale_entries=STALE_CACHE_ENTRIES,
+                 sleep=time.sleep, rng=None):
+        self.repository = repository
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._sleep = sleep
+        self._rng = rng or random.Random()
+        self._flights = SingleFlight()
+        self._stale = OrderedDict()
+        self._stale_entries = stale_entries
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        for name, member in vars(AnnotationRepository).items():
+            if callable(member) and not name.startswith('_') and name != 'save_annotation':
+                setattr(self, name, self._wrap(name, getattr(repository, name)))
+
+    def save_annotation(self, annotation):
+        # A keyed upsert can be replayed safely; a plain insert cannot
+        if not annotation.get('idempotency_key'):
+            annotation = {**annotation, 'idempotency_key': str(uuid.uuid4())}
+        self.save_annotations([annotation])
+
+    def _count(self, name, operation=None):
+        with self._lock:
+            self._counters[name] += 1
+            if operation:
+                self._counters[f"{name}:{operation}"] += 1
+
+    def _call_with_retries(self, operation, method, args, kwargs, retryable):
+        attempt = 1
+        while True:
+            if not self.breaker.allow():
+                self._count('short_circuited', operation)
+                raise CircuitOpenError(
+                    f"Backend unavailable, {operation} not attempted; retrying in {self.breaker.retry_in():.0f}s"
+                )
+            self._count('attempts', operation)
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    # The backend answered; the request itself was bad
+                    self.breaker.record_success()
+                    raise
+                self._count('transient_failures', operation)
+                self.breaker.record_failure()
+                if not retryable or attempt >= self.max_attempts:
+                    self._count('gave_up', operation)
+                    raise
+                self._count('retries', operation)
+                self._sleep(backoff_delay(attempt, self.base_delay, self.max_delay, self._rng))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _read(self, operation, method, args, kwargs, keep_stale):
+        self._count('calls', operation)
+        key = (operation, args, tuple(sorted(kwargs.items())))
+        try:
+            result, shared = self._flights.do(
+                key, lambda: self._call_with_retries(operation, method, args, kwargs, True)
+            )
+        except Exception as e:
+            if not isinstance(e, CircuitOpenError) and not is_transient(e):
+                raise
+            with self._lock:
+                if key not in self._stale:
+                    raise
+                self._stale.move_to_end(key)
+                self._counters['stale_served'] += 1
+                return self._stale[key]
+        if shared:
+            self._count('coalesced', operation)
+        elif keep_stale:
+            with self._lock:
+                self._stale[key] = result
+                self._stale.move_to_end(key)
+                while len(self._stale) > self._stale_entries:
+                    self._stale.popitem(last=False)
+        return result
+
+    def _wrap(self, operation, method):
+        if operation not in READ_OPERATIONS:
+            retryable = operation in IDEMPOTENT_WRITES
+
+            def call(*args, **kwargs):
+                self._count('calls', operation)
+                return self._call_with_retries(operation, method, args, kwargs, retryable)
+
+            return call
+
+        def read(*args, **kwargs):
+            return self._read(operation, method, args, kwargs, operation in STALE_OPERATIONS)
+
+        return read
+
+    def call(self, operation, func, *args, **kwargs):
+        """Run a backend call made outside the repository under the same breaker, counted as `operation`.
+
+        Operations in DIRECT_READ_OPERATIONS are retried, coalesced and answered
+        from their last result while the backend is unavailable; other
+        DIRECT_RETRYABLE_OPERATIONS are retried; anything else is tried once.
+        """
+        if operation in DIRECT_READ_OPERATIONS:
+            return self._read(operation, func, args, kwargs, True)
+        self._count('calls', operation)
+        return self._call_with_retries(operation, func, args, kwargs, operation in DIRECT_RETRYABLE_OPERATIONS)
+
+    def stats(self):
+        """Counters since start-up plus the breaker state, for the developer panel."""
+        with self._lock:
+            counters = dict(self._counters)
+            stale_entries = len(self._stale)
+        totals = {name: value for name, value in counters.items() if ':' not in name}
+        per_operation = {}
+        for name, value in counters.items():
+            if ':' in name:
+                counter, operation = name.split(':', 1)
+                per_operation.setdefault(operation, {})[counter] = value
+        return {
+            'breaker_state': self.breaker.state,
+            'breaker_opened': self.breaker.times_opened,
+            'stale_entries': stale_entries,
+            **{name: totals.get(name, 0) for name in (
+                'calls', 'attempts', 'retries', 'transient_failures', 'gave_up',
+                'coalesced', 'short_circuited', 'stale_served',
+            )},
+            'per_operation': per_operation,
+        }
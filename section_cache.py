@@ -0,0 +1,180 @@
+"""Process-wide cache of section comments shared by all sessions.
+
+Sections are loaded once per process into a compact Section (parallel tuples
+of id / text / original_index) keyed by (batch_id, section_number). Each
+session only holds a SectionHandle plus its current_comment_index, so
+annotators on the same section share one copy of the comment texts.
+
+Sections in use by at least one live handle are pinned. Unpinned sections stay
+cached in LRU order until the total size goes over the memory cap. Handles
+unpin themselves when they are garbage collected, so sessions that simply
+disappear do not pin sections forever. Collection can happen on any thread,
+including one that holds the cache lock, so a collected handle only queues its
+key and the next cache operation applies the unpin under the lock.
+"""
+import math
+import sys
+import threading
+import weakref
+from array import array
+from collections import OrderedDict, deque
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+NAN = float('nan')
+
+
+class Section:
+    """Immutable, compact column store for the comments of one section."""
+
+    __slots__ = ('ids', 'texts', 'original_indexes', 'hate_probabilities', 'nbytes')
+
+    def __init__(self, comments):
+        self.ids = tuple(str(comment['id']) for comment in comments)
+        self.texts = tuple(comment['comment_text'] for comment in comments)
+        self.original_indexes = array('q', (comment.get('original_index') or 0 for comment in comments))
+        # Suggestion model scores (active_learning.py); NaN where a comment is unscored
+        self.hate_probabilities = array('f', (
+            NAN if comment.get('hate_probability') is None else comment['hate_probability'] for comment in comments
+        ))
+        self.nbytes = (
+            sys.getsizeof(self.ids) + sys.getsizeof(self.texts) + sys.getsizeof(self.original_indexes)
+            + sys.getsizeof(self.hate_probabilities)
+            + sum(sys.getsizeof(value) for value in self.ids)
+            + sum(sys.getsizeof(value) for value in self.texts)
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        probability = self.hate_probabilities[index]
+        return {
+            'id': self.ids[index],
+            'comment_text': self.texts[index],
+            'original_index': self.original_indexes[index],
+            'hate_probability': None if math.isnan(probability) else probability,
+        }
+
+
+class SectionHandle:
+    """A session's reference to a cached section; behaves like a read-only list of comment dicts."""
+
+    __slots__ = ('key', '_section', '__weakref__')
+
+    def __init__(self, cache, key, section):
+        self.key = key
+        self._section = section
+        # deque.append never blocks, so this is safe wherever the collector runs
+        weakref.finalize(self, cache._released.append, key)
+
+    def __len__(self):
+        return len(self._section)
+
+    def __bool__(self):
+        return len(self._section) > 0
+
+    def __getitem__(self, index):
+        return self._section[index]
+
+
+class SectionCache:
+    """LRU cache of Sections with pinning and a soft memory cap."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sections = OrderedDict()
+        self._pins = {}
+        self._loading = {}
+        # Keys of collected handles, unpinned by the next operation that takes the lock
+        self._released = deque()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, key, loader):
+        """Return a handle for `key`, calling loader() to fetch the comments on a miss.
+
+        Concurrent misses for the same key share a single load. Returns None if
+        the section has no comments (empty sections are not cached).
+        """
+        while True:
+            with self._lock:
+                self._unpin_released()
+                section = self._sections.get(key)
+                if section is not None:
+                    self.hits += 1
+                    return self._pin(key, section)
+                pending = self._loading.get(key)
+                if pending is None:
+                    pending = self._loading[key] = threading.Event()
+                    break
+            pending.wait()
+
+        try:
+            comments = loader()
+        except BaseException:
+            with self._lock:
+                self._loading.pop(key).set()
+            raise
+        return self.put(key, comments, count_miss=True)
+
+    def put(self, key, comments, count_miss=False):
+        """Cache already-fetched comments (e.g. from a prefetch) and return a handle, or None if empty."""
+        section = Section(comments) if comments else None
+        with self._lock:
+            self._unpin_released()
+            if count_miss:
+                self.misses += 1
+            pending = self._loading.pop(key, None)
+            if pending is not None:
+                pending.set()
+            if section is None:
+                return None
+            existing = self._sections.get(key)
+            if existing is not None:
+                section = existing
+            else:
+                self._sections[key] = section
+                self.nbytes += section.nbytes
+            handle = self._pin(key, section)
+            self._evict()
+            return handle
+
+    def _pin(self, key, section):
+        # Caller holds the lock.
+        self._sections.move_to_end(key)
+        self._pins[key] = self._pins.get(key, 0) + 1
+        return SectionHandle(self, key, section)
+
+    def _unpin_released(self):
+        # Caller holds the lock.
+        while self._released:
+            key = self._released.popleft()
+            remaining = self._pins.get(key, 0) - 1
+            if remaining > 0:
+                self._pins[key] = remaining
+            else:
+                self._pins.pop(key, None)
+        self._evict()
+
+    def _evict(self):
+        # Caller holds the lock. Oldest unpinned sections go first.
+        if self.nbytes <= self.max_bytes:
+            return
+        for key in list(self._sections):
+            if self.nbytes <= self.max_bytes:
+                break
+            if key not in self._pins:
+                self.nbytes -= self._sections.pop(key).nbytes
+
+    def stats(self):
+        with self._lock:
+            self._unpin_released()
+            return {
+                'sections': len(self._sections),
+                'pinned': len(self._pins),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
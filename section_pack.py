@@ -0,0 +1,253 @@
+"""Offline section packs for annotators on slow connections.
+
+A pack is one assigned section as a gzip-compressed JSON file: the schema
+version, batch and section, the annotator, the comment ids and texts (with the
+suggestion model's probability when there is one) and the position to resume
+from. It is downloaded once, annotated with no network at all, and uploaded
+once; the upload goes through import_section_pack, which inserts the
+annotations and skips and advances progress_index in a single transaction and
+ignores anything already saved, so uploading the same pack twice is harmless.
+
+Annotators download and upload packs from the section screen of the app. This
+CLI does the same with the service role key, and its annotate command is the
+offline annotation mode:
+
+    python section_pack.py export --batch <batch id> --user annotator@example.com -o section.an2pack
+    python section_pack.py annotate section.an2pack
+    python section_pack.py upload section.an2pack
+"""
+import argparse
+import gzip
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from supabase import create_client
+
+from repository import CATEGORIES, LABELS, SupabaseRepository
+
+PACK_KIND = 'an2ot8-section-pack'
+PACK_SCHEMA_VERSION = 1
+PACK_SUFFIX = '.an2pack'
+# Longer than this on one comment means the annotator stepped away; the time is not recorded.
+# The app's time_on_comment_ms uses the same limit, so online and offline durations compare.
+MAX_TIMED_SECONDS = 600
+
+
+class PackError(ValueError):
+    """The file is not a section pack this version can read."""
+
+
+def build_pack(batch, section_number, user_id, comments, progress_index, labels=LABELS, categories=CATEGORIES):
+    """A new pack for `comments` (the whole section, in order), resuming at progress_index."""
+    return {
+        'kind': PACK_KIND,
+        'schema_version': PACK_SCHEMA_VERSION,
+        'exported_at': datetime.now(timezone.utc).isoformat(),
+        'batch_id': str(batch['id']),
+        'batch_name': batch.get('name', ''),
+        'section_number': section_number,
+        'user_id': user_id,
+        'labels': list(labels),
+        'categories': list(categories),
+        'comments': [
+            {'id': str(comment['id']), 'comment_text': comment['comment_text'],
+             'hate_probability': comment.get('hate_probability')}
+            for comment in comments
+        ],
+        'start_index': progress_index,
+        'position': progress_index,
+        'results': [],
+    }
+
+
+def dumps_pack(pack):
+    # mtime=0 keeps the bytes identical for identical packs
+    return gzip.compress(json.dumps(pack, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), mtime=0)
+
+
+def loads_pack(data):
+    """Parse and validate pack bytes. Raises PackError if they are not a readable pack."""
+    try:
+        pack = json.loads(gzip.decompress(data).decode('utf-8'))
+    except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise PackError(f"Not a section pack: {e}") from None
+    if not isinstance(pack, dict) or pack.get('kind') != PACK_KIND:
+        raise PackError("Not a section pack")
+    version = pack.get('schema_version')
+    if not isinstance(version, int) or version > PACK_SCHEMA_VERSION:
+        raise PackError(f"Pack schema version {version} is newer than this app supports ({PACK_SCHEMA_VERSION})")
+    missing = {'batch_id', 'section_number', 'user_id', 'comments', 'start_index', 'position', 'results'} - pack.keys()
+    if missing:
+        raise PackError(f"Pack is missing {', '.join(sorted(missing))}")
+    return pack
+
+
+def read_pack(path):
+    with open(path, 'rb') as f:
+        return loads_pack(f.read())
+
+
+def write_pack(path, pack):
+    """Write atomically, so an interrupted save never leaves a half-written pack."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(dumps_pack(pack))
+    os.replace(tmp_path, path)
+
+
+def current_comment(pack):
+    """The comment at the pack's position, or None when the section is done."""
+    position = pack['position']
+    return pack['comments'][position] if position < len(pack['comments']) else None
+
+
+def _record(pack, result):
+    comment = current_comment(pack)
+    if comment is None:
+        raise PackError("The section in this pack is already finished")
+    pack['results'].append({
+        'comment_id': comment['id'],
+        'idempotency_key': str(uuid.uuid4()),
+        'at': datetime.now(timezone.utc).isoformat(),
+        **result,
+    })
+    pack['position'] += 1
+
+
+def record_annotation(pack, label, categories, notes='', duration_ms=None):
+    """Label the current comment and move to the next one."""
+    _record(pack, {'action': 'annotate', 'label': label, 'categories': list(categories),
+                   'notes': notes, 'duration_ms': duration_ms})
+
+
+def record_skip(pack, duration_ms=None):
+    """Skip the current comment and move to the next one."""
+    _record(pack, {'action': 'skip', 'duration_ms': duration_ms})
+
+
+def pack_results(pack):
+    """(annotations, skips, progress_index) in the shape import_section_results expects."""
+    annotations, skips = [], []
+    for result in pack['results']:
+        if result['action'] == 'annotate':
+            annotations.append({
+                'comment_id': result['comment_id'], 'label': result['label'],
+                'categories': result['categories'], 'notes': result['notes'],
+                'duration_ms': result['duration_ms'], 'idempotency_key': result['idempotency_key'],
+                'offline_at': result['at'],
+            })
+        else:
+            skips.append({
+                'comment_id': result['comment_id'], 'duration_ms': result['duration_ms'],
+                'idempotency_key': result['idempotency_key'], 'offline_at': result['at'],
+            })
+    return annotations, skips, pack['position']
+
+
+def export_section(repository, batch_id, user_id):
+    """Assign (or resume) the user's section of the batch and pack it. Returns None if the batch is finished."""
+    assignment = repository.assign_section(batch_id, user_id)
+    if not assignment:
+        return None
+    section_number = assignment['assigned_section_number']
+    comments = repository.get_section_comments(batch_id, section_number)
+    return build_pack(repository.get_batch(batch_id), section_number, user_id, comments,
+                      assignment['saved_progress_index'])
+
+
+def upload_pack(repository, pack, user_id=None):
+    """Import the pack's results. user_id, when given, must match the pack's annotator."""
+    if user_id is not None and pack['user_id'] != user_id:
+        raise PackError(f"This pack belongs to {pack['user_id']}")
+    annotations, skips, progress_index = pack_results(pack)
+    return repository.import_section_results(
+        pack['batch_id'], pack['user_id'], pack['section_number'], annotations, skips, progress_index
+    )
+
+
+def annotate_offline(path, prompt=input, show=print):
+    """Terminal annotation loop over a pack file; the pack is saved after every comment."""
+    pack = read_pack(path)
+    labels, categories = pack.get('labels') or LABELS, pack.get('categories') or CATEGORIES
+    keys = {label[0]: label for label in labels}
+    total = len(pack['comments'])
+    while True:
+        comment = current_comment(pack)
+        if comment is None:
+            show(f"Section {pack['section_number']} is finished. Upload {path} when you are back online.")
+            return
+        shown_at = time.monotonic()
+        show(f"\n{pack.get('batch_name', '')} | Section {pack['section_number']} | "
+             f"Comment {pack['position'] + 1} of {total}")
+        show(comment['comment_text'])
+        if comment.get('hate_probability') is not None:
+            probability = comment['hate_probability']
+            show(f"Suggested: {'hate' if probability >= 0.5 else 'non-hate'} "
+                 f"({max(probability, 1 - probability):.0%} confident)")
+        choice = prompt(' '.join(f"[{key}] {label}" for key, label in keys.items()) + " [k] skip [q] quit > ")
+        choice = choice.strip().lower()[:1]
+        if choice == 'q':
+            show(f"Saved. {pack['position'] - pack['start_index']} comment(s) done in this pack.")
+            return
+        elapsed = time.monotonic() - shown_at
+        duration_ms = int(elapsed * 1000) if elapsed <= MAX_TIMED_SECONDS else None
+        if choice == 'k':
+            record_skip(pack, duration_ms)
+        elif choice in keys:
+            show('  '.join(f"{i} {category}" for i, category in enumerate(categories, 1)))
+            picked = prompt("Categories (numbers, comma-separated, Enter for none) > ")
+            chosen = [categories[int(n) - 1] for n in picked.replace(' ', '').split(',')
+                      if n.isdigit() and 1 <= int(n) <= len(categories)]
+            notes = prompt("Notes (Enter for none) > ").strip()
+            record_annotation(pack, keys[choice], chosen, notes, duration_ms)
+        else:
+            show("Unknown choice.")
+            continue
+        write_pack(path, pack)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export, annotate offline and upload section packs.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help="Pack the user's current (or next) section of a batch")
+    export.add_argument('--batch', required=True, help="Batch id")
+    export.add_argument('--user', required=True, help="Annotator's user id (email)")
+    export.add_argument('-o', '--output', help=f"Pack file (default: batch-section{PACK_SUFFIX})")
+    annotate = commands.add_parser('annotate', help="Annotate a pack in the terminal, without a connection")
+    annotate.add_argument('pack')
+    upload = commands.add_parser('upload', help="Import a pack's annotations and progress")
+    upload.add_argument('pack')
+    args = parser.parse_args(argv)
+
+    if args.command == 'annotate':
+        annotate_offline(args.pack)
+        return
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set.")
+    repository = SupabaseRepository(create_client(url, key))
+
+    if args.command == 'export':
+        pack = export_section(repository, args.batch, args.user)
+        if pack is None:
+            print(f"Batch {args.batch} has no sections left for {args.user}")
+            return
+        path = args.output or f"{args.batch}-section{pack['section_number']}{PACK_SUFFIX}"
+        write_pack(path, pack)
+        print(f"Wrote section {pack['section_number']} ({len(pack['comments']) - pack['position']} comment(s) "
+              f"to do) to {path}")
+    else:
+        result = upload_pack(repository, read_pack(args.pack))
+        print(f"Imported {result['imported_annotations']} annotation(s) and {result['imported_skips']} skip(s); "
+              f"progress index {result['progress_index']}")
+
+
+if __name__ == "__main__":
+    main()
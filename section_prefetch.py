@@ -0,0 +1,75 @@
+"""Background prefetch of an annotator's next section.
+
+When the annotator gets close to the end of their section, a SectionPrefetcher
+reserves the next section (reserve_next_section RPC) and downloads its
+comments on a daemon thread. Clicking "Get Next Section" then only has to turn
+the reservation into the real assignment, and the comments are already in memory.
+
+The worker thread never touches Streamlit: reserve/fetch/release are plain
+callables that raise on failure.
+"""
+import threading
+
+
+class SectionPrefetcher:
+    """Reserves and downloads one section ahead for a single (batch, user)."""
+
+    def __init__(self, batch_id, user_id, reserve, fetch, release):
+        self.batch_id = batch_id
+        self.user_id = user_id
+        self._reserve = reserve
+        self._fetch = fetch
+        self._release = release
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self.section_number = None
+        self.comments = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name="section-prefetch", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            section_number = self._reserve(self.batch_id, self.user_id)
+            if section_number is None:
+                return
+            with self._lock:
+                self.section_number = section_number
+            if self._cancelled.is_set():
+                return
+            comments = self._fetch(self.batch_id, section_number)
+            with self._lock:
+                self.comments = comments
+        except Exception as e:
+            self.error = e
+        finally:
+            if self._cancelled.is_set():
+                self._release_reservation()
+
+    def _release_reservation(self):
+        with self._lock:
+            section_number, self.section_number = self.section_number, None
+        if section_number is None:
+            return
+        try:
+            self._release(self.batch_id, self.user_id)
+        except Exception as e:
+            # The reservation expires server-side anyway.
+            self.error = e
+
+    def result(self, timeout=None):
+        """Wait up to `timeout` seconds and return (section_number, comments), or None if nothing usable."""
+        self._thread.join(timeout)
+        if self._thread.is_alive() or self._cancelled.is_set():
+            return None
+        with self._lock:
+            if self.section_number is None or not self.comments:
+                return None
+            return self.section_number, self.comments
+
+    def cancel(self):
+        """Stop the prefetch and give back any reservation it holds."""
+        self._cancelled.set()
+        # Always release from here too: the worker may already be past its own cancelled
+        # check while still alive. Only one of the two finds the reservation to give back.
+        threading.Thread(target=self._release_reservation, daemon=True).start()
@@ -1,23 +1,43 @@
 import streamlit as st
+import streamlit.components.v1 as components
+from streamlit.errors import StreamlitAPIException
 import pandas as pd
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 import os
+import tempfile
+import threading
+import time
 from datetime import datetime
 import json
 from dotenv import load_dotenv  
+from export_annotations import export_annotations
+from write_behind import AnnotationJournal, WriteBehindWorker, DEFAULT_JOURNAL_PATH
+from section_prefetch import SectionPrefetcher
+from section_cache import SectionCache
+from repository import CATEGORIES, LABELS, AnnotationRepository, SupabaseRepository
+from instrumentation import RerunTrace, instrument, new_ring_buffer, append_jsonl, traced
+from resilience import CircuitBreaker, ResilientRepository
+import section_pack
+from agreement import LabelMatrix, agreement_report, DEFAULT_CACHE_PATH as DEFAULT_AGREEMENT_CACHE_PATH
+from dedup import list_cluster_members, override_cluster_label
+import analytics
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize Supabase client
-# In streamlit_app.py
-print("--- Environment Check ---")
-key_loaded = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-if key_loaded:
+@st.cache_resource
+def _create_shared_client(url, key):
+    """Build the Supabase client once per server process.
+
+    Every session and rerun reuses it, so its HTTP connection pool stays warm
+    instead of paying a new TLS handshake on every interaction. User sign-in
+    never happens on this client (see create_auth_client), so it always acts
+    with the service role.
+    """
+    print("--- Environment Check ---")
     print("✅ Service Key was found.")
-else:
-    print("❌ Service Key NOT found. The .env file was likely not loaded correctly.")
-print("-----------------------")
+    print("-----------------------")
+    return create_client(url, key, options=ClientOptions(auto_refresh_token=False, persist_session=False))
 
 def init_supabase():
     """Initialize Supabase client with credentials from environment variables"""
@@ -27,12 +47,71 @@ def init_supabase():
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") 
     
     if not url or not key:
+        print("❌ Service Key NOT found. The .env file was likely not loaded correctly.")
         st.error("Missing Supabase credentials. Please add SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY to your environment variables.")
         st.stop()
     
-    return create_client(url, key)
+    return _create_shared_client(url, key)
+
+def create_auth_client():
+    """Short-lived client for sign-in / sign-up.
+
+    Signing in attaches the user's session to a client, so this must never be
+    the shared one; the identity is kept in st.session_state instead.
+    """
+    return create_client(
+        os.getenv("SUPABASE_URL"),
+        os.getenv("SUPABASE_SERVICE_ROLE_KEY"),
+        options=ClientOptions(auto_refresh_token=False, persist_session=False)
+    )
 
 supabase: Client = init_supabase()
+# Developer performance panel. Off unless PERF_PANEL is set, and even then the
+# repository is only wrapped while "Record timings" is ticked.
+PERF_PANEL_ENABLED = os.getenv("PERF_PANEL", "").lower() in ("1", "true", "yes")
+# Optional JSONL file every recorded rerun is appended to
+PERF_LOG_PATH = os.getenv("PERF_LOG_PATH")
+
+def start_rerun_trace():
+    """Begin timing this rerun if the performance panel is recording."""
+    if not PERF_PANEL_ENABLED or not st.session_state.get('perf_panel'):
+        return None
+    user = st.session_state.get('user')
+    return RerunTrace(label=getattr(user, 'email', None))
+
+def finish_rerun_trace(trace):
+    """Store a finished rerun in the session's ring buffer and the JSONL log."""
+    if trace is None:
+        return
+    record = trace.finish().to_dict()
+    if 'perf_reruns' not in st.session_state:
+        st.session_state.perf_reruns = new_ring_buffer()
+    st.session_state.perf_reruns.append(record)
+    if PERF_LOG_PATH:
+        try:
+            append_jsonl(PERF_LOG_PATH, record)
+        except OSError as e:
+            print(f"Could not write performance log: {e}")
+
+def start_fragment_trace():
+    """Start a trace for a fragment-only rerun.
+
+    Those skip the module body, so rerun_trace is the (already finished) trace
+    of the last full run; point the instrumented repository at a fresh one.
+    """
+    if rerun_trace is None or rerun_trace.duration is None:
+        return None
+    trace = RerunTrace(label=rerun_trace.label)
+    repository.trace = trace
+    return trace
+
+@st.cache_resource
+def get_resilient_repository():
+    """The retrying, coalescing, circuit-broken backend shared by every session."""
+    return ResilientRepository(SupabaseRepository(supabase))
+
+rerun_trace = start_rerun_trace()
+repository: AnnotationRepository = instrument(get_resilient_repository(), rerun_trace)
 
 # Initialize session state
 def init_session_state():
@@ -57,15 +136,6 @@ def authenticate_user():
     """Supabase authentication"""
     st.title("💻Hinglish Hate Speech Annotation (An2ot8)")
 
-    try:
-        user = supabase.auth.get_user()
-        if user and user.user:
-            st.session_state.user = user.user
-            st.session_state.authenticated = True
-            st.rerun()
-    except:
-        pass
-    
     tab1, tab2 = st.tabs(["Sign In", "Sign Up"])
     
     with tab1:
@@ -76,10 +146,13 @@ def authenticate_user():
             
             if signin_btn:
                 try:
-                    response = supabase.auth.sign_in_with_password({"email": email, "password": password})
+                    response = traced(repository, 'auth_sign_in', create_auth_client().auth.sign_in_with_password,
+                                      {"email": email, "password": password})
                     if response.user:
                         st.session_state.user = response.user
                         st.session_state.authenticated = True
+                        # Seed the metadata cache so reruns never need the admin API
+                        st.session_state.active_batch_id = (response.user.user_metadata or {}).get('active_batch_id')
                         st.success("Successfully signed in!")
                         st.rerun()
                 except Exception as e:
@@ -93,134 +166,177 @@ def authenticate_user():
             
             if signup_btn:
                 try:
-                    response = supabase.auth.sign_up({"email": signup_email, "password": signup_password})
+                    response = traced(repository, 'auth_sign_up', create_auth_client().auth.sign_up,
+                                      {"email": signup_email, "password": signup_password})
                     if response.user:
                         st.success("Account created successfully!")
                 except Exception as e:
                     st.error(f"Sign up failed: {str(e)}")
 
+# How long the batch dashboard is shared between sessions before it is re-fetched
+BATCH_DASHBOARD_TTL_SECONDS = 15
+
+@st.cache_data(ttl=BATCH_DASHBOARD_TTL_SECONDS, show_spinner=False)
+def _fetch_batch_dashboard():
+    """Single round trip for every batch plus its annotated count (see get_batch_dashboard in supabase_rpc.sql)."""
+    return repository.list_batches()
+
 def get_available_batches():
-    """Fetch available batches from Supabase"""
+    """Fetch available batches together with their annotated counts.
+
+    The result is cached process-wide for a short TTL, so concurrent annotators
+    looking at the selection screen share one query.
+    """
     try:
-        # Now fetching comment_count directly from the table
-        response = supabase.table('batches').select('id, name, description, comment_count').execute()
-        return response.data
+        return _fetch_batch_dashboard()
     except Exception as e:
         st.error(f"Error fetching batches: {str(e)}")
         return []
 
-def get_batch_progress(batch_id, total_count):
-    """Get annotated comments count for a batch using a dedicated RPC."""
-    try:
-        # The total count is passed in from the 'batches' table.
-        # Call the RPC to get the annotated count.
-        response = supabase.rpc('count_annotated_in_batch', {
-            'p_batch_id': batch_id
-        }).execute()
-        
-        annotated_count = response.data
-        return total_count, annotated_count
-    except Exception as e:
-        # The original error object might be complex, so we convert it to a string.
-        st.error(f"Error getting batch progress: {str(e)}")
-        return total_count, 0
 # Add these new functions anywhere before main_app()
 
 def get_user_active_batch(user_id):
-    """Fetches the active_batch_id from a user's metadata."""
+    """Fetches the active_batch_id from a user's metadata, cached for the session."""
+    if 'active_batch_id' in st.session_state:
+        return st.session_state.active_batch_id
     try:
-        user_data = supabase.auth.admin.get_user_by_id(user_id).user
-        return user_data.user_metadata.get('active_batch_id')
+        user_data = traced(repository, 'auth_get_user', supabase.auth.admin.get_user_by_id, user_id).user
+        active_batch_id = user_data.user_metadata.get('active_batch_id')
     except Exception as e:
         st.error(f"Error fetching user metadata: {e}")
         return None
+    st.session_state.active_batch_id = active_batch_id
+    return active_batch_id
 
 def set_user_active_batch(user_id, batch_id):
     """Sets the active_batch_id in a user's metadata."""
     try:
-        supabase.auth.admin.update_user_by_id(
-            user_id,
-            {'user_metadata': {'active_batch_id': batch_id}}
+        traced(
+            repository, 'auth_update_user', supabase.auth.admin.update_user_by_id,
+            user_id, {'user_metadata': {'active_batch_id': batch_id}}
         )
+        st.session_state.active_batch_id = batch_id
     except Exception as e:
+        # Unknown server state: re-read it next time
+        st.session_state.pop('active_batch_id', None)
         st.error(f"Error setting active batch: {e}")
 def update_section_progress(batch_id, user_id, new_index):
     """Updates the user's progress index for their assigned section."""
     try:
-        supabase.table('section_assignments') \
-                .update({'progress_index': new_index}) \
-                .eq('batch_id', batch_id) \
-                .eq('user_id', user_id) \
-                .execute()
+        repository.update_progress(batch_id, user_id, new_index,
+                                   section_number=st.session_state.get('assigned_section_number'))
     except Exception as e:
         st.warning(f"Could not save progress: {e}")
 def clear_user_active_batch(user_id):
     """Clears the active_batch_id from a user's metadata."""
     try:
-        supabase.auth.admin.update_user_by_id(
-            user_id,
-            {'user_metadata': {'active_batch_id': None}}
+        traced(
+            repository, 'auth_update_user', supabase.auth.admin.update_user_by_id,
+            user_id, {'user_metadata': {'active_batch_id': None}}
         )
+        st.session_state.active_batch_id = None
     except Exception as e:
+        st.session_state.pop('active_batch_id', None)
         st.error(f"Error clearing active batch: {e}")
 
 def get_user_stats(user_email):
-    """Get user annotation statistics"""
+    """Get user annotation statistics as (total, label counts, category counts).
+
+    Reads the single counters row kept up to date by the database on every
+    insert, and caches it in the session until the user saves an annotation.
+    """
+    cached_stats = st.session_state.get('user_stats')
+    if cached_stats is not None:
+        return cached_stats
     try:
-        response = supabase.table('annotations').select('*').eq('user_id', user_email).execute()
-        total_annotations = len(response.data)
-        labels = {annotation.get('label', 'unknown'): 0 for annotation in response.data}
-        for annotation in response.data:
-            labels[annotation.get('label', 'unknown')] += 1
-        return total_annotations, labels
+        stats = repository.get_user_stats(user_email)
+        st.session_state.user_stats = stats
+        return stats
     except Exception as e:
         st.error(f"Error getting user stats: {str(e)}")
-        return 0, {}
+        return 0, {}, {}
+
+def invalidate_user_stats():
+    """Drop the cached statistics so the next rerun reads fresh counters."""
+    st.session_state.pop('user_stats', None)
 
 # NEW: Function to get or assign a section
-def get_or_assign_user_section(batch_id, user_email):
-    """Call the RPC to get an already assigned section or assign a new one."""
-    try:
-        response = supabase.rpc('assign_section_to_user', {
-            'p_batch_id': batch_id,
-            'p_user_id': user_email
-        }).execute()
-        if response.data:
-            return response.data
-        return None
-    except Exception as e:
-        st.error(f"Error assigning section: {e}")
-        return None
+# Memory cap for the process-wide section cache, in MB
+SECTION_CACHE_MB = int(os.getenv("SECTION_CACHE_MB", "64"))
+
+@st.cache_resource
+def get_section_cache():
+    """One section cache per server process, shared by every session."""
+    return SectionCache(max_bytes=SECTION_CACHE_MB * 1024 * 1024)
+
+def load_section(cache, batch_id, section_number):
+    """Return a handle on the section's comments, downloading them only if no session has them cached."""
+    return cache.acquire(
+        (str(batch_id), section_number),
+        lambda: repository.get_section_comments(batch_id, section_number)
+    )
 
 # NEW: Function to fetch comments for an assigned section
-def get_comments_for_section(batch_id, section_number, total_batch_size):
-    """Fetch the comments for a given section number with dynamic section size."""
+def get_comments_for_section(batch_id, section_number):
+    """Fetch the comments for a given section number from the shared section cache."""
     try:
-        # Calculate the dynamic section size. Using integer division.
-        if total_batch_size < 10:
-            section_size = total_batch_size
-        else:
-            section_size = total_batch_size // 10
-
-        # The rest of the logic uses the new dynamic section_size
-        start_index = (section_number - 1) * section_size
-        end_index = start_index + section_size - 1
-        
-        response = supabase.table('comment_batches') \
-                           .select('comments(*)') \
-                           .eq('batch_id', batch_id) \
-                           .order('original_index', foreign_table='comments', desc=False) \
-                           .range(start_index, end_index) \
-                           .execute()
-        
-        if response.data:
-            return [item['comments'] for item in response.data if item.get('comments')]
-        return []
+        return load_section(get_section_cache(), batch_id, section_number) or []
     except Exception as e:
         st.error(f"Error fetching comments for section: {e}")
         return []
+
+# Start reserving and downloading the next section once this many comments remain
+PREFETCH_THRESHOLD = int(os.getenv("SECTION_PREFETCH_THRESHOLD", "5"))
+# How long "Get Next Section" waits for a prefetch that is still running
+PREFETCH_WAIT_SECONDS = 5
+
+def maybe_start_prefetch(batch, user_email):
+    """Start prefetching the next section once the annotator is near the end of the current one."""
+    if PREFETCH_THRESHOLD <= 0 or st.session_state.get('prefetcher'):
+        return
+    remaining = len(st.session_state.section_comments) - st.session_state.current_comment_index
+    if remaining > PREFETCH_THRESHOLD:
+        return
+    # Resolve the cache here: the prefetch thread has no script context.
+    cache = get_section_cache()
+    st.session_state.prefetcher = SectionPrefetcher(
+        batch['id'], user_email,
+        reserve=repository.reserve_next_section,
+        fetch=lambda batch_id, section_number: load_section(cache, batch_id, section_number),
+        release=repository.release_section_reservation
+    )
+
+def cancel_prefetch():
+    """Cancel any running prefetch and release its reservation (batch change, logout)."""
+    prefetcher = st.session_state.pop('prefetcher', None)
+    if prefetcher:
+        prefetcher.cancel()
+
+def take_prefetched_section(user_email):
+    """Swap in the prefetched section. Returns False if there is none and the normal path should run."""
+    prefetcher = st.session_state.pop('prefetcher', None)
+    if not prefetcher:
+        return False
+    result = prefetcher.result(timeout=PREFETCH_WAIT_SECONDS)
+    if result is None:
+        prefetcher.cancel()
+        return False
+    _, comments = result
+    try:
+        assignment = repository.claim_section_reservation(prefetcher.batch_id, user_email)
+    except Exception:
+        prefetcher.cancel()
+        return False
+    if not assignment:
+        # The reservation expired; fall back to a fresh assignment.
+        return False
+    st.session_state.assigned_section_number = assignment['assigned_section_number']
+    st.session_state.section_comments = comments
+    st.session_state.current_comment_index = assignment['saved_progress_index']
+    return True
+
 # The new function signature now includes batch_id
-def save_annotation(comment_id, batch_id, user_email, label, categories, notes):
+def save_annotation(comment_id, batch_id, user_email, label, categories, notes, duration_ms=None):
     """Save annotation to database, now including the batch_id."""
     try:
         annotation_data = {
@@ -229,9 +345,10 @@ def save_annotation(comment_id, batch_id, user_email, label, categories, notes):
             'user_id': user_email,
             'label': label,
             'categories': categories,
-            'notes': notes
+            'notes': notes,
+            'duration_ms': duration_ms
         }
-        supabase.table('annotations').insert(annotation_data).execute()
+        repository.save_annotation(annotation_data)
         
         # We no longer update the comment's status, as it can be annotated in other batches.
         # supabase.table('comments').update({'status': 'annotated'}).eq('id', comment_id).execute()
@@ -241,28 +358,290 @@ def save_annotation(comment_id, batch_id, user_email, label, categories, notes):
         st.error(f"Error saving annotation: {str(e)}")
         return False
 
-# This function might need updates depending on how you handle downloads now
-def download_annotations():
-    """Generate CSV download for all annotations"""
-    # This might need to be adjusted to join through the new tables if batch_name is required.
+# Opt-in: journal saves locally and flush them to Supabase from a background thread
+WRITE_BEHIND_ENABLED = os.getenv("ANNOTATION_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+
+@st.cache_resource
+def get_write_behind_worker():
+    """One journal and flush thread per server process, shared by all sessions."""
+    journal = AnnotationJournal(os.getenv("ANNOTATION_JOURNAL_PATH", DEFAULT_JOURNAL_PATH))
+    return WriteBehindWorker(journal, get_resilient_repository())
+
+def record_annotation(comment_id, batch_id, user_email, label, categories, notes, new_index, duration_ms=None):
+    """Save an annotation and advance section progress.
+
+    With write-behind enabled this only touches the local journal; otherwise it
+    makes the insert and progress update directly.
+    """
+    if not WRITE_BEHIND_ENABLED:
+        if not save_annotation(comment_id, batch_id, user_email, label, categories, notes, duration_ms):
+            return False
+        update_section_progress(batch_id, user_email, new_index)
+        return True
     try:
-        response = supabase.table('annotations').select('''
-            *, comments (comment_text, original_index)
-        ''').execute()
-        
-        if not response.data:
-            st.warning("No annotations found to download.")
-            return None
-            
-        csv_data = [{'annotation_id': ann['id'], 'comment_id': ann['comment_id'], 'user_id': ann['user_id'],
-                     'label': ann['label'], 'categories': ', '.join(ann.get('categories', [])), 'notes': ann.get('notes', ''),
-                     'created_at': ann['created_at'], 'comment_text': ann.get('comments', {}).get('comment_text', '')}
-                    for ann in response.data]
-        return pd.DataFrame(csv_data)
+        get_write_behind_worker().journal.append(
+            annotation={
+                'comment_id': comment_id,
+                'batch_id': batch_id,
+                'user_id': user_email,
+                'label': label,
+                'categories': categories,
+                'notes': notes,
+                'duration_ms': duration_ms
+            },
+            progress=(batch_id, user_email, st.session_state.assigned_section_number, new_index)
+        )
+        return True
+    except Exception as e:
+        st.error(f"Error saving annotation: {str(e)}")
+        return False
+
+def record_skip(comment_id, batch_id, user_email, new_index, duration_ms=None):
+    """Record a "Skip For Now" event and advance section progress past the comment."""
+    skip_event = {
+        'comment_id': comment_id,
+        'batch_id': batch_id,
+        'user_id': user_email,
+        'duration_ms': duration_ms
+    }
+    if not WRITE_BEHIND_ENABLED:
+        try:
+            repository.save_skip_events([skip_event])
+        except Exception as e:
+            # Losing a skip only affects analytics; keep the annotator moving.
+            st.warning(f"Could not record skip: {e}")
+        update_section_progress(batch_id, user_email, new_index)
+        return
+    try:
+        get_write_behind_worker().journal.append(
+            skip=skip_event, progress=(batch_id, user_email, st.session_state.assigned_section_number, new_index)
+        )
+    except Exception as e:
+        st.warning(f"Could not save progress: {e}")
+
+def flush_write_behind():
+    """Push journalled saves to Supabase now, e.g. before a new section is assigned or on logout."""
+    if not WRITE_BEHIND_ENABLED:
+        return
+    try:
+        get_write_behind_worker().flush()
+    except Exception as e:
+        st.warning(f"Saved annotations are still queued locally and will be retried: {e}")
+
+# Rows per downloadable export file; only one part is held in memory at a time
+EXPORT_PART_ROWS = int(os.getenv("EXPORT_PART_ROWS", "50000"))
+
+def export_next_part():
+    """Stream the next EXPORT_PART_ROWS annotations to a temporary file and keep only that part for download."""
+    export = st.session_state.export
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, f"annotations.{export['fmt']}")
+            row_count, cursor = traced(
+                repository, 'export_annotations', export_annotations,
+                supabase, path, fmt=export['fmt'], since=export['cursor'], max_rows=EXPORT_PART_ROWS
+            )
+            data = None
+            if row_count:
+                with open(path, 'rb') as f:
+                    data = f.read()
     except Exception as e:
-        st.error(f"Error generating CSV: {str(e)}")
+        st.error(f"Error generating export: {str(e)}")
+        return
+    if not row_count:
+        st.warning("No annotations found to download." if export['part'] == 0 else "There are no more annotations.")
+    export.update(
+        cursor=cursor, data=data, rows=row_count,
+        part=export['part'] + 1 if row_count else export['part'],
+        done=row_count < EXPORT_PART_ROWS,
+    )
+
+def render_export_controls():
+    """Download all annotations as one or more files of at most EXPORT_PART_ROWS rows."""
+    export_format = st.radio("Export format", options=['csv', 'parquet'], horizontal=True)
+    if st.button("📥 Download All Annotations"):
+        st.session_state.export = {
+            'fmt': export_format, 'cursor': None, 'part': 0, 'data': None, 'rows': 0, 'done': False,
+            'stamp': datetime.now().strftime('%Y%m%d_%H%M%S'),
+        }
+        export_next_part()
+    export = st.session_state.get('export')
+    if not export or export['data'] is None:
+        return
+    fmt = export['fmt']
+    mime = "text/csv" if fmt == 'csv' else "application/vnd.apache.parquet"
+    suffix = "" if export['part'] == 1 and export['done'] else f"_part{export['part']}"
+    st.download_button(
+        f"Download {fmt.upper()}" + (f" part {export['part']}" if suffix else "") + f" ({export['rows']} rows)",
+        export['data'], f"annotations_{export['stamp']}{suffix}.{fmt}", mime, on_click="ignore"
+    )
+    if not export['done'] and st.button("Prepare next part"):
+        export_next_part()
+        st.rerun()
+
+# Comma-separated e-mails of users who may open the admin views
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+AGREEMENT_CACHE_PATH = os.getenv("AGREEMENT_CACHE_PATH", DEFAULT_AGREEMENT_CACHE_PATH)
+
+def is_admin(user):
+    return (getattr(user, 'email', None) or '').lower() in ADMIN_EMAILS
+
+@st.cache_resource
+def get_agreement_state():
+    """Label matrix shared by all admin sessions; refreshes only read annotations newer than its cursor."""
+    return {'matrix': LabelMatrix.load(AGREEMENT_CACHE_PATH), 'report': None, 'lock': threading.Lock()}
+
+def refresh_agreement():
+    """Fold new annotations into the shared label matrix and recompute the report."""
+    state = get_agreement_state()
+    try:
+        with state['lock']:
+            added = traced(repository, 'refresh_agreement', state['matrix'].refresh, supabase)
+            if added or state['report'] is None:
+                state['matrix'].save(AGREEMENT_CACHE_PATH)
+                state['report'] = agreement_report(state['matrix'])
+        return added
+    except Exception as e:
+        st.error(f"Error computing agreement: {str(e)}")
         return None
 
+def render_agreement_view():
+    """Admin view of inter-annotator agreement on comments rated by two or more annotators."""
+    st.subheader("📊 Inter-Annotator Agreement")
+    state = get_agreement_state()
+    if st.button("🔄 Refresh") or state['report'] is None:
+        with st.spinner("Reading new annotations..."):
+            added = refresh_agreement()
+        if added is not None:
+            st.caption(f"{added} new annotation(s) read.")
+    report = state['report']
+    if report is None:
+        return
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Overlapping comments", report['overlapping_comments'])
+    col2.metric("Fleiss' κ", f"{report['fleiss_kappa']:.3f}")
+    col3.metric("Krippendorff's α", f"{report['krippendorff_alpha']:.3f}")
+    col4.metric("Mean pairwise Cohen's κ", f"{report['mean_pairwise_cohen_kappa']:.3f}")
+    st.write("**Per-category agreement**")
+    st.dataframe(pd.DataFrame(report['categories']), hide_index=True)
+    st.write("**Annotator pairs**")
+    if report['pairs']:
+        st.dataframe(pd.DataFrame(report['pairs']).sort_values('cohen_kappa'), hide_index=True)
+    else:
+        st.info("No annotator pair shares enough comments yet.")
+
+# Near-duplicates shown per page of the review view
+DUPLICATE_REVIEW_LIMIT = 25
+
+def render_duplicate_review(user):
+    """Admin review of labels copied from cluster leaders to their near-duplicates."""
+    st.subheader("🧬 Near-Duplicate Review")
+    include_reviewed = st.checkbox("Include reviewed")
+    try:
+        members = traced(repository, 'list_cluster_members', list_cluster_members, supabase,
+                         limit=DUPLICATE_REVIEW_LIMIT, unreviewed_only=not include_reviewed)
+    except Exception as e:
+        st.error(f"Error loading near-duplicates: {str(e)}")
+        return
+    if not members:
+        st.info("No near-duplicates to review.")
+        return
+    for member in members:
+        with st.container(border=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                st.caption("Leader")
+                st.write(member['leader_text'])
+            with col2:
+                st.caption(f"Near-duplicate · similarity {member['similarity']:.2f}")
+                st.write(member['comment_text'])
+            if member['label'] is None:
+                st.caption("The leader is not annotated yet.")
+                continue
+            if member['overridden_by']:
+                st.caption(f"Reviewed by {member['overridden_by']}")
+            with st.form(f"override_{member['comment_id']}"):
+                label = st.radio(
+                    "Label", options=LABELS, horizontal=True,
+                    index=LABELS.index(member['label']) if member['label'] in LABELS else 0
+                )
+                categories = st.multiselect(
+                    "Categories", options=CATEGORIES,
+                    default=[c for c in member['categories'] or [] if c in CATEGORIES]
+                )
+                if st.form_submit_button("✔️ Save Review"):
+                    try:
+                        if traced(repository, 'override_cluster_label', override_cluster_label,
+                                  supabase, member['comment_id'], label, categories, user.email):
+                            st.rerun()
+                        st.warning("Nothing to override yet.")
+                    except Exception as e:
+                        st.error(f"Error saving review: {str(e)}")
+
+ANALYTICS_WINDOWS = {'Last 24 hours': 24, 'Last 7 days': 24 * 7, 'Last 30 days': 24 * 30}
+ANALYTICS_TTL_SECONDS = 60
+
+@st.cache_data(ttl=ANALYTICS_TTL_SECONDS, show_spinner=False)
+def _fetch_analytics(window_hours):
+    since = analytics.since_hours_ago(window_hours)
+    return (traced(repository, 'get_throughput', analytics.fetch_throughput, supabase, since),
+            traced(repository, 'get_batch_projections', analytics.fetch_batch_projections, supabase, window_hours))
+
+def render_throughput_view():
+    """Admin dashboard of annotation velocity, read from the hourly rollups only."""
+    st.subheader("📈 Throughput")
+    window = st.radio("Window", options=list(ANALYTICS_WINDOWS), horizontal=True)
+    try:
+        rollups, projections = _fetch_analytics(ANALYTICS_WINDOWS[window])
+    except Exception as e:
+        st.error(f"Error loading analytics: {str(e)}")
+        return
+    col1, col2, col3 = st.columns(3)
+    annotations, skips = int(rollups['annotations'].sum()), int(rollups['skips'].sum())
+    col1.metric("Annotations", annotations)
+    col2.metric("Skips", skips)
+    col3.metric("Skip rate", f"{skips / (annotations + skips):.1%}" if annotations + skips else "–")
+
+    st.write("**Per hour**")
+    if rollups.empty:
+        st.info("No activity in this window.")
+    else:
+        st.bar_chart(analytics.hourly_totals(rollups))
+    st.write("**Annotators**")
+    st.dataframe(analytics.annotator_summary(rollups), hide_index=True)
+    st.write("**Batches**")
+    st.dataframe(analytics.batch_projections(projections), hide_index=True)
+    mix = analytics.label_mix(rollups)
+    if not mix.empty:
+        with st.expander("Label mix per batch"):
+            st.dataframe(mix)
+
+def render_perf_panel():
+    """Sidebar panel with the repository calls of recent reruns."""
+    if not PERF_PANEL_ENABLED:
+        return
+    st.divider()
+    st.subheader("⏱️ Performance")
+    st.checkbox("Record timings", key='perf_panel')
+    reruns = st.session_state.get('perf_reruns')
+    if not st.session_state.get('perf_panel') or not reruns:
+        return
+    last_rerun = reruns[-1]
+    st.metric("Last rerun", f"{last_rerun['duration_ms']:.0f} ms")
+    if last_rerun['calls']:
+        st.dataframe(pd.DataFrame(last_rerun['calls']), hide_index=True)
+    with st.expander("Recent reruns"):
+        st.dataframe(pd.DataFrame([{
+            'started': datetime.fromtimestamp(rerun['started_at']).strftime('%H:%M:%S'),
+            'duration_ms': rerun['duration_ms'],
+            'calls': len(rerun['calls']),
+            'db_ms': round(sum(call['duration_ms'] for call in rerun['calls']), 3),
+        } for rerun in reversed(reruns)]), hide_index=True)
+    with st.expander("Section cache"):
+        st.json(get_section_cache().stats())
+    with st.expander("Request layer"):
+        st.json(get_resilient_repository().stats())
+
 def apply_theme():
     # Theme application logic remains the same
     pass
@@ -273,6 +652,10 @@ def main_app():
     st.title("💻An2ot8")
     user = st.session_state.user
     st.write(f"Welcome, {user.email}!")
+    breaker = get_resilient_repository().breaker
+    if breaker.state != CircuitBreaker.CLOSED:
+        st.warning(f"⚠️ The database is not responding. Showing the last data we had; "
+                   f"trying again in {breaker.retry_in():.0f}s.")
     
     with st.sidebar:
         # Sidebar logic...
@@ -282,34 +665,51 @@ def main_app():
             st.rerun()
         st.divider()
         st.subheader("👤 User Statistics")
-        total_annotations, label_stats = get_user_stats(user.email)
+        total_annotations, label_stats, category_stats = get_user_stats(user.email)
         st.metric("Total Annotations", total_annotations)
         if label_stats:
             st.write("**Labels Distribution:**")
             for label, count in label_stats.items():
                 st.write(f"- {label}: {count}")
+        if category_stats:
+            with st.expander("Categories Distribution"):
+                for category, count in sorted(category_stats.items(), key=lambda item: -item[1]):
+                    st.write(f"- {category}: {count}")
         st.divider()
-        if st.button("📥 Download All Annotations"):
-            df = download_annotations()
-            if df is not None:
-                csv = df.to_csv(index=False)
-                st.download_button("Download CSV", csv, f"annotations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv", "text/csv")
+        render_export_controls()
+        render_perf_panel()
+        if is_admin(user):
+            st.divider()
+            st.radio("🛠️ Admin", options=['Annotate', 'Throughput', 'Agreement', 'Near-duplicates'], key='admin_view')
         st.divider()
         if st.button("🚪 Logout"):
-            try:
-                supabase.auth.sign_out()
-            except:
-                pass
+            flush_write_behind()
+            cancel_prefetch()
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
             st.rerun()
 
+    admin_view = st.session_state.get('admin_view') if is_admin(user) else None
+    if admin_view == 'Throughput':
+        render_throughput_view()
+        return
+    if admin_view == 'Agreement':
+        render_agreement_view()
+        return
+    if admin_view == 'Near-duplicates':
+        render_duplicate_review(user)
+        return
+
     if not st.session_state.get('selected_batch'):
         active_batch_id = get_user_active_batch(user.id)
         if active_batch_id:
-            response = supabase.table('batches').select('*').eq('id', active_batch_id).single().execute()
-            st.session_state.selected_batch = response.data
-            st.rerun()
+            try:
+                st.session_state.selected_batch = repository.get_batch(active_batch_id)
+            except Exception as e:
+                # Fall through to the batch list rather than rerunning into the same failure
+                st.error(f"Error loading your active batch: {e}")
+            else:
+                st.rerun()
 
     if not st.session_state.selected_batch:
         st.subheader("📁 Select a Batch")
@@ -319,8 +719,8 @@ def main_app():
             st.warning("No batches available.")
             return
         for batch in batches:
-            total_count = batch.get('comment_count', 0)
-            _, annotated_count = get_batch_progress(batch['id'], total_count)
+            total_count = batch.get('comment_count') or 0
+            annotated_count = batch.get('annotated_count') or 0
             progress = annotated_count / total_count if total_count > 0 else 0
             col1, col2, col3 = st.columns([3, 2, 1])
             with col1:
@@ -344,11 +744,16 @@ def main_app():
         
         if not st.session_state.section_comments:
             with st.spinner("Loading your section..."):
-                # CHANGED: RPC now returns a list with a dictionary
-                response = supabase.rpc('assign_section_to_user', {'p_batch_id': batch['id'], 'p_user_id': user.email}).execute()
-                
-                if response.data:
-                    assignment = response.data[0]
+                try:
+                    assignment = repository.assign_section(batch['id'], user.email)
+                except Exception as e:
+                    # Not the same as "no section left": keep the batch and let the user retry
+                    st.error(f"Error assigning section: {e}")
+                    if st.button("🔄 Retry"):
+                        st.rerun()
+                    return
+
+                if assignment:
                     section_number = assignment['assigned_section_number']
                     saved_progress = assignment['saved_progress_index']
 
@@ -356,8 +761,7 @@ def main_app():
                         set_user_active_batch(user.id, batch['id'])
                     
                     st.session_state.assigned_section_number = section_number
-                    total_comments_in_batch = batch.get('comment_count', 0)
-                    comments = get_comments_for_section(batch['id'], section_number, total_comments_in_batch)
+                    comments = get_comments_for_section(batch['id'], section_number)
 
                     if comments:
                         st.session_state.section_comments = comments
@@ -377,19 +781,23 @@ def main_app():
 
         if st.session_state.section_comments:
             total_in_section = len(st.session_state.section_comments)
-            
+
             if st.session_state.current_comment_index >= total_in_section:
+                # The next assignment depends on this section's progress being on the server
+                flush_write_behind()
                 st.success(f"🎉 Section {st.session_state.assigned_section_number} complete!")
                 st.balloons()
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button("Get Next Section", use_container_width=True):
-                        st.session_state.assigned_section_number = None
-                        st.session_state.section_comments = []
-                        st.session_state.current_comment_index = 0
+                        if not take_prefetched_section(user.email):
+                            st.session_state.assigned_section_number = None
+                            st.session_state.section_comments = []
+                            st.session_state.current_comment_index = 0
                         st.rerun()
                 with col2:
                     if st.button("🔄 Change Batch", use_container_width=True):
+                        cancel_prefetch()
                         clear_user_active_batch(user.id) # Also clear active batch here
                         st.session_state.selected_batch = None
                         st.session_state.assigned_section_number = None
@@ -398,42 +806,193 @@ def main_app():
                         st.rerun()
                 return
 
-            st.info(f"Annotating Section {st.session_state.assigned_section_number} | Comment {st.session_state.current_comment_index + 1} of {total_in_section}")
-            
-            current_comment = st.session_state.section_comments[st.session_state.current_comment_index]
-            
-            st.text_area("Comment Text", value=current_comment['comment_text'], height=150, disabled=True)
-            
-            with st.form("annotation_form"):
-                label = st.selectbox("Label *", options=['hate', 'non-hate'])
-                categories = st.multiselect("Categories", options=['none','religion', 'race', 'caste', 'regionalism', 'terrorism','language', 'body shaming','addiction','disability', 'age', 'gender', 'sexual', 'political', 'privacy', 'cyber bully'])
-                notes = st.text_area("Notes (optional)")
-                
-                submit, skip = st.columns(2)
-                with submit:
-                    if st.form_submit_button("✅ Save Annotation", use_container_width=True, type="primary"):
-                        if save_annotation(current_comment['id'], batch['id'], user.email, label, categories, notes):
-                            st.success("Annotation saved!")
-                            # CHANGED: Update progress in the database
-                            new_index = st.session_state.current_comment_index + 1
-                            update_section_progress(batch['id'], user.email, new_index)
-                            st.session_state.current_comment_index = new_index
-                            st.rerun()
-                with skip:
-                    if st.form_submit_button("⏭️ Skip For Now", use_container_width=True):
-                        # CHANGED: Also update progress on skip
-                        new_index = st.session_state.current_comment_index + 1
-                        update_section_progress(batch['id'], user.email, new_index)
-                        st.session_state.current_comment_index = new_index
-                        st.rerun()
+            annotation_panel(batch, user)
+            render_keyboard_shortcuts()
+
+def render_section_pack_panel(batch, user):
+    """Download the current section for offline work, or import an annotated pack.
+
+    Rendered inside annotation_panel, so it follows the annotator from comment to comment.
+    """
+    with st.expander("📦 Work offline"):
+        st.caption("Download this section, annotate it without a connection with "
+                   "`python section_pack.py annotate <file>`, then upload the file here.")
+        section_number = st.session_state.assigned_section_number
+        # The pack is only built on request, at the position the annotator has reached by then,
+        # and dropped as soon as they move on, so it never resumes from a stale index.
+        position = (str(batch['id']), section_number, st.session_state.current_comment_index)
+        if st.button("📦 Prepare section pack"):
+            pack = section_pack.build_pack(
+                batch, section_number, user.email, st.session_state.section_comments,
+                st.session_state.current_comment_index, LABELS, CATEGORIES
+            )
+            st.session_state.section_pack = {'position': position, 'data': section_pack.dumps_pack(pack)}
+        prepared = st.session_state.get('section_pack')
+        if prepared and prepared['position'] != position:
+            st.session_state.section_pack = prepared = None
+        if prepared:
+            st.download_button(
+                "📥 Download section pack", data=prepared['data'],
+                file_name=f"{batch['name']}-section{section_number}{section_pack.PACK_SUFFIX}",
+                mime="application/gzip", on_click="ignore"
+            )
+        uploaded = st.file_uploader("Annotated pack", type=[section_pack.PACK_SUFFIX.lstrip('.')])
+        if uploaded is None or not st.button("📤 Import pack"):
+            return
+        try:
+            # Queued progress from this session must not land after the import and move it back
+            flush_write_behind()
+            pack = section_pack.loads_pack(uploaded.getvalue())
+            result = section_pack.upload_pack(repository, pack, user_id=user.email)
+        except section_pack.PackError as e:
+            st.error(str(e))
+            return
+        except Exception as e:
+            st.error(f"Error importing pack: {str(e)}")
+            return
+        invalidate_user_stats()
+        message = (f"Imported {result['imported_annotations']} annotation(s) and "
+                   f"{result['imported_skips']} skip(s).")
+        if (result['progress_index'] is not None and pack['batch_id'] == str(batch['id'])
+                and pack['section_number'] == section_number
+                and result['progress_index'] > st.session_state.current_comment_index):
+            st.toast(message, icon="📤")
+            advance_to_comment(result['progress_index'], len(st.session_state.section_comments))
+        st.success(message)
+
+@st.fragment
+def annotation_panel(batch, user):
+    """Comment and annotation form.
+
+    Runs as a fragment: saving or skipping reruns only this function, so the
+    sidebar, batch header and client setup are not re-executed per comment.
+    The whole page reruns only when the section is finished.
+    """
+    trace = start_fragment_trace()
+    try:
+        render_section_pack_panel(batch, user)
+        total_in_section = len(st.session_state.section_comments)
+        st.info(f"Annotating Section {st.session_state.assigned_section_number} | Comment {st.session_state.current_comment_index + 1} of {total_in_section}")
+
+        current_comment = st.session_state.section_comments[st.session_state.current_comment_index]
+        maybe_start_prefetch(batch, user.email)
+        if st.session_state.get('shown_comment_id') != current_comment['id']:
+            st.session_state.shown_comment_id = current_comment['id']
+            st.session_state.shown_comment_at = time.monotonic()
+
+        st.text_area("Comment Text", value=current_comment['comment_text'], height=150, disabled=True)
+
+        # Pre-select the suggestion model's label when the comment has been scored (active_learning.py)
+        suggested_index = 0
+        hate_probability = current_comment.get('hate_probability')
+        if hate_probability is not None:
+            suggested_index = LABELS.index('hate' if hate_probability >= 0.5 else 'non-hate')
+            st.caption(f"🤖 Suggested: {LABELS[suggested_index]} ({max(hate_probability, 1 - hate_probability):.0%} confident)")
+
+        with st.form("annotation_form"):
+            label = st.radio("Label *", options=LABELS, index=suggested_index, horizontal=True)
+            categories = st.multiselect("Categories", options=CATEGORIES)
+            notes = st.text_area("Notes (optional)")
+
+            submit, skip = st.columns(2)
+            with submit:
+                if st.form_submit_button("✅ Save Annotation", use_container_width=True, type="primary"):
+                    new_index = st.session_state.current_comment_index + 1
+                    if record_annotation(current_comment['id'], batch['id'], user.email, label, categories, notes,
+                                         new_index, time_on_comment_ms()):
+                        # A toast outlives the rerun below; an st.success here would be discarded with it
+                        st.toast("Annotation saved!", icon="✅")
+                        # Sidebar statistics are re-read on the next full rerun
+                        invalidate_user_stats()
+                        advance_to_comment(new_index, total_in_section)
+            with skip:
+                if st.form_submit_button("⏭️ Skip For Now", use_container_width=True):
+                    # CHANGED: Also update progress on skip
+                    new_index = st.session_state.current_comment_index + 1
+                    record_skip(current_comment['id'], batch['id'], user.email, new_index, time_on_comment_ms())
+                    advance_to_comment(new_index, total_in_section)
+    finally:
+        finish_rerun_trace(trace)
+
+def time_on_comment_ms():
+    """Milliseconds since the current comment was first shown, or None if implausibly long."""
+    elapsed = time.monotonic() - st.session_state.get('shown_comment_at', time.monotonic())
+    return int(elapsed * 1000) if elapsed <= section_pack.MAX_TIMED_SECONDS else None
+
+def advance_to_comment(new_index, total_in_section):
+    """Move to the next comment, rerunning the whole page only when the section is done."""
+    st.session_state.current_comment_index = new_index
+    if new_index < total_in_section:
+        try:
+            st.rerun(scope="fragment")
+        except StreamlitAPIException:
+            # Only valid during a fragment rerun; the form was submitted in a full run.
+            pass
+    st.rerun()
+
+# Installed once into the page itself (not the component iframe), so the
+# listener survives reruns. Keys are ignored while typing in a text field.
+KEYBOARD_SHORTCUTS_JS = """
+<script>
+const doc = window.parent.document;
+if (!doc.getElementById('an2ot8-shortcuts')) {
+    const script = doc.createElement('script');
+    script.id = 'an2ot8-shortcuts';
+    script.textContent = `
+        (function () {
+            function clickButton(text) {
+                const button = Array.from(document.querySelectorAll('button'))
+                    .find(b => b.innerText.includes(text) && !b.disabled);
+                if (button) button.click();
+            }
+            function chooseLabel(text) {
+                const option = Array.from(document.querySelectorAll('[data-testid="stRadio"] label'))
+                    .find(l => l.innerText.trim() === text);
+                if (option) option.click();
+            }
+            document.addEventListener('keydown', function (event) {
+                if (event.key === 'Enter' && (event.ctrlKey || event.metaKey)) {
+                    event.preventDefault();
+                    clickButton('Save Annotation');
+                    return;
+                }
+                const target = event.target;
+                if (event.ctrlKey || event.metaKey || event.altKey || target.isContentEditable
+                        || ['INPUT', 'TEXTAREA', 'SELECT'].includes(target.tagName)) {
+                    return;
+                }
+                const key = event.key.toLowerCase();
+                if (key === 'h') chooseLabel('hate');
+                else if (key === 'n') chooseLabel('non-hate');
+                else if (key === 's') clickButton('Save Annotation');
+                else if (key === 'k') clickButton('Skip For Now');
+                else return;
+                event.preventDefault();
+            });
+        })();
+    `;
+    doc.head.appendChild(script);
+}
+</script>
+"""
+
+def render_keyboard_shortcuts():
+    """Keyboard shortcuts for the annotation form: H / N pick the label, S (or Ctrl+Enter) saves, K skips."""
+    components.html(KEYBOARD_SHORTCUTS_JS, height=0)
+    st.caption("Shortcuts: **H** hate · **N** non-hate · **S** or **Ctrl+Enter** save · **K** skip")
+
 def main():
     """Main application entry point"""
     st.set_page_config(page_title="An2ot8", page_icon="💻", layout="wide")
     init_session_state()
-    if not st.session_state.authenticated:
-        authenticate_user()
-    else:
-        main_app()
+    try:
+        if not st.session_state.authenticated:
+            authenticate_user()
+        else:
+            main_app()
+    finally:
+        # Also runs when st.rerun() / st.stop() end the script early
+        finish_rerun_trace(rerun_trace)
 
 if __name__ == "__main__":
     main()
@@ -54,29 +54,1450 @@ BEGIN
 END;
 $$;
 
--- Optional: Function to release expired locks
--- This can be called periodically to free up comments that were claimed but not annotated
-CREATE OR REPLACE FUNCTION release_expired_locks()
+-- Claim K comments at once with a single lease, so an annotator pays one
+-- round trip (and one SKIP LOCKED probe) per K comments instead of per comment.
+CREATE OR REPLACE FUNCTION claim_comments_in_batch(
+    p_user_id TEXT,
+    p_batch_id UUID,
+    p_count INTEGER DEFAULT 10,
+    p_lease_seconds INTEGER DEFAULT 1800
+)
+RETURNS TABLE(
+    id UUID,
+    original_index INTEGER,
+    comment_text TEXT,
+    lock_expires_at TIMESTAMPTZ
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    WITH picked AS (
+        SELECT c.id
+        FROM comments c
+        WHERE c.batch_id = p_batch_id
+        AND c.status = 'unassigned'
+        ORDER BY c.original_index ASC
+        LIMIT p_count
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE comments c
+    SET
+        status = 'claimed',
+        assigned_to = p_user_id::UUID,
+        claimed_at = NOW(),
+        lock_expires_at = NOW() + make_interval(secs => p_lease_seconds)
+    FROM picked
+    WHERE c.id = picked.id
+    RETURNING c.id, c.original_index, c.comment_text, c.lock_expires_at;
+END;
+$$;
+
+-- Extend the leases an active annotator still holds in a batch.
+-- Returns the number of comments renewed; expired leases are not revived.
+CREATE OR REPLACE FUNCTION renew_comment_leases(
+    p_user_id TEXT,
+    p_batch_id UUID,
+    p_lease_seconds INTEGER DEFAULT 1800
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    renewed_count INTEGER;
+BEGIN
+    UPDATE comments
+    SET lock_expires_at = NOW() + make_interval(secs => p_lease_seconds)
+    WHERE batch_id = p_batch_id
+    AND status = 'claimed'
+    AND assigned_to = p_user_id::UUID
+    AND lock_expires_at >= NOW();
+
+    GET DIAGNOSTICS renewed_count = ROW_COUNT;
+    RETURN renewed_count;
+END;
+$$;
+
+-- Claim probes only ever look at unassigned rows, and the sweeper only at
+-- claimed ones, so both indexes are partial and stay small as the table grows.
+CREATE INDEX IF NOT EXISTS comments_unassigned_claim_idx
+    ON comments (batch_id, status, original_index)
+    WHERE status = 'unassigned';
+
+CREATE INDEX IF NOT EXISTS comments_claimed_expiry_idx
+    ON comments (lock_expires_at)
+    WHERE status = 'claimed';
+
+-- Function to release expired locks, at most p_limit rows per call.
+-- Each call is its own short transaction; run it on a schedule (see below) or
+-- with sweep_locks.py, which repeats it until a call releases less than a chunk.
+DROP FUNCTION IF EXISTS release_expired_locks();
+
+CREATE OR REPLACE FUNCTION release_expired_locks(p_limit INTEGER DEFAULT 1000)
 RETURNS INTEGER
 LANGUAGE plpgsql
 AS $$
 DECLARE
     released_count INTEGER;
 BEGIN
-    UPDATE comments 
+    WITH expired AS (
+        SELECT c.id
+        FROM comments c
+        WHERE c.status = 'claimed'
+        AND c.lock_expires_at < NOW()
+        ORDER BY c.lock_expires_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE comments c
     SET 
         status = 'unassigned',
         assigned_to = NULL,
         claimed_at = NULL,
         lock_expires_at = NULL
-    WHERE status = 'claimed'
-    AND lock_expires_at < NOW();
+    FROM expired
+    WHERE c.id = expired.id;
     
     GET DIAGNOSTICS released_count = ROW_COUNT;
     RETURN released_count;
 END;
 $$;
 
+-- With pg_cron enabled:
+-- SELECT cron.schedule('release-expired-locks', '* * * * *', 'SELECT release_expired_locks(1000)');
+
 -- Grant execute permissions (adjust as needed for your setup)
 -- GRANT EXECUTE ON FUNCTION claim_next_comment_in_batch(TEXT, UUID) TO authenticated;
--- GRANT EXECUTE ON FUNCTION release_expired_locks() TO authenticated;
+-- GRANT EXECUTE ON FUNCTION claim_comments_in_batch(TEXT, UUID, INTEGER, INTEGER) TO authenticated;
+-- GRANT EXECUTE ON FUNCTION renew_comment_leases(TEXT, UUID, INTEGER) TO authenticated;
+-- GRANT EXECUTE ON FUNCTION release_expired_locks(INTEGER) TO authenticated;
+
+-- ---------------------------------------------------------------------------
+-- Batch dashboard
+-- ---------------------------------------------------------------------------
+-- Per-batch annotated counts, kept up to date incrementally by triggers on
+-- annotations so the batch selection screen never has to count rows.
+
+CREATE TABLE IF NOT EXISTS batch_progress (
+    batch_id UUID PRIMARY KEY REFERENCES batches(id) ON DELETE CASCADE,
+    annotated_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS annotations_batch_comment_idx
+    ON annotations (batch_id, comment_id);
+
+-- Statement-level so bulk inserts bump each batch once.
+-- Only the first annotation of a comment within a batch counts as progress.
+CREATE OR REPLACE FUNCTION bump_batch_progress()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO batch_progress AS bp (batch_id, annotated_count)
+    SELECT n.batch_id, COUNT(DISTINCT n.comment_id)
+    FROM new_rows n
+    WHERE n.batch_id IS NOT NULL
+    AND NOT EXISTS (
+        SELECT 1
+        FROM annotations a
+        WHERE a.batch_id = n.batch_id
+        AND a.comment_id = n.comment_id
+        AND NOT EXISTS (SELECT 1 FROM new_rows r WHERE r.id = a.id)
+    )
+    GROUP BY n.batch_id
+    ON CONFLICT (batch_id) DO UPDATE
+    SET annotated_count = bp.annotated_count + EXCLUDED.annotated_count,
+        updated_at = NOW();
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS annotations_bump_batch_progress ON annotations;
+CREATE TRIGGER annotations_bump_batch_progress
+    AFTER INSERT ON annotations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_batch_progress();
+
+-- A comment stops counting as progress when its last annotation in the batch
+-- is deleted. Relabelling does not change which comments are annotated.
+CREATE OR REPLACE FUNCTION drop_batch_progress()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE batch_progress bp
+    SET annotated_count = GREATEST(bp.annotated_count - gone.comment_count, 0),
+        updated_at = NOW()
+    FROM (
+        SELECT o.batch_id, COUNT(DISTINCT o.comment_id) AS comment_count
+        FROM old_rows o
+        WHERE o.batch_id IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1
+            FROM annotations a
+            WHERE a.batch_id = o.batch_id
+            AND a.comment_id = o.comment_id
+        )
+        GROUP BY o.batch_id
+    ) gone
+    WHERE bp.batch_id = gone.batch_id;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS annotations_drop_batch_progress ON annotations;
+CREATE TRIGGER annotations_drop_batch_progress
+    AFTER DELETE ON annotations
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION drop_batch_progress();
+
+-- Recompute the counters from scratch. Run once after creating the table, and
+-- whenever annotations are moved between comments or batches outside the app.
+CREATE OR REPLACE FUNCTION refresh_batch_progress()
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    refreshed_count INTEGER;
+BEGIN
+    INSERT INTO batch_progress AS bp (batch_id, annotated_count)
+    SELECT b.id, COUNT(DISTINCT a.comment_id)
+    FROM batches b
+    LEFT JOIN annotations a ON a.batch_id = b.id
+    GROUP BY b.id
+    ON CONFLICT (batch_id) DO UPDATE
+    SET annotated_count = EXCLUDED.annotated_count,
+        updated_at = NOW();
+
+    GET DIAGNOSTICS refreshed_count = ROW_COUNT;
+    RETURN refreshed_count;
+END;
+$$;
+
+-- Every batch with its annotated count in a single round trip
+CREATE OR REPLACE FUNCTION get_batch_dashboard()
+RETURNS TABLE(
+    id UUID,
+    name TEXT,
+    description TEXT,
+    comment_count INTEGER,
+    annotated_count INTEGER
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT b.id, b.name, b.description, b.comment_count,
+           COALESCE(bp.annotated_count, 0)
+    FROM batches b
+    LEFT JOIN batch_progress bp ON bp.batch_id = b.id
+    ORDER BY b.name;
+$$;
+
+-- SELECT refresh_batch_progress();
+-- GRANT EXECUTE ON FUNCTION get_batch_dashboard() TO authenticated;
+
+-- ---------------------------------------------------------------------------
+-- User statistics
+-- ---------------------------------------------------------------------------
+-- One counters row per annotator, maintained by triggers on insert, update
+-- and delete, so the sidebar reads a single small row instead of every
+-- annotation the user has written. Labels copied to near-duplicates
+-- (propagated_from set, see "Near-duplicate clusters" below) are not anyone's
+-- work and are never counted.
+
+CREATE TABLE IF NOT EXISTS user_annotation_stats (
+    user_id TEXT PRIMARY KEY,
+    total_annotations INTEGER NOT NULL DEFAULT 0,
+    label_counts JSONB NOT NULL DEFAULT '{}'::JSONB,
+    category_counts JSONB NOT NULL DEFAULT '{}'::JSONB,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Add two {key: count} objects together, dropping keys that reach zero
+CREATE OR REPLACE FUNCTION jsonb_sum_counts(a JSONB, b JSONB)
+RETURNS JSONB
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT COALESCE(jsonb_object_agg(key, total), '{}'::JSONB)
+    FROM (
+        SELECT key, SUM(value::INTEGER) AS total
+        FROM (
+            SELECT * FROM jsonb_each_text(COALESCE(a, '{}'::JSONB))
+            UNION ALL
+            SELECT * FROM jsonb_each_text(COALESCE(b, '{}'::JSONB))
+        ) pairs
+        GROUP BY key
+        HAVING SUM(value::INTEGER) <> 0
+    ) sums;
+$$;
+
+-- Add (p_sign = 1) or subtract (p_sign = -1) annotations, given as a JSON
+-- array of {user_id, label, categories}, to the counters.
+CREATE OR REPLACE FUNCTION apply_user_stats_delta(p_rows JSONB, p_sign INTEGER)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    INSERT INTO user_annotation_stats (user_id)
+    SELECT DISTINCT r->>'user_id'
+    FROM jsonb_array_elements(COALESCE(p_rows, '[]'::JSONB)) AS r
+    ON CONFLICT (user_id) DO NOTHING;
+
+    WITH changed AS (
+        SELECT r->>'user_id' AS user_id,
+               COALESCE(r->>'label', 'unknown') AS label,
+               COALESCE(r->'categories', '[]'::JSONB) AS categories
+        FROM jsonb_array_elements(COALESCE(p_rows, '[]'::JSONB)) AS r
+    ), per_user AS (
+        SELECT ch.user_id, COUNT(*) * p_sign AS total
+        FROM changed ch
+        GROUP BY ch.user_id
+    ), labels AS (
+        SELECT l.user_id, jsonb_object_agg(l.label, l.total) AS counts
+        FROM (
+            SELECT ch.user_id, ch.label, COUNT(*) * p_sign AS total
+            FROM changed ch
+            GROUP BY 1, 2
+        ) l
+        GROUP BY l.user_id
+    ), categories AS (
+        SELECT c.user_id, jsonb_object_agg(c.category, c.total) AS counts
+        FROM (
+            SELECT ch.user_id, cat.category, COUNT(*) * p_sign AS total
+            FROM changed ch
+            CROSS JOIN LATERAL jsonb_array_elements_text(ch.categories) AS cat(category)
+            GROUP BY 1, 2
+        ) c
+        GROUP BY c.user_id
+    )
+    UPDATE user_annotation_stats s
+    SET total_annotations = s.total_annotations + p.total,
+        label_counts = jsonb_sum_counts(s.label_counts, l.counts),
+        category_counts = jsonb_sum_counts(s.category_counts, c.counts),
+        updated_at = NOW()
+    FROM per_user p
+    LEFT JOIN labels l ON l.user_id = p.user_id
+    LEFT JOIN categories c ON c.user_id = p.user_id
+    WHERE s.user_id = p.user_id;
+$$;
+
+-- Statement-level, one trigger per event (a trigger with transition tables
+-- can only have one). An update is the old rows out and the new rows in, so
+-- a reviewer relabelling an annotation moves it between label counts.
+CREATE OR REPLACE FUNCTION bump_user_annotation_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_user_stats_delta((
+            SELECT jsonb_agg(jsonb_build_object('user_id', o.user_id, 'label', o.label,
+                                                'categories', to_jsonb(COALESCE(o.categories, '{}'))))
+            FROM old_rows o
+            WHERE o.propagated_from IS NULL
+        ), -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_user_stats_delta((
+            SELECT jsonb_agg(jsonb_build_object('user_id', n.user_id, 'label', n.label,
+                                                'categories', to_jsonb(COALESCE(n.categories, '{}'))))
+            FROM new_rows n
+            WHERE n.propagated_from IS NULL
+        ), 1);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS annotations_bump_user_stats ON annotations;
+CREATE TRIGGER annotations_bump_user_stats
+    AFTER INSERT ON annotations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_user_annotation_stats();
+
+DROP TRIGGER IF EXISTS annotations_bump_user_stats_update ON annotations;
+CREATE TRIGGER annotations_bump_user_stats_update
+    AFTER UPDATE ON annotations
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_user_annotation_stats();
+
+DROP TRIGGER IF EXISTS annotations_bump_user_stats_delete ON annotations;
+CREATE TRIGGER annotations_bump_user_stats_delete
+    AFTER DELETE ON annotations
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_user_annotation_stats();
+
+-- Rebuild every user's counters from the annotations table
+CREATE OR REPLACE FUNCTION refresh_user_annotation_stats()
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    refreshed_count INTEGER;
+BEGIN
+    TRUNCATE user_annotation_stats;
+
+    WITH own AS (
+        SELECT a.user_id, a.label, a.categories
+        FROM annotations a
+        WHERE a.propagated_from IS NULL
+    ), per_user AS (
+        SELECT o.user_id, COUNT(*) AS total
+        FROM own o
+        GROUP BY o.user_id
+    ), labels AS (
+        SELECT l.user_id, jsonb_object_agg(l.label, l.total) AS counts
+        FROM (
+            SELECT o.user_id, COALESCE(o.label, 'unknown') AS label, COUNT(*) AS total
+            FROM own o
+            GROUP BY 1, 2
+        ) l
+        GROUP BY l.user_id
+    ), categories AS (
+        SELECT c.user_id, jsonb_object_agg(c.category, c.total) AS counts
+        FROM (
+            SELECT o.user_id, cat.category, COUNT(*) AS total
+            FROM own o
+            CROSS JOIN LATERAL unnest(o.categories) AS cat(category)
+            GROUP BY 1, 2
+        ) c
+        GROUP BY c.user_id
+    )
+    INSERT INTO user_annotation_stats (user_id, total_annotations, label_counts, category_counts)
+    SELECT p.user_id, p.total, COALESCE(l.counts, '{}'::JSONB), COALESCE(c.counts, '{}'::JSONB)
+    FROM per_user p
+    LEFT JOIN labels l ON l.user_id = p.user_id
+    LEFT JOIN categories c ON c.user_id = p.user_id;
+
+    GET DIAGNOSTICS refreshed_count = ROW_COUNT;
+    RETURN refreshed_count;
+END;
+$$;
+
+-- Run once after upgrading: it also drops the counters row earlier versions
+-- kept for near-duplicate-propagation.
+-- SELECT refresh_user_annotation_stats();
+
+-- ---------------------------------------------------------------------------
+-- Write-behind idempotency
+-- ---------------------------------------------------------------------------
+-- Annotations flushed from the local journal carry a client-generated key;
+-- the bulk insert uses ON CONFLICT (idempotency_key) DO NOTHING so replays are
+-- harmless. Rows saved directly leave it NULL.
+
+ALTER TABLE annotations ADD COLUMN IF NOT EXISTS idempotency_key UUID;
+
+CREATE UNIQUE INDEX IF NOT EXISTS annotations_idempotency_key_idx
+    ON annotations (idempotency_key);
+
+-- ---------------------------------------------------------------------------
+-- Next-section reservations (prefetch)
+-- ---------------------------------------------------------------------------
+-- While an annotator finishes a section, the app reserves the following one so
+-- its comments can be downloaded in the background. A section counts as taken
+-- when a section_assignments row or a live reservation points at it, and
+-- assign_section_to_user (see "Section map" below) skips reserved sections
+-- too. Unused reservations are released by the app, and expire on their own
+-- if a session simply disappears.
+--
+-- section_assignments keeps one row per assigned section, never overwritten,
+-- so a finished section stays taken; a user's current section in a batch is
+-- their most recent row. Tables created with a unique (batch_id, user_id)
+-- constraint must drop it first, and the unique index below fails if a
+-- section has already been handed out twice; resolve those rows before
+-- creating it.
+
+ALTER TABLE section_assignments
+    ADD COLUMN IF NOT EXISTS assigned_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+CREATE UNIQUE INDEX IF NOT EXISTS section_assignments_section_idx
+    ON section_assignments (batch_id, assigned_section_number);
+
+CREATE INDEX IF NOT EXISTS section_assignments_user_idx
+    ON section_assignments (batch_id, user_id, assigned_at DESC);
+
+CREATE TABLE IF NOT EXISTS section_reservations (
+    batch_id UUID NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+    user_id TEXT NOT NULL,
+    section_number INTEGER NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (batch_id, user_id)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS section_reservations_section_idx
+    ON section_reservations (batch_id, section_number);
+
+-- Number of sections in a batch. Uses the section map (see build_batch_sections)
+-- and falls back to ten sections, or one for tiny batches, if it is not built yet.
+-- plpgsql so the body is only resolved when called: batch_sections is created
+-- further down, in the "Section map" part.
+CREATE OR REPLACE FUNCTION section_count_for_batch(p_batch_id UUID)
+RETURNS INTEGER
+LANGUAGE plpgsql
+STABLE
+AS $$
+BEGIN
+    RETURN COALESCE(
+        (SELECT MAX(bs.section_number) FROM batch_sections bs WHERE bs.batch_id = p_batch_id),
+        (SELECT CASE WHEN b.comment_count < 10 THEN 1 ELSE 10 END FROM batches b WHERE b.id = p_batch_id)
+    );
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION reserve_next_section(
+    p_batch_id UUID,
+    p_user_id TEXT,
+    p_ttl INTERVAL DEFAULT '2 hours'
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    reserved_section INTEGER;
+BEGIN
+    -- Serialize reservations within a batch
+    PERFORM pg_advisory_xact_lock(hashtext(p_batch_id::TEXT));
+
+    DELETE FROM section_reservations
+    WHERE batch_id = p_batch_id
+    AND expires_at < NOW();
+
+    -- Re-use (and extend) a reservation this user already holds
+    UPDATE section_reservations
+    SET expires_at = NOW() + p_ttl
+    WHERE batch_id = p_batch_id
+    AND user_id = p_user_id
+    RETURNING section_number INTO reserved_section;
+
+    IF reserved_section IS NOT NULL THEN
+        RETURN reserved_section;
+    END IF;
+
+    SELECT s.n INTO reserved_section
+    FROM generate_series(1, COALESCE(section_count_for_batch(p_batch_id), 0)) AS s(n)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM section_assignments sa
+        WHERE sa.batch_id = p_batch_id
+        AND sa.assigned_section_number = s.n
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM section_reservations r
+        WHERE r.batch_id = p_batch_id
+        AND r.section_number = s.n
+    )
+    ORDER BY s.n
+    LIMIT 1;
+
+    IF reserved_section IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO section_reservations (batch_id, user_id, section_number, expires_at)
+    VALUES (p_batch_id, p_user_id, reserved_section, NOW() + p_ttl);
+
+    RETURN reserved_section;
+END;
+$$;
+
+-- Turn a live reservation into the user's current assignment for the batch.
+-- The section gets a row of its own; the rows of earlier sections are kept.
+-- Returns the same shape as assign_section_to_user, or no rows if the
+-- reservation expired.
+CREATE OR REPLACE FUNCTION claim_section_reservation(
+    p_batch_id UUID,
+    p_user_id TEXT
+)
+RETURNS TABLE(
+    assigned_section_number INTEGER,
+    saved_progress_index INTEGER
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    reserved_section INTEGER;
+BEGIN
+    DELETE FROM section_reservations r
+    WHERE r.batch_id = p_batch_id
+    AND r.user_id = p_user_id
+    AND r.expires_at >= NOW()
+    RETURNING r.section_number INTO reserved_section;
+
+    IF reserved_section IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO section_assignments (batch_id, user_id, assigned_section_number, progress_index, assigned_at)
+    VALUES (p_batch_id, p_user_id, reserved_section, 0, NOW());
+
+    RETURN QUERY SELECT reserved_section, 0;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION release_section_reservation(
+    p_batch_id UUID,
+    p_user_id TEXT
+)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    DELETE FROM section_reservations
+    WHERE batch_id = p_batch_id
+    AND user_id = p_user_id;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Bulk ingestion (ingest.py)
+-- ---------------------------------------------------------------------------
+-- Comments are deduplicated on the SHA-256 of their stripped text. Backfill
+-- existing rows before creating the unique index; it fails if the table
+-- already holds duplicate texts.
+
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS text_hash TEXT;
+
+UPDATE comments
+SET text_hash = encode(sha256(convert_to(btrim(comment_text, E' \t\r\n\f\v'), 'UTF8')), 'hex')
+WHERE text_hash IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS comments_text_hash_idx ON comments (text_hash);
+
+-- Which of p_hashes are already stored, and in which batch. ingest.py asks
+-- before numbering a chunk, so texts loaded earlier (by another corpus or
+-- the app) never take an original_index or a place in a batch.
+CREATE OR REPLACE FUNCTION existing_comment_hashes(p_hashes TEXT[])
+RETURNS TABLE(
+    text_hash TEXT,
+    batch_id UUID
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT c.text_hash, c.batch_id
+    FROM comments c
+    WHERE c.text_hash = ANY(p_hashes);
+$$;
+
+-- Insert one chunk of comments into a batch in a single transaction.
+-- p_comments is a JSON array of {id, comment_text, original_index, text_hash}.
+-- Texts already present are skipped, and batches.comment_count grows by the
+-- number of comments actually linked, so replaying a chunk changes nothing.
+-- Returns the number of comments linked.
+CREATE OR REPLACE FUNCTION ingest_comment_chunk(
+    p_batch_id UUID,
+    p_comments JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    linked_count INTEGER;
+BEGIN
+    WITH inserted AS (
+        INSERT INTO comments (id, comment_text, original_index, text_hash, batch_id)
+        SELECT (c->>'id')::UUID, c->>'comment_text', (c->>'original_index')::INTEGER, c->>'text_hash', p_batch_id
+        FROM jsonb_array_elements(p_comments) AS c
+        ON CONFLICT (text_hash) DO NOTHING
+        RETURNING id
+    ), linked AS (
+        INSERT INTO comment_batches (batch_id, comment_id)
+        SELECT p_batch_id, inserted.id
+        FROM inserted
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO linked_count FROM linked;
+
+    UPDATE batches
+    SET comment_count = COALESCE(comment_count, 0) + linked_count
+    WHERE id = p_batch_id;
+
+    RETURN linked_count;
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Section map
+-- ---------------------------------------------------------------------------
+-- Each batch is split into sections once: comment_batches.section_number
+-- records which section a comment belongs to and section_position its place in
+-- the batch's serving order, and batch_sections keeps the serving-order bounds,
+-- the smallest and largest original_index and the size of every section.
+-- Fetching a section is an indexed lookup on (batch_id, section_number)
+-- instead of OFFSET paging, and the remainder of an uneven split becomes a
+-- final, smaller section.
+-- assign_section_to_user hands out every section of the map, that final one
+-- included, and knows a section is finished from its own comment_count.
+
+ALTER TABLE comment_batches ADD COLUMN IF NOT EXISTS section_number INTEGER;
+ALTER TABLE comment_batches ADD COLUMN IF NOT EXISTS section_position INTEGER;
+
+CREATE INDEX IF NOT EXISTS comment_batches_section_idx
+    ON comment_batches (batch_id, section_number);
+
+CREATE TABLE IF NOT EXISTS batch_sections (
+    batch_id UUID NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+    section_number INTEGER NOT NULL,
+    first_original_index INTEGER NOT NULL,
+    last_original_index INTEGER NOT NULL,
+    comment_count INTEGER NOT NULL,
+    PRIMARY KEY (batch_id, section_number)
+);
+
+ALTER TABLE batch_sections ADD COLUMN IF NOT EXISTS first_position INTEGER;
+ALTER TABLE batch_sections ADD COLUMN IF NOT EXISTS last_position INTEGER;
+
+-- (Re)build the section map of a batch. p_section_size defaults to a tenth of
+-- the batch (the whole batch if it has fewer than ten comments). Comments go
+-- in original_index order, or with p_order => 'uncertainty' most uncertain
+-- first according to comment_scores (see active_learning.py); sections are
+-- handed out in number order and served in position order, so the most
+-- uncertain comments are the first ones annotated. Rebuilding a
+-- batch that is already being annotated moves comments between sections, so
+-- only do that before work starts. Returns the number of sections.
+DROP FUNCTION IF EXISTS build_batch_sections(UUID, INTEGER);
+
+CREATE OR REPLACE FUNCTION build_batch_sections(
+    p_batch_id UUID,
+    p_section_size INTEGER DEFAULT NULL,
+    p_order TEXT DEFAULT 'original'
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    total_comments INTEGER;
+    section_size INTEGER;
+    built_sections INTEGER;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('sections:' || p_batch_id::TEXT));
+
+    SELECT COUNT(*) INTO total_comments
+    FROM comment_batches cb
+    WHERE cb.batch_id = p_batch_id
+    AND NOT EXISTS (SELECT 1 FROM comment_clusters cc WHERE cc.comment_id = cb.comment_id);
+
+    section_size := COALESCE(
+        p_section_size,
+        CASE WHEN total_comments < 10 THEN GREATEST(total_comments, 1) ELSE total_comments / 10 END
+    );
+
+    -- Near-duplicate cluster members (see comment_clusters below) are never
+    -- served; they receive their leader's label instead.
+    UPDATE comment_batches cb
+    SET section_number = NULL,
+        section_position = NULL
+    WHERE cb.batch_id = p_batch_id
+    AND cb.section_number IS NOT NULL;
+
+    WITH ordered AS (
+        SELECT cb.comment_id,
+               ROW_NUMBER() OVER (
+                   ORDER BY CASE WHEN p_order = 'uncertainty' THEN s.uncertainty END DESC NULLS LAST,
+                            c.original_index, c.id
+               ) - 1 AS position
+        FROM comment_batches cb
+        JOIN comments c ON c.id = cb.comment_id
+        LEFT JOIN comment_scores s ON s.comment_id = cb.comment_id
+        WHERE cb.batch_id = p_batch_id
+        AND NOT EXISTS (SELECT 1 FROM comment_clusters cc WHERE cc.comment_id = cb.comment_id)
+    )
+    UPDATE comment_batches cb
+    SET section_number = o.position / section_size + 1,
+        section_position = o.position
+    FROM ordered o
+    WHERE cb.batch_id = p_batch_id
+    AND cb.comment_id = o.comment_id;
+
+    DELETE FROM batch_sections bs WHERE bs.batch_id = p_batch_id;
+
+    INSERT INTO batch_sections (
+        batch_id, section_number, first_original_index, last_original_index, comment_count,
+        first_position, last_position
+    )
+    SELECT cb.batch_id, cb.section_number, MIN(c.original_index), MAX(c.original_index), COUNT(*),
+           MIN(cb.section_position), MAX(cb.section_position)
+    FROM comment_batches cb
+    JOIN comments c ON c.id = cb.comment_id
+    WHERE cb.batch_id = p_batch_id
+    AND cb.section_number IS NOT NULL
+    GROUP BY cb.batch_id, cb.section_number;
+
+    GET DIAGNOSTICS built_sections = ROW_COUNT;
+    RETURN built_sections;
+END;
+$$;
+
+-- Comments of one section in serving order (original_index for maps built
+-- before section_position existed), with the suggestion model's cached hate
+-- probability if the comment has been scored. Builds the batch's section map
+-- on first use.
+DROP FUNCTION IF EXISTS get_section_comments(UUID, INTEGER);
+
+CREATE OR REPLACE FUNCTION get_section_comments(
+    p_batch_id UUID,
+    p_section_number INTEGER
+)
+RETURNS TABLE(
+    id UUID,
+    comment_text TEXT,
+    original_index INTEGER,
+    hate_probability REAL
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM batch_sections bs WHERE bs.batch_id = p_batch_id) THEN
+        PERFORM build_batch_sections(p_batch_id);
+    END IF;
+
+    RETURN QUERY
+    SELECT c.id, c.comment_text, c.original_index, s.hate_probability
+    FROM comment_batches cb
+    JOIN comments c ON c.id = cb.comment_id
+    LEFT JOIN comment_scores s ON s.comment_id = cb.comment_id
+    WHERE cb.batch_id = p_batch_id
+    AND cb.section_number = p_section_number
+    ORDER BY cb.section_position, c.original_index;
+END;
+$$;
+
+-- The user's current section of the batch while it has comments left,
+-- otherwise the first section nobody has been assigned or has reserved.
+-- Returns no rows when every section is taken.
+DROP FUNCTION IF EXISTS assign_section_to_user(UUID, TEXT);
+
+CREATE OR REPLACE FUNCTION assign_section_to_user(
+    p_batch_id UUID,
+    p_user_id TEXT
+)
+RETURNS TABLE(
+    assigned_section_number INTEGER,
+    saved_progress_index INTEGER
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    current_section INTEGER;
+    current_progress INTEGER;
+    free_section INTEGER;
+BEGIN
+    -- Same lock as reserve_next_section, so the two never pick the same section
+    PERFORM pg_advisory_xact_lock(hashtext(p_batch_id::TEXT));
+
+    IF NOT EXISTS (SELECT 1 FROM batch_sections bs WHERE bs.batch_id = p_batch_id) THEN
+        PERFORM build_batch_sections(p_batch_id);
+    END IF;
+
+    SELECT sa.assigned_section_number, sa.progress_index
+    INTO current_section, current_progress
+    FROM section_assignments sa
+    WHERE sa.batch_id = p_batch_id
+    AND sa.user_id = p_user_id
+    ORDER BY sa.assigned_at DESC
+    LIMIT 1;
+
+    IF current_section IS NOT NULL AND current_progress < (
+        SELECT bs.comment_count FROM batch_sections bs
+        WHERE bs.batch_id = p_batch_id
+        AND bs.section_number = current_section
+    ) THEN
+        RETURN QUERY SELECT current_section, current_progress;
+        RETURN;
+    END IF;
+
+    SELECT bs.section_number INTO free_section
+    FROM batch_sections bs
+    WHERE bs.batch_id = p_batch_id
+    AND NOT EXISTS (
+        SELECT 1 FROM section_assignments sa
+        WHERE sa.batch_id = p_batch_id
+        AND sa.assigned_section_number = bs.section_number
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM section_reservations r
+        WHERE r.batch_id = p_batch_id
+        AND r.section_number = bs.section_number
+        AND r.expires_at >= NOW()
+    )
+    ORDER BY bs.section_number
+    LIMIT 1;
+
+    IF free_section IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO section_assignments (batch_id, user_id, assigned_section_number, progress_index, assigned_at)
+    VALUES (p_batch_id, p_user_id, free_section, 0, NOW());
+
+    RETURN QUERY SELECT free_section, 0;
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Near-duplicate clusters (dedup.py)
+-- ---------------------------------------------------------------------------
+-- dedup.py groups near-duplicate comments into clusters led by the first
+-- comment seen; comment_clusters has one row per member (leaders have none).
+-- Members are left out of the section map, and the first annotation of a
+-- leader is copied to all of its members in one statement. Copies are written
+-- by the near-duplicate-propagation user and point at the source annotation
+-- through propagated_from; a reviewer can override a copy, which records them
+-- in overridden_by.
+--
+-- Build a batch's sections after its clusters are written (ingest.py does);
+-- comments clustered later stay in their sections and are annotated normally.
+
+CREATE TABLE IF NOT EXISTS comment_clusters (
+    comment_id UUID PRIMARY KEY REFERENCES comments(id) ON DELETE CASCADE,
+    leader_id UUID NOT NULL REFERENCES comments(id) ON DELETE CASCADE,
+    similarity REAL NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS comment_clusters_leader_idx ON comment_clusters (leader_id);
+
+ALTER TABLE annotations ADD COLUMN IF NOT EXISTS propagated_from UUID REFERENCES annotations(id) ON DELETE CASCADE;
+ALTER TABLE annotations ADD COLUMN IF NOT EXISTS overridden_by TEXT;
+
+-- At most one copied label per comment
+CREATE UNIQUE INDEX IF NOT EXISTS annotations_propagated_comment_idx
+    ON annotations (comment_id) WHERE propagated_from IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS annotations_comment_idx ON annotations (comment_id);
+
+-- Copy leader labels to members that have no annotation yet. p_leader_ids
+-- limits the work to some clusters (NULL = all). Returns the rows written.
+CREATE OR REPLACE FUNCTION propagate_cluster_labels(p_leader_ids UUID[] DEFAULT NULL)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    propagated_count INTEGER;
+BEGIN
+    INSERT INTO annotations (comment_id, batch_id, user_id, label, categories, notes, propagated_from)
+    SELECT cc.comment_id, member_batch.batch_id, 'near-duplicate-propagation',
+           source.label, source.categories, '', source.id
+    FROM comment_clusters cc
+    JOIN LATERAL (
+        SELECT a.id, a.label, a.categories
+        FROM annotations a
+        WHERE a.comment_id = cc.leader_id
+        AND a.propagated_from IS NULL
+        ORDER BY a.created_at, a.id
+        LIMIT 1
+    ) source ON TRUE
+    JOIN LATERAL (
+        SELECT cb.batch_id
+        FROM comment_batches cb
+        WHERE cb.comment_id = cc.comment_id
+        LIMIT 1
+    ) member_batch ON TRUE
+    WHERE (p_leader_ids IS NULL OR cc.leader_id = ANY(p_leader_ids))
+    AND NOT EXISTS (SELECT 1 FROM annotations a WHERE a.comment_id = cc.comment_id)
+    ON CONFLICT (comment_id) WHERE propagated_from IS NOT NULL DO NOTHING;
+
+    GET DIAGNOSTICS propagated_count = ROW_COUNT;
+    RETURN propagated_count;
+END;
+$$;
+
+-- Statement-level: a bulk flush of annotations propagates all of its leaders
+-- at once. Copies have propagated_from set, so they do not recurse.
+CREATE OR REPLACE FUNCTION propagate_new_leader_labels()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    leader_ids UUID[];
+BEGIN
+    SELECT array_agg(DISTINCT n.comment_id) INTO leader_ids
+    FROM new_rows n
+    WHERE n.propagated_from IS NULL
+    AND EXISTS (SELECT 1 FROM comment_clusters cc WHERE cc.leader_id = n.comment_id);
+
+    IF leader_ids IS NOT NULL THEN
+        PERFORM propagate_cluster_labels(leader_ids);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS annotations_propagate_cluster_labels ON annotations;
+CREATE TRIGGER annotations_propagate_cluster_labels
+    AFTER INSERT ON annotations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION propagate_new_leader_labels();
+
+-- Record cluster members from dedup.py. p_clusters is a JSON array of
+-- {comment_id, leader_id, similarity}; known members are skipped, and leaders
+-- that are already annotated pass their label on right away.
+-- Returns the number of new members.
+CREATE OR REPLACE FUNCTION add_comment_clusters(p_clusters JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    added_count INTEGER;
+    leader_ids UUID[];
+BEGIN
+    WITH added AS (
+        INSERT INTO comment_clusters (comment_id, leader_id, similarity)
+        SELECT (c->>'comment_id')::UUID, (c->>'leader_id')::UUID, (c->>'similarity')::REAL
+        FROM jsonb_array_elements(p_clusters) AS c
+        ON CONFLICT (comment_id) DO NOTHING
+        RETURNING leader_id
+    )
+    SELECT COUNT(*), array_agg(DISTINCT leader_id) INTO added_count, leader_ids FROM added;
+
+    IF leader_ids IS NOT NULL THEN
+        PERFORM propagate_cluster_labels(leader_ids);
+    END IF;
+    RETURN added_count;
+END;
+$$;
+
+-- Members for review, least similar first. p_unreviewed_only hides copies a
+-- reviewer has already overridden.
+CREATE OR REPLACE FUNCTION list_cluster_members(
+    p_limit INTEGER DEFAULT 50,
+    p_unreviewed_only BOOLEAN DEFAULT TRUE
+)
+RETURNS TABLE(
+    comment_id UUID,
+    comment_text TEXT,
+    leader_id UUID,
+    leader_text TEXT,
+    similarity REAL,
+    label TEXT,
+    categories TEXT[],
+    overridden_by TEXT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT cc.comment_id, member.comment_text, cc.leader_id, leader.comment_text, cc.similarity,
+           copied.label, copied.categories, copied.overridden_by
+    FROM comment_clusters cc
+    JOIN comments member ON member.id = cc.comment_id
+    JOIN comments leader ON leader.id = cc.leader_id
+    LEFT JOIN annotations copied ON copied.comment_id = cc.comment_id AND copied.propagated_from IS NOT NULL
+    WHERE NOT p_unreviewed_only OR copied.overridden_by IS NULL
+    ORDER BY cc.similarity, cc.comment_id
+    LIMIT p_limit;
+$$;
+
+-- Replace the label copied to a member. Returns FALSE if nothing has been
+-- copied yet (the leader is not annotated).
+CREATE OR REPLACE FUNCTION override_propagated_label(
+    p_comment_id UUID,
+    p_label TEXT,
+    p_categories TEXT[],
+    p_reviewer TEXT
+)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE annotations
+    SET label = p_label,
+        categories = p_categories,
+        overridden_by = p_reviewer
+    WHERE comment_id = p_comment_id
+    AND propagated_from IS NOT NULL;
+    RETURN FOUND;
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Suggestion scores (active_learning.py)
+-- ---------------------------------------------------------------------------
+-- Latest prediction of the local suggestion model per comment. model_version
+-- is a hash of the model's weights: scoring skips comments that already have
+-- a score from the current version. uncertainty is 1 at p = 0.5 and 0 at
+-- p = 0 or 1, and orders sections built with p_order => 'uncertainty'.
+
+CREATE TABLE IF NOT EXISTS comment_scores (
+    comment_id UUID PRIMARY KEY REFERENCES comments(id) ON DELETE CASCADE,
+    model_version TEXT NOT NULL,
+    hate_probability REAL NOT NULL,
+    uncertainty REAL GENERATED ALWAYS AS (1 - ABS(2 * hate_probability - 1)) STORED,
+    scored_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Next page of a batch's unannotated comments without a score from
+-- p_model_version, keyset-paginated on (original_index, id).
+CREATE OR REPLACE FUNCTION get_unscored_comments(
+    p_batch_id UUID,
+    p_model_version TEXT,
+    p_after_index INTEGER DEFAULT -1,
+    p_after_id UUID DEFAULT NULL,
+    p_limit INTEGER DEFAULT 1000
+)
+RETURNS TABLE(
+    id UUID,
+    comment_text TEXT,
+    original_index INTEGER
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT c.id, c.comment_text, c.original_index
+    FROM comment_batches cb
+    JOIN comments c ON c.id = cb.comment_id
+    LEFT JOIN comment_scores s ON s.comment_id = c.id
+    WHERE cb.batch_id = p_batch_id
+    AND (c.original_index, c.id) > (p_after_index, COALESCE(p_after_id, '00000000-0000-0000-0000-000000000000'::UUID))
+    AND (s.comment_id IS NULL OR s.model_version <> p_model_version)
+    AND NOT EXISTS (SELECT 1 FROM annotations a WHERE a.comment_id = c.id)
+    ORDER BY c.original_index, c.id
+    LIMIT p_limit;
+$$;
+
+-- Store one page of scores. p_scores is a JSON array of
+-- {comment_id, hate_probability}. Returns the number of rows written.
+CREATE OR REPLACE FUNCTION upsert_comment_scores(
+    p_model_version TEXT,
+    p_scores JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    written_count INTEGER;
+BEGIN
+    INSERT INTO comment_scores (comment_id, model_version, hate_probability)
+    SELECT (sc->>'comment_id')::UUID, p_model_version, (sc->>'hate_probability')::REAL
+    FROM jsonb_array_elements(p_scores) AS sc
+    ON CONFLICT (comment_id) DO UPDATE
+    SET model_version = EXCLUDED.model_version,
+        hate_probability = EXCLUDED.hate_probability,
+        scored_at = NOW();
+
+    GET DIAGNOSTICS written_count = ROW_COUNT;
+    RETURN written_count;
+END;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Throughput analytics
+-- ---------------------------------------------------------------------------
+-- "Skip For Now" is recorded in skip_events, and annotations and skips carry
+-- duration_ms, the time the comment was on screen (NULL when the annotator
+-- apparently stepped away). Statement-level triggers fold every insert into
+-- throughput_hourly, one row per (hour, batch, annotator, label); skips are
+-- counted on the row with label ''. Work done offline (see "Offline section
+-- packs" below) counts in the hour it was done, not the hour it was uploaded.
+-- Copies made by propagate_cluster_labels are not annotator work and are left
+-- out. The admin dashboard reads only
+-- this table, batches and batch_progress.
+
+CREATE TABLE IF NOT EXISTS skip_events (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    comment_id UUID NOT NULL REFERENCES comments(id) ON DELETE CASCADE,
+    batch_id UUID REFERENCES batches(id) ON DELETE CASCADE,
+    user_id TEXT NOT NULL,
+    duration_ms INTEGER,
+    idempotency_key UUID UNIQUE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE annotations ADD COLUMN IF NOT EXISTS duration_ms INTEGER;
+
+CREATE TABLE IF NOT EXISTS throughput_hourly (
+    hour TIMESTAMPTZ NOT NULL,
+    batch_id UUID NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+    user_id TEXT NOT NULL,
+    label TEXT NOT NULL,
+    annotations INTEGER NOT NULL DEFAULT 0,
+    skips INTEGER NOT NULL DEFAULT 0,
+    timed_events INTEGER NOT NULL DEFAULT 0,
+    total_duration_ms BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, batch_id, user_id, label)
+);
+
+CREATE INDEX IF NOT EXISTS throughput_hourly_batch_idx ON throughput_hourly (batch_id, hour);
+
+CREATE OR REPLACE FUNCTION bump_throughput_from_annotations()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO throughput_hourly AS t (hour, batch_id, user_id, label, annotations, timed_events, total_duration_ms)
+    SELECT date_trunc('hour', COALESCE(n.offline_at, n.created_at)), n.batch_id, n.user_id,
+           COALESCE(n.label, 'unknown'),
+           COUNT(*), COUNT(n.duration_ms), COALESCE(SUM(n.duration_ms), 0)
+    FROM new_rows n
+    WHERE n.batch_id IS NOT NULL
+    AND n.propagated_from IS NULL
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (hour, batch_id, user_id, label) DO UPDATE
+    SET annotations = t.annotations + EXCLUDED.annotations,
+        timed_events = t.timed_events + EXCLUDED.timed_events,
+        total_duration_ms = t.total_duration_ms + EXCLUDED.total_duration_ms;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS annotations_bump_throughput ON annotations;
+CREATE TRIGGER annotations_bump_throughput
+    AFTER INSERT ON annotations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_throughput_from_annotations();
+
+CREATE OR REPLACE FUNCTION bump_throughput_from_skips()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO throughput_hourly AS t (hour, batch_id, user_id, label, skips, timed_events, total_duration_ms)
+    SELECT date_trunc('hour', COALESCE(n.offline_at, n.created_at)), n.batch_id, n.user_id, '',
+           COUNT(*), COUNT(n.duration_ms), COALESCE(SUM(n.duration_ms), 0)
+    FROM new_rows n
+    WHERE n.batch_id IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT (hour, batch_id, user_id, label) DO UPDATE
+    SET skips = t.skips + EXCLUDED.skips,
+        timed_events = t.timed_events + EXCLUDED.timed_events,
+        total_duration_ms = t.total_duration_ms + EXCLUDED.total_duration_ms;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS skip_events_bump_throughput ON skip_events;
+CREATE TRIGGER skip_events_bump_throughput
+    AFTER INSERT ON skip_events
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_throughput_from_skips();
+
+-- Comments annotated for the first time in their batch, per hour. A comment
+-- labelled by several annotators is progress only once, so completion is
+-- projected from this rather than from the annotation counts above.
+CREATE TABLE IF NOT EXISTS batch_progress_hourly (
+    hour TIMESTAMPTZ NOT NULL,
+    batch_id UUID NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+    newly_annotated INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (batch_id, hour)
+);
+
+CREATE OR REPLACE FUNCTION bump_batch_progress_hourly()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO batch_progress_hourly AS h (hour, batch_id, newly_annotated)
+    SELECT date_trunc('hour', NOW()), n.batch_id, COUNT(DISTINCT n.comment_id)
+    FROM new_rows n
+    WHERE n.batch_id IS NOT NULL
+    AND NOT EXISTS (
+        SELECT 1
+        FROM annotations a
+        WHERE a.batch_id = n.batch_id
+        AND a.comment_id = n.comment_id
+        AND NOT EXISTS (SELECT 1 FROM new_rows r WHERE r.id = a.id)
+    )
+    GROUP BY n.batch_id
+    ON CONFLICT (batch_id, hour) DO UPDATE
+    SET newly_annotated = h.newly_annotated + EXCLUDED.newly_annotated;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS annotations_bump_batch_progress_hourly ON annotations;
+CREATE TRIGGER annotations_bump_batch_progress_hourly
+    AFTER INSERT ON annotations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_batch_progress_hourly();
+
+-- Rebuild the rollups from scratch, e.g. after annotations were deleted or
+-- edited outside the app. Returns the number of throughput_hourly rows.
+CREATE OR REPLACE FUNCTION refresh_throughput_rollups()
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    refreshed_count INTEGER;
+BEGIN
+    TRUNCATE throughput_hourly;
+
+    INSERT INTO throughput_hourly (hour, batch_id, user_id, label, annotations, skips, timed_events, total_duration_ms)
+    SELECT e.hour, e.batch_id, e.user_id, e.label,
+           SUM(e.annotations), SUM(e.skips), SUM(e.timed_events), SUM(e.total_duration_ms)
+    FROM (
+        SELECT date_trunc('hour', COALESCE(a.offline_at, a.created_at)) AS hour, a.batch_id, a.user_id,
+               COALESCE(a.label, 'unknown') AS label, 1 AS annotations, 0 AS skips,
+               (a.duration_ms IS NOT NULL)::INTEGER AS timed_events, COALESCE(a.duration_ms, 0) AS total_duration_ms
+        FROM annotations a
+        WHERE a.batch_id IS NOT NULL
+        AND a.propagated_from IS NULL
+        UNION ALL
+        SELECT date_trunc('hour', COALESCE(s.offline_at, s.created_at)), s.batch_id, s.user_id, '', 0, 1,
+               (s.duration_ms IS NOT NULL)::INTEGER, COALESCE(s.duration_ms, 0)
+        FROM skip_events s
+        WHERE s.batch_id IS NOT NULL
+    ) e
+    GROUP BY 1, 2, 3, 4;
+
+    GET DIAGNOSTICS refreshed_count = ROW_COUNT;
+
+    TRUNCATE batch_progress_hourly;
+
+    INSERT INTO batch_progress_hourly (hour, batch_id, newly_annotated)
+    SELECT date_trunc('hour', f.first_at), f.batch_id, COUNT(*)
+    FROM (
+        SELECT a.batch_id, a.comment_id, MIN(a.created_at) AS first_at
+        FROM annotations a
+        WHERE a.batch_id IS NOT NULL
+        GROUP BY a.batch_id, a.comment_id
+    ) f
+    GROUP BY 1, 2;
+
+    RETURN refreshed_count;
+END;
+$$;
+
+-- Rollup rows since p_since, optionally for one batch
+CREATE OR REPLACE FUNCTION get_throughput(
+    p_since TIMESTAMPTZ,
+    p_batch_id UUID DEFAULT NULL
+)
+RETURNS SETOF throughput_hourly
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT *
+    FROM throughput_hourly t
+    WHERE t.hour >= date_trunc('hour', p_since)
+    AND (p_batch_id IS NULL OR t.batch_id = p_batch_id)
+    ORDER BY t.hour;
+$$;
+
+-- Remaining work per batch and the number of comments newly annotated over
+-- the last p_window_hours, for projecting completion.
+DROP FUNCTION IF EXISTS get_batch_projections(INTEGER);
+
+CREATE OR REPLACE FUNCTION get_batch_projections(p_window_hours INTEGER DEFAULT 24)
+RETURNS TABLE(
+    id UUID,
+    name TEXT,
+    comment_count INTEGER,
+    annotated_count INTEGER,
+    recent_annotated BIGINT,
+    window_hours INTEGER
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT b.id, b.name, b.comment_count, COALESCE(bp.annotated_count, 0),
+           COALESCE(recent.total, 0), p_window_hours
+    FROM batches b
+    LEFT JOIN batch_progress bp ON bp.batch_id = b.id
+    LEFT JOIN (
+        SELECT h.batch_id, SUM(h.newly_annotated) AS total
+        FROM batch_progress_hourly h
+        WHERE h.hour >= date_trunc('hour', NOW()) - make_interval(hours => p_window_hours)
+        GROUP BY h.batch_id
+    ) recent ON recent.batch_id = b.id
+    ORDER BY b.name;
+$$;
+
+-- SELECT refresh_throughput_rollups();
+
+-- ---------------------------------------------------------------------------
+-- Offline section packs
+-- ---------------------------------------------------------------------------
+-- section_pack.py exports an assigned section to a file that is annotated
+-- without a connection. import_section_pack loads the results in one
+-- transaction: annotations and skips whose idempotency_key is already stored,
+-- and annotations of comments the user has already labelled, are ignored, so
+-- a pack can be uploaded again safely. Only comments of the packed section are
+-- accepted. The packed section's progress_index only moves forward.
+--
+-- Imported rows get created_at = NOW() like any other save, so --since-last
+-- exports and incremental agreement refreshes, which read rows created after
+-- their watermark, pick them up. The time the comment was handled offline is
+-- kept in offline_at (NULL for rows saved online).
+
+ALTER TABLE annotations ADD COLUMN IF NOT EXISTS offline_at TIMESTAMPTZ;
+ALTER TABLE skip_events ADD COLUMN IF NOT EXISTS offline_at TIMESTAMPTZ;
+
+CREATE OR REPLACE FUNCTION import_section_pack(
+    p_batch_id UUID,
+    p_user_id TEXT,
+    p_section_number INTEGER,
+    p_annotations JSONB,
+    p_skips JSONB,
+    p_progress_index INTEGER
+)
+RETURNS TABLE(
+    imported_annotations INTEGER,
+    imported_skips INTEGER,
+    progress_index INTEGER
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    annotation_count INTEGER;
+    skip_count INTEGER;
+    new_progress INTEGER;
+BEGIN
+    WITH incoming AS (
+        SELECT DISTINCT ON ((a->>'comment_id')::UUID) a
+        FROM jsonb_array_elements(p_annotations) AS a
+        ORDER BY (a->>'comment_id')::UUID
+    ),
+    inserted AS (
+        INSERT INTO annotations (
+            comment_id, batch_id, user_id, label, categories, notes, duration_ms, idempotency_key, offline_at
+        )
+        SELECT (a->>'comment_id')::UUID, p_batch_id, p_user_id, a->>'label',
+               ARRAY(SELECT jsonb_array_elements_text(COALESCE(a->'categories', '[]'::JSONB))),
+               a->>'notes', (a->>'duration_ms')::INTEGER, (a->>'idempotency_key')::UUID,
+               (a->>'offline_at')::TIMESTAMPTZ
+        FROM incoming
+        JOIN comment_batches cb
+          ON cb.comment_id = (a->>'comment_id')::UUID
+         AND cb.batch_id = p_batch_id
+         AND cb.section_number = p_section_number
+        WHERE NOT EXISTS (
+            SELECT 1 FROM annotations existing
+            WHERE existing.comment_id = cb.comment_id
+            AND existing.user_id = p_user_id
+        )
+        ON CONFLICT (idempotency_key) DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO annotation_count FROM inserted;
+
+    WITH inserted AS (
+        INSERT INTO skip_events (comment_id, batch_id, user_id, duration_ms, idempotency_key, offline_at)
+        SELECT (s->>'comment_id')::UUID, p_batch_id, p_user_id, (s->>'duration_ms')::INTEGER,
+               (s->>'idempotency_key')::UUID, (s->>'offline_at')::TIMESTAMPTZ
+        FROM jsonb_array_elements(p_skips) AS s
+        JOIN comment_batches cb
+          ON cb.comment_id = (s->>'comment_id')::UUID
+         AND cb.batch_id = p_batch_id
+         AND cb.section_number = p_section_number
+        ON CONFLICT (idempotency_key) DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO skip_count FROM inserted;
+
+    UPDATE section_assignments sa
+    SET progress_index = GREATEST(sa.progress_index, p_progress_index)
+    WHERE sa.batch_id = p_batch_id
+    AND sa.user_id = p_user_id
+    AND sa.assigned_section_number = p_section_number
+    RETURNING sa.progress_index INTO new_progress;
+
+    RETURN QUERY SELECT annotation_count, skip_count, new_progress;
+END;
+$$;
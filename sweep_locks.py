@@ -0,0 +1,51 @@
+"""Release expired comment claims in bounded chunks.
+
+Each chunk is one release_expired_locks call (its own short transaction), so a
+large backlog of expired leases never holds locks on many rows at once. Meant
+to be run from cron or any scheduler:
+
+    python sweep_locks.py --chunk-size 1000
+"""
+import argparse
+import os
+import time
+
+from dotenv import load_dotenv
+from supabase import create_client
+
+from repository import SWEEP_CHUNK_SIZE, SupabaseRepository
+
+
+def sweep(repository, chunk_size=SWEEP_CHUNK_SIZE, max_chunks=None, pause=0.0):
+    """Release expired claims until a chunk comes back short. Returns the total released."""
+    total = chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        released = repository.release_expired_locks(chunk_size) or 0
+        total += released
+        chunks += 1
+        if released < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Release expired comment claims in bounded chunks.")
+    parser.add_argument('--chunk-size', type=int, default=SWEEP_CHUNK_SIZE)
+    parser.add_argument('--max-chunks', type=int, help="Stop after this many chunks even if more are expired")
+    parser.add_argument('--pause', type=float, default=0.0, help="Seconds to wait between chunks")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set.")
+
+    released = sweep(SupabaseRepository(create_client(url, key)), args.chunk_size, args.max_chunks, args.pause)
+    print(f"Released {released} expired claim(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from active_learning import HashedLogisticModel, text_features, vectorize
+from repository import SQLiteRepository
+
+
+def add_scores(repository, probabilities):
+    with repository._transaction() as conn:
+        conn.executemany(
+            "INSERT INTO comment_scores (comment_id, model_version, hate_probability) VALUES (?, 'v1', ?)",
+            list(probabilities.items()),
+        )
+
+
+@pytest.fixture
+def repository(tmp_path):
+    return SQLiteRepository(str(tmp_path / 'annotations.sqlite3'))
+
+
+def test_first_section_served_holds_the_most_uncertain_comments(repository):
+    batch_id = repository.load_batch('Batch', [f'comment {i}' for i in range(7)], section_size=3)
+    ids = [comment['id'] for section in (1, 2, 3) for comment in repository.get_section_comments(batch_id, section)]
+    # Uncertainty is 1 - |2p - 1|: 0.5 -> 1.0, 0.4 -> 0.8, 0.3 -> 0.6, 0.9 -> 0.2, 0.02 -> 0.04
+    add_scores(repository, {ids[0]: 0.02, ids[2]: 0.3, ids[3]: 0.9, ids[4]: 0.5, ids[6]: 0.4})
+
+    assert repository.build_sections(batch_id, 3, order='uncertainty') == 3
+    assignment = repository.assign_section(batch_id, 'ann')
+    served = repository.get_section_comments(batch_id, assignment['assigned_section_number'])
+
+    assert assignment['assigned_section_number'] == 1
+    assert [comment['id'] for comment in served] == [ids[4], ids[6], ids[2]]
+    assert [comment['hate_probability'] for comment in served] == pytest.approx([0.5, 0.4, 0.3])
+    # Unscored comments come last, in original order
+    rest = [c['id'] for section in (2, 3) for c in repository.get_section_comments(batch_id, section)]
+    assert rest == [ids[3], ids[0], ids[1], ids[5]]
+
+
+def test_section_bounds_follow_the_serving_order(repository):
+    batch_id = repository.load_batch('Batch', [f'comment {i}' for i in range(4)], section_size=2)
+    ids = [comment['id'] for section in (1, 2) for comment in repository.get_section_comments(batch_id, section)]
+    add_scores(repository, {ids[3]: 0.5, ids[0]: 0.45})
+    repository.build_sections(batch_id, 2, order='uncertainty')
+
+    sections = [dict(row) for row in repository._connection().execute(
+        "SELECT section_number, first_position, last_position, first_original_index, last_original_index "
+        "FROM batch_sections WHERE batch_id = ? ORDER BY section_number", (batch_id,)
+    )]
+    assert sections == [
+        {'section_number': 1, 'first_position': 0, 'last_position': 1, 'first_original_index': 0, 'last_original_index': 3},
+        {'section_number': 2, 'first_position': 2, 'last_position': 3, 'first_original_index': 1, 'last_original_index': 2},
+    ]
+
+
+def test_original_order_is_the_default(repository):
+    batch_id = repository.load_batch('Batch', [f'comment {i}' for i in range(4)], section_size=2)
+    ids = [comment['id'] for section in (1, 2) for comment in repository.get_section_comments(batch_id, section)]
+    add_scores(repository, {ids[3]: 0.5})
+    repository.build_sections(batch_id, 2)
+
+    assert [c['original_index'] for c in repository.get_section_comments(batch_id, 1)] == [0, 1]
+    with pytest.raises(ValueError):
+        repository.build_sections(batch_id, 2, order='random')
+
+
+def test_text_features_ignore_case_links_and_repeats():
+    assert sorted(text_features("Sooo ACCHHA https://t.co/x")) == sorted(text_features("so acha"))
+
+
+def test_vectorized_rows_are_unit_length():
+    row_ids, indexes, values = vectorize(["pehla comment", "doosra comment bahut lamba hai"], n_features=2 ** 10)
+    norms = np.bincount(row_ids, weights=values ** 2)
+    assert norms == pytest.approx([1.0, 1.0])
+    assert indexes.max() < 2 ** 10
+
+
+def test_model_learns_and_round_trips(tmp_path):
+    model = HashedLogisticModel(n_features=2 ** 12)
+    untrained = model.version
+    hateful = ["tum log gande ho nikal jao", "in logon ko maar do", "gande log desh se nikalo"]
+    harmless = ["aaj match bahut accha tha", "chai peene chalein", "baarish mein mazaa aaya"]
+    for _ in range(10):
+        model.partial_fit(hateful + harmless, [True] * 3 + [False] * 3)
+
+    probabilities = model.predict_proba(["gande log nikal jao", "match accha tha"])
+    assert probabilities[0] > 0.5 > probabilities[1]
+    assert model.version != untrained
+
+    path = str(tmp_path / 'model.npz')
+    model.cursor = ('2026-01-01T00:00:00+00:00', 'a1')
+    model.save(path)
+    loaded = HashedLogisticModel.load(path)
+    assert loaded.version == model.version
+    assert loaded.cursor == model.cursor
+    assert loaded.predict_proba(["gande log nikal jao"]) == pytest.approx(model.predict_proba(["gande log nikal jao"]))
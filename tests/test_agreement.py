@@ -0,0 +1,179 @@
+import json
+
+import numpy as np
+import pytest
+
+from agreement import (
+    MISSING, LabelMatrix, agreement_report, category_agreement, category_counts, cohen_kappa_matrix,
+    fleiss_kappa, krippendorff_alpha,
+)
+
+
+def rows(*ratings):
+    """Annotation rows from (comment_id, user_id, label, categories) tuples, in creation order."""
+    return [
+        {'id': f'a{i}', 'comment_id': comment_id, 'user_id': user_id, 'label': label,
+         'categories': categories, 'created_at': f'2026-01-01T00:00:{i:02d}+00:00'}
+        for i, (comment_id, user_id, label, categories) in enumerate(ratings)
+    ]
+
+
+def test_fleiss_kappa_perfect_agreement():
+    assert fleiss_kappa([[3, 0], [0, 3], [3, 0]]) == pytest.approx(1.0)
+
+
+def test_fleiss_kappa_known_value():
+    # Two raters, four items: agree on 2 items, split on 2
+    counts = [[2, 0], [0, 2], [1, 1], [1, 1]]
+    # p_observed = 0.5, p_expected = 0.5**2 + 0.5**2 = 0.5
+    assert fleiss_kappa(counts) == pytest.approx(0.0)
+    # Fleiss (1971) textbook example with 10 items, 14 raters and 5 categories
+    example = [
+        [0, 0, 0, 0, 14], [0, 2, 6, 4, 2], [0, 0, 3, 5, 6], [0, 3, 9, 2, 0], [2, 2, 8, 1, 1],
+        [7, 7, 0, 0, 0], [3, 2, 6, 3, 0], [2, 5, 3, 2, 2], [6, 5, 2, 1, 0], [0, 2, 2, 3, 7],
+    ]
+    assert fleiss_kappa(example) == pytest.approx(0.210, abs=1e-3)
+
+
+def test_fleiss_kappa_ignores_items_with_one_rater():
+    assert fleiss_kappa([[2, 0], [0, 2], [1, 0]]) == pytest.approx(1.0)
+    assert np.isnan(fleiss_kappa([[1, 0], [0, 1]]))
+
+
+def test_krippendorff_alpha_perfect_agreement():
+    assert krippendorff_alpha([[2, 0], [0, 3], [2, 0]]) == pytest.approx(1.0)
+
+
+def test_krippendorff_alpha_known_value():
+    # Two coders, nominal data: alpha = 1 - (n - 1) * D_o / D_e
+    counts = [[2, 0], [0, 2], [1, 1], [2, 0]]
+    # Coincidences: o_00 = 4, o_11 = 2, o_01 = o_10 = 1; n = 8, n_0 = 5, n_1 = 3
+    expected = 1 - (8 - 1) * 2 / (8 ** 2 - 5 ** 2 - 3 ** 2)
+    assert krippendorff_alpha(counts) == pytest.approx(expected)
+
+
+def test_category_counts_skip_missing():
+    codes = np.array([[0, 1, MISSING], [1, 1, 1]], dtype=np.int8)
+    assert category_counts(codes, 2).tolist() == [[1, 1], [0, 3]]
+
+
+def test_cohen_kappa_matrix():
+    codes = np.array([
+        [0, 0, 1],
+        [1, 1, 1],
+        [0, 0, MISSING],
+        [1, 1, 0],
+    ], dtype=np.int8)
+    kappa, overlap = cohen_kappa_matrix(codes, 2)
+
+    assert overlap.tolist() == [[4, 4, 3], [4, 4, 3], [3, 3, 3]]
+    assert kappa[0, 1] == pytest.approx(1.0)
+    assert kappa[0, 1] == kappa[1, 0]
+    # Annotators 0 and 2 on comments 0, 1, 3: (0, 1), (1, 1), (1, 0)
+    # p_o = 1/3, p_e = (1/3)(1/3) + (2/3)(2/3) = 5/9
+    assert kappa[0, 2] == pytest.approx((1 / 3 - 5 / 9) / (1 - 5 / 9))
+
+
+def test_later_annotation_by_the_same_annotator_wins():
+    matrix = LabelMatrix()
+    matrix.add(rows(('c1', 'u1', 'hate', ['race']), ('c1', 'u2', 'hate', [])))
+    matrix.add(rows(('c1', 'u1', 'non-hate', ['gender'])))
+
+    comments, raters, codes, masks = matrix.ratings()
+    assert len(codes) == 2
+    by_rater = {matrix.annotator_ids[r]: (matrix.label_names[c], int(m)) for r, c, m in zip(raters, codes, masks)}
+    assert by_rater['u1'] == ('non-hate', 1 << matrix.category_names.index('gender'))
+    assert by_rater['u2'] == ('hate', 0)
+
+
+def test_masks_are_uint16_for_the_known_categories():
+    matrix = LabelMatrix()
+    matrix.add(rows(('c1', 'u1', 'hate', ['cyber bully', 'none'])))
+
+    masks = matrix.ratings()[3]
+    assert masks.dtype == np.uint16
+    assert int(masks[0]) == (1 << 15) | 1
+
+
+def test_masks_widen_past_sixteen_categories():
+    matrix = LabelMatrix()
+    matrix.add(rows(('c1', 'u1', 'hate', ['brand new category'])))
+
+    masks = matrix.ratings()[3]
+    assert masks.dtype == np.uint32
+    assert int(masks[0]) == 1 << 16
+
+
+def test_overlapping_expands_only_comments_with_enough_raters():
+    matrix = LabelMatrix()
+    matrix.add(rows(
+        ('c1', 'u1', 'hate', []), ('c1', 'u2', 'non-hate', []),
+        ('c2', 'u1', 'hate', []),
+        ('c3', 'u2', 'hate', []), ('c3', 'u3', 'hate', []),
+    ))
+    kept, codes, masks = matrix.overlapping(min_raters=2)
+
+    assert [matrix.comment_ids[i] for i in kept] == ['c1', 'c3']
+    assert codes.tolist() == [[0, 1, MISSING], [MISSING, 0, 0]]
+    assert masks.shape == codes.shape
+
+
+def test_category_agreement_counts_flagged_comments():
+    matrix = LabelMatrix()
+    matrix.add(rows(
+        ('c1', 'u1', 'hate', ['race']), ('c1', 'u2', 'hate', ['race']),
+        ('c2', 'u1', 'hate', ['race']), ('c2', 'u2', 'hate', []),
+        ('c3', 'u1', 'hate', ['race']),
+    ))
+    race = next(result for result in category_agreement(matrix) if result['category'] == 'race')
+
+    assert race['comments_flagged'] == 2
+    assert race['unanimous'] == pytest.approx(0.5)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / 'cache.npz')
+    matrix = LabelMatrix()
+    matrix.add(rows(('c1', 'u1', 'hate', ['race']), ('c1', 'u2', 'non-hate', []), ('c2', 'u2', 'hate', [])))
+    matrix.save(path)
+
+    loaded = LabelMatrix.load(path)
+    assert loaded.comment_ids == matrix.comment_ids
+    assert loaded.annotator_ids == matrix.annotator_ids
+    assert loaded.cursor == matrix.cursor
+    for saved, read in zip(matrix.ratings(), loaded.ratings()):
+        assert read.dtype == saved.dtype
+        assert read.tolist() == saved.tolist()
+    # Compared as JSON because the report holds NaNs
+    assert json.dumps(agreement_report(loaded, min_pair_overlap=1)) == \
+        json.dumps(agreement_report(matrix, min_pair_overlap=1))
+
+
+def test_load_of_a_missing_file_is_empty(tmp_path):
+    matrix = LabelMatrix.load(str(tmp_path / 'missing.npz'))
+    assert matrix.comment_ids == [] and len(matrix.ratings()[0]) == 0
+
+
+def test_load_converts_a_dense_cache(tmp_path):
+    path = str(tmp_path / 'dense.npz')
+    labels = np.array([[0, 1], [MISSING, 0]], dtype=np.int8)
+    categories = np.array([[4, 0], [0, 1]], dtype=np.uint64)
+    meta = {
+        'comment_ids': ['c1', 'c2'], 'annotator_ids': ['u1', 'u2'],
+        'label_names': ['hate', 'non-hate'], 'category_names': ['none', 'religion', 'race'],
+        'cursor': ['2026-01-01T00:00:00+00:00', 'a9'],
+    }
+    np.savez_compressed(path, labels=labels, categories=categories, meta=json.dumps(meta))
+
+    matrix = LabelMatrix.load(path)
+    comments, raters, codes, masks = matrix.ratings()
+    assert list(zip(comments.tolist(), raters.tolist(), codes.tolist(), masks.tolist())) == [
+        (0, 0, 0, 4), (0, 1, 1, 0), (1, 1, 0, 1),
+    ]
+    assert masks.dtype == np.uint16
+    assert matrix.cursor == ('2026-01-01T00:00:00+00:00', 'a9')
+
+    # New pages keep folding into a converted cache
+    matrix.add(rows(('c2', 'u1', 'hate', [])))
+    _, codes, _ = matrix.overlapping()
+    assert codes.tolist() == [[0, 1], [0, 0]]
@@ -0,0 +1,101 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pandas as pd
+
+from analytics import (
+    ROLLUP_COLUMNS, annotator_summary, batch_projections, fetch_throughput, hourly_totals, label_mix,
+)
+
+H1 = '2024-05-01T10:00:00+00:00'
+H2 = '2024-05-01T11:00:00+00:00'
+
+
+def rollups(*rows):
+    frame = pd.DataFrame(list(rows), columns=ROLLUP_COLUMNS)
+    frame['hour'] = pd.to_datetime(frame['hour'], utc=True)
+    return frame
+
+
+# hour, batch_id, user_id, label, annotations, skips, timed_events, total_duration_ms
+ROWS = rollups(
+    (H1, 'b1', 'ana', 'hate', 6, 0, 6, 60000),
+    (H1, 'b1', 'ana', 'non-hate', 4, 0, 4, 40000),
+    (H1, 'b1', 'ana', '', 0, 2, 2, 4000),
+    (H2, 'b2', 'ana', 'hate', 5, 0, 0, 0),
+    (H2, 'b1', 'raj', 'non-hate', 3, 1, 0, 0),
+)
+
+
+def test_annotator_summary():
+    summary = annotator_summary(ROWS).set_index('user_id')
+
+    assert list(summary.index) == ['ana', 'raj']
+    ana, raj = summary.loc['ana'], summary.loc['raj']
+    assert (ana['annotations'], ana['skips'], ana['active_hours']) == (15, 2, 2)
+    assert ana['comments_per_hour'] == 8.5
+    # Only timed events count towards the pace
+    assert ana['seconds_per_comment'] == 8.7
+    assert ana['skip_rate'] == round(2 / 17, 3)
+    assert pd.isna(raj['seconds_per_comment'])
+    assert raj['skip_rate'] == 0.25
+
+
+def test_annotator_summary_of_nothing_has_the_columns():
+    summary = annotator_summary(rollups())
+
+    assert summary.empty
+    assert list(summary.columns) == ['user_id', 'annotations', 'skips', 'active_hours',
+                                     'comments_per_hour', 'seconds_per_comment', 'skip_rate']
+
+
+def test_hourly_totals():
+    totals = hourly_totals(ROWS)
+
+    assert list(totals.index) == list(pd.to_datetime([H1, H2], utc=True))
+    assert totals.to_dict('list') == {'annotations': [10, 8], 'skips': [2, 1]}
+
+
+def test_label_mix_leaves_out_skip_rows():
+    mix = label_mix(ROWS)
+
+    assert list(mix.columns) == ['hate', 'non-hate']
+    assert mix.loc['b1'].to_dict() == {'hate': 6, 'non-hate': 7}
+    assert mix.loc['b2'].to_dict() == {'hate': 5, 'non-hate': 0}
+    assert label_mix(rollups((H1, 'b1', 'ana', '', 0, 3, 0, 0))).empty
+
+
+def test_batch_projections():
+    frame = batch_projections([
+        {'id': 'b1', 'name': 'B1', 'comment_count': 100, 'annotated_count': 40, 'recent_annotated': 12,
+         'window_hours': 24},
+        {'id': 'b2', 'name': 'B2', 'comment_count': 50, 'annotated_count': 10, 'recent_annotated': 0,
+         'window_hours': 24},
+        {'id': 'b3', 'name': 'B3', 'comment_count': None, 'annotated_count': 5, 'recent_annotated': 5,
+         'window_hours': 24},
+    ]).set_index('id')
+
+    assert 'window_hours' not in frame.columns
+    assert frame.loc['b1', ['remaining', 'per_hour', 'hours_to_complete']].tolist() == [60, 0.5, 120.0]
+    # No recent progress: no projection rather than infinity
+    assert frame.loc['b2', 'remaining'] == 40 and pd.isna(frame.loc['b2', 'hours_to_complete'])
+    assert frame.loc['b3', 'remaining'] == 0 and frame.loc['b3', 'hours_to_complete'] == 0
+
+
+def test_fetch_throughput_parses_hours():
+    calls = []
+
+    class Client:
+        def rpc(self, name, params):
+            calls.append((name, params))
+            return SimpleNamespace(execute=lambda: SimpleNamespace(data=[
+                dict(zip(ROLLUP_COLUMNS, (H1, 'b1', 'ana', 'hate', 1, 0, 1, 900))),
+            ]))
+
+    since = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    frame = fetch_throughput(Client(), since, batch_id='b1')
+
+    assert calls == [('get_throughput', {'p_since': since.isoformat(), 'p_batch_id': 'b1'})]
+    assert frame['hour'].tolist() == list(pd.to_datetime([H1], utc=True))
+    assert fetch_throughput(SimpleNamespace(rpc=lambda name, params: SimpleNamespace(
+        execute=lambda: SimpleNamespace(data=None))), since).empty
@@ -0,0 +1,189 @@
+import re
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from dedup import (
+    BANDS, NUM_PERM, MinHasher, NearDuplicateIndex, backfill, band_keys, normalize, shingle_hashes,
+)
+
+TWEET = "Yeh log kabhi nahi sudhrenge, sabko bahar nikalo is desh se #bharat"
+
+
+def jaccard(a, b):
+    a, b = set(shingle_hashes(a).tolist()), set(shingle_hashes(b).tolist())
+    return len(a & b) / len(a | b)
+
+
+def test_normalize():
+    assert normalize("RT @user: Sooo ACCHHA!!! https://t.co/x") == "so acha"
+    assert normalize("so acha") == "so acha"
+    assert normalize("#tag   www.example.com  ") == ""
+    assert normalize(None) == ""
+
+
+def test_shingle_hashes():
+    assert len(shingle_hashes("")) == 0
+    assert len(shingle_hashes("http://only.a/link")) == 0
+    # Shorter than a shingle: the whole text is one shingle
+    assert len(shingle_hashes("ab")) == 1
+    # "abcdef" -> abcd, bcde, cdef
+    assert len(shingle_hashes("abcdef")) == 3
+    assert shingle_hashes("ABCDEF").tolist() == shingle_hashes("abcdef").tolist()
+
+
+def test_signatures_are_deterministic_for_a_seed():
+    first, second = MinHasher(seed=7), MinHasher(seed=7)
+    signature = first.signature(TWEET)
+
+    assert signature.dtype == np.uint32 and signature.shape == (NUM_PERM,)
+    assert signature.tolist() == second.signature(TWEET).tolist()
+    assert signature.tolist() != MinHasher(seed=8).signature(TWEET).tolist()
+    assert first.signature("@someone https://t.co/abc") is None
+
+
+def test_signature_agreement_estimates_jaccard_similarity():
+    hasher = MinHasher()
+    edited = TWEET.replace("sabko", "sab ko")
+    estimate = (hasher.signature(TWEET) == hasher.signature(edited)).mean()
+
+    assert estimate == pytest.approx(jaccard(TWEET, edited), abs=0.15)
+
+
+def test_band_keys():
+    signature = MinHasher().signature(TWEET)
+    keys = band_keys(signature)
+
+    assert len(keys) == BANDS
+    assert all(-2 ** 63 <= key < 2 ** 63 for key in keys)
+    assert keys == band_keys(signature.copy())
+    changed = signature.copy()
+    changed[0] += 1
+    assert band_keys(changed)[1:] == keys[1:]
+    assert band_keys(changed)[0] != keys[0]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = NearDuplicateIndex(str(tmp_path / 'index.sqlite3'))
+    yield index
+    index.close()
+
+
+def test_near_duplicates_join_the_first_comment(index):
+    clusters = index.add([
+        {'id': 1, 'comment_text': TWEET},
+        {'id': 2, 'comment_text': "RT @news: " + TWEET},
+        {'id': 3, 'comment_text': TWEET.upper() + "!!!"},
+        {'id': 4, 'comment_text': "Match was great yesterday, what a finish by the captain"},
+    ])
+
+    assert {(c['comment_id'], c['leader_id']) for c in clusters} == {('2', '1'), ('3', '1')}
+    assert all(c['similarity'] >= index.threshold for c in clusters)
+
+
+def test_distinct_comments_stay_apart(index):
+    clusters = index.add([
+        {'id': 'a', 'comment_text': "Match was great yesterday, what a finish by the captain"},
+        {'id': 'b', 'comment_text': "Traffic on the highway was terrible this morning near the toll"},
+        {'id': 'c', 'comment_text': "https://t.co/only-a-link"},
+        {'id': 'd', 'comment_text': "https://t.co/another-link"},
+    ])
+
+    assert clusters == []
+
+
+def test_members_are_matched_against_leaders_only(index):
+    # Each comment changes one more word of the first, so neighbours stay similar but the chain drifts away
+    words = TWEET.split()
+    chain = [' '.join(words[:len(words) - i] + ['badla'] * i) for i in range(len(words))]
+    clusters = index.add([{'id': i, 'comment_text': text} for i, text in enumerate(chain)])
+    members = {c['comment_id'] for c in clusters}
+
+    assert members
+    assert {c['leader_id'] for c in clusters}.isdisjoint(members)
+    assert '1' in members and clusters[0]['leader_id'] == '0'
+    # The far end of the chain is too far from the first comment to join it
+    assert str(len(chain) - 1) not in members
+
+
+def test_adding_again_returns_the_stored_clusters(tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    comments = [{'id': 1, 'comment_text': TWEET}, {'id': 2, 'comment_text': "RT " + TWEET}]
+    index = NearDuplicateIndex(path)
+    first = index.add(comments)
+    index.close()
+
+    reopened = NearDuplicateIndex(path)
+    assert reopened.add(comments) == first
+    assert reopened.add([{'id': 3, 'comment_text': TWEET + "!!"}])[0]['leader_id'] == '1'
+    reopened.close()
+
+
+def test_index_refuses_other_parameters(tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    NearDuplicateIndex(path).close()
+
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(path, seed=2)
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(str(tmp_path / 'other.sqlite3'), num_perm=100, bands=16)
+
+
+class FakeComments:
+    """The comments table behind client.table('comments'), with the keyset filter backfill uses."""
+
+    def __init__(self):
+        self.rows = []
+        self.clusters = []
+
+    def add(self, comment_id, text, second):
+        self.rows.append({'id': comment_id, 'comment_text': text, 'created_at': f'2026-01-01T00:00:{second:02d}+00:00'})
+
+    def table(self, name):
+        fake, state = self, {'after': None}
+
+        class Query:
+            def select(self, columns):
+                return self
+
+            def or_(self, condition):
+                match = re.fullmatch(r'created_at\.gt\."(.+)",and\(created_at\.eq\."\1",id\.gt\."(.+)"\)', condition)
+                state['after'] = (match.group(1), match.group(2))
+                return self
+
+            def order(self, column):
+                return self
+
+            def limit(self, count):
+                state['limit'] = count
+                return self
+
+            def execute(self):
+                rows = sorted(fake.rows, key=lambda row: (row['created_at'], row['id']))
+                if state['after']:
+                    rows = [row for row in rows if (row['created_at'], row['id']) > state['after']]
+                return SimpleNamespace(data=rows[:state['limit']])
+
+        return Query()
+
+    def rpc(self, name, params):
+        self.clusters.extend(params['p_clusters'])
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=len(params['p_clusters'])))
+
+
+def test_backfill_picks_up_comments_whose_ids_sort_before_the_cursor(index):
+    client = FakeComments()
+    client.add('ffff0000-0000-0000-0000-000000000001', TWEET, 1)
+    client.add('eeee0000-0000-0000-0000-000000000002', "Match was great yesterday, what a finish", 2)
+    client.add('dddd0000-0000-0000-0000-000000000003', "Traffic on the highway was terrible today", 2)
+    assert backfill(client, index, page_size=2, log=lambda *args: None) == (3, 0)
+
+    # A random UUID below every id read so far
+    client.add('00000000-0000-0000-0000-000000000004', "RT " + TWEET, 3)
+    assert backfill(client, index, page_size=2, log=lambda *args: None) == (1, 1)
+    assert client.clusters == [{'comment_id': '00000000-0000-0000-0000-000000000004',
+                                'leader_id': 'ffff0000-0000-0000-0000-000000000001',
+                                'similarity': client.clusters[0]['similarity']}]
+    assert backfill(client, index, page_size=2, log=lambda *args: None) == (0, 0)
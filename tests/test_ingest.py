@@ -0,0 +1,183 @@
+import csv
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import ingest
+from dedup import NearDuplicateIndex
+
+
+class FakeClient:
+    """Just enough of the Supabase client for ingest.py, with the comment_clusters foreign keys enforced."""
+
+    def __init__(self, slow_chunks=(), failing_chunks=(), failing_texts=()):
+        self.comments = {}
+        self.batches = {}
+        self.clusters = {}
+        self.chunk_calls = 0
+        self.slow_chunks = set(slow_chunks)
+        self.failing_chunks = set(failing_chunks)
+        self.failing_texts = set(failing_texts)
+        self._lock = threading.Lock()
+
+    def table(self, name):
+        client = self
+
+        class Query:
+            def upsert(self, row, **kwargs):
+                self.row = row
+                return self
+
+            def execute(self):
+                client.batches.setdefault(self.row['id'], 0)
+                return SimpleNamespace(data=[])
+
+        return Query()
+
+    def rpc(self, name, params):
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=getattr(self, name)(**params)))
+
+    def existing_comment_hashes(self, p_hashes):
+        with self._lock:
+            return [{'text_hash': digest, 'batch_id': self.comments[digest]['batch_id']}
+                    for digest in p_hashes if digest in self.comments]
+
+    def ingest_comment_chunk(self, p_batch_id, p_comments):
+        with self._lock:
+            self.chunk_calls += 1
+            call = self.chunk_calls
+        if call in self.slow_chunks:
+            time.sleep(0.2)
+        if call in self.failing_chunks or self.failing_texts & {c['comment_text'] for c in p_comments}:
+            raise ConnectionError("connection reset")
+        with self._lock:
+            linked = 0
+            for comment in p_comments:
+                if comment['text_hash'] not in self.comments:
+                    self.comments[comment['text_hash']] = {**comment, 'batch_id': p_batch_id}
+                    linked += 1
+            self.batches[p_batch_id] += linked
+            return linked
+
+    def add_comment_clusters(self, p_clusters):
+        with self._lock:
+            ids = {comment['id'] for comment in self.comments.values()}
+            for cluster in p_clusters:
+                if cluster['comment_id'] not in ids or cluster['leader_id'] not in ids:
+                    raise RuntimeError('insert or update on table "comment_clusters" violates foreign key constraint')
+                self.clusters.setdefault(cluster['comment_id'], cluster['leader_id'])
+            return len(p_clusters)
+
+    def build_batch_sections(self, p_batch_id, p_section_size):
+        return 1
+
+    def ids_by_text(self):
+        return {comment['comment_text']: comment['id'] for comment in self.comments.values()}
+
+
+def write_corpus(path, texts):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['comment_text'])
+        writer.writerows([text] for text in texts)
+    return str(path)
+
+
+TWEET = "Yeh log kabhi nahi sudhrenge, sabko bahar nikalo is desh se"
+NEAR_DUPLICATE_CORPUS = [
+    TWEET, "Match was great yesterday, what a finish by the captain",
+    "Traffic on the highway was terrible this morning", "RT @news: " + TWEET + "!!",
+    "Monsoon came early this year in the south", TWEET.upper(),
+]
+
+
+def run(client, tmp_path, corpus, **kwargs):
+    kwargs = {'batch_size': 10, 'chunk_size': 2, 'concurrency': 4,
+              'checkpoint_path': str(tmp_path / 'checkpoint.sqlite3'), 'log': lambda *args: None, **kwargs}
+    return ingest.ingest(client, write_corpus(tmp_path / 'corpus.csv', corpus), 'Corpus', **kwargs)
+
+
+def test_clusters_are_written_after_their_leaders(tmp_path):
+    # The leader's chunk is still being written while later chunks finish
+    client = FakeClient(slow_chunks={1})
+    index = NearDuplicateIndex(str(tmp_path / 'index.sqlite3'))
+
+    run(client, tmp_path, NEAR_DUPLICATE_CORPUS, dedup_index=index)
+    index.close()
+
+    ids = client.ids_by_text()
+    assert client.clusters == {
+        ids["RT @news: " + TWEET + "!!"]: ids[TWEET],
+        ids[TWEET.upper()]: ids[TWEET],
+    }
+
+
+def test_a_failed_chunk_is_not_indexed(tmp_path):
+    client = FakeClient(failing_chunks={2})
+    index = NearDuplicateIndex(str(tmp_path / 'index.sqlite3'))
+
+    with pytest.raises(ConnectionError):
+        run(client, tmp_path, NEAR_DUPLICATE_CORPUS, dedup_index=index, concurrency=1)
+    indexed = {row[0] for row in index._conn.execute("SELECT comment_id FROM comments")}
+    ids = client.ids_by_text()
+    # Only the chunk before the failed one was indexed; nothing points at unwritten comments
+    assert indexed == {ids[TWEET], ids[NEAR_DUPLICATE_CORPUS[1]]}
+
+    client.failing_chunks = set()
+    run(client, tmp_path, NEAR_DUPLICATE_CORPUS, dedup_index=index, concurrency=1)
+    index.close()
+    assert len(client.clusters) == 2
+
+
+def test_resume_restarts_after_the_last_contiguous_written_chunk(tmp_path):
+    checkpoint = ingest.Checkpoint(str(tmp_path / 'checkpoint.sqlite3'))
+    assert checkpoint.resume_state() == (0, 0, 0, 0, 0)
+    for seq in range(1, 5):
+        checkpoint.plan_chunk(seq, seq * 10, seq * 2, 1, seq * 2)
+        checkpoint.is_new(f'hash{seq}', seq)
+    for seq in (1, 2, 4):
+        checkpoint.mark_done(seq)
+
+    assert checkpoint.resume_state() == (2, 20, 4, 1, 4)
+    # Hashes planned for the chunks after it are forgotten, earlier ones are not
+    assert checkpoint.is_new('hash3', 3) and checkpoint.is_new('hash4', 3)
+    assert not checkpoint.is_new('hash2', 3)
+    assert checkpoint._conn.execute("SELECT MAX(seq) FROM chunks").fetchone() == (2,)
+    checkpoint.close()
+
+
+def test_resumed_load_writes_every_comment_once(tmp_path):
+    corpus = [f"comment number {i}" for i in range(10)]
+    client = FakeClient(failing_texts={corpus[3]})
+
+    with pytest.raises(ConnectionError):
+        run(client, tmp_path, corpus, batch_size=4)
+    client.failing_texts = set()
+    planned, duplicates = run(client, tmp_path, corpus, batch_size=4)
+
+    # Chunks written after the failed one are replanned, not counted as duplicates
+    assert (planned, duplicates) == (8, 0)
+    assert sorted(c['original_index'] for c in client.comments.values()) == list(range(10))
+    assert {c['comment_text']: c['original_index'] for c in client.comments.values()} == \
+        {text: i for i, text in enumerate(corpus)}
+    assert sorted(client.batches.values()) == [2, 4, 4]
+
+
+def test_texts_stored_by_another_batch_are_duplicates_on_resume(tmp_path):
+    corpus = [f"comment number {i}" for i in range(10)] + ["comment number 1"]
+    client = FakeClient(failing_texts={corpus[3]})
+    foreign = ingest.text_hash(corpus[6])
+    client.comments[foreign] = {'id': 'elsewhere', 'comment_text': corpus[6], 'text_hash': foreign,
+                                'batch_id': 'another-corpus-batch'}
+
+    with pytest.raises(ConnectionError):
+        run(client, tmp_path, corpus, batch_size=4)
+    client.failing_texts = set()
+    planned, duplicates = run(client, tmp_path, corpus, batch_size=4)
+
+    assert (planned, duplicates) == (7, 2)
+    assert client.comments[foreign]['batch_id'] == 'another-corpus-batch'
+    assert sorted(c['original_index'] for c in client.comments.values() if c['id'] != 'elsewhere') == \
+        list(range(9))
@@ -0,0 +1,125 @@
+import json
+import threading
+
+import pandas as pd
+import pytest
+
+from instrumentation import (
+    RING_BUFFER_SIZE, RerunTrace, _measure, append_jsonl, instrument, new_ring_buffer,
+    traced,
+)
+from repository import AnnotationRepository, SQLiteRepository
+
+
+@pytest.fixture
+def repository(tmp_path):
+    return SQLiteRepository(str(tmp_path / 'annotations.sqlite3'))
+
+
+def operations(trace):
+    return [call['operation'] for call in trace.calls]
+
+
+def test_tracing_off_returns_the_repository_itself(repository):
+    assert instrument(repository, None) is repository
+    assert traced(repository, 'export_annotations', lambda: 'direct') == 'direct'
+
+
+def test_every_repository_call_is_recorded(repository):
+    trace = RerunTrace('rerun')
+    wrapped = instrument(repository, trace)
+    assert isinstance(wrapped, AnnotationRepository)
+
+    batch_id = repository.load_batch('Batch', ['one', 'two', 'three'])
+    comments = wrapped.get_section_comments(batch_id, 1)
+    wrapped.get_batch('missing')
+    wrapped.list_batches()
+
+    assert operations(trace) == ['get_section_comments', 'get_batch', 'list_batches']
+    first = trace.calls[0]
+    assert first['rows'] == 3
+    assert first['payload_bytes'] == len(json.dumps(comments))
+    assert first['error'] is None and first['duration_ms'] >= 0
+    assert trace.calls[1]['rows'] == 0 and trace.calls[1]['payload_bytes'] == 0
+
+
+def test_a_failed_call_is_recorded_and_raised(repository):
+    trace = RerunTrace()
+    wrapped = instrument(repository, trace)
+
+    with pytest.raises(KeyError):
+        wrapped.save_annotations([{'label': 'hate'}])
+
+    assert trace.calls == [{'operation': 'save_annotations', 'duration_ms': trace.calls[0]['duration_ms'],
+                            'rows': 0, 'payload_bytes': 0, 'error': "'comment_id'"}]
+
+
+def test_calls_land_in_the_current_trace(repository):
+    wrapped = instrument(repository, RerunTrace('first'))
+    wrapped.list_batches()
+    second = RerunTrace('fragment')
+    wrapped.trace = second
+
+    wrapped.list_batches()
+
+    assert operations(second) == ['list_batches']
+
+
+def test_traced_records_direct_backend_calls(repository):
+    trace = RerunTrace()
+    wrapped = instrument(repository, trace)
+
+    assert traced(wrapped, 'export_annotations', lambda limit: [{'id': 1}] * limit, 2) == [{'id': 1}, {'id': 1}]
+    with pytest.raises(ValueError):
+        traced(wrapped, 'override_cluster_label', lambda: int('x'))
+
+    assert operations(trace) == ['export_annotations', 'override_cluster_label']
+    assert trace.calls[0]['rows'] == 2
+    assert 'invalid literal' in trace.calls[1]['error']
+
+
+def test_calls_from_other_threads_are_recorded(repository):
+    trace = RerunTrace()
+    wrapped = instrument(repository, trace)
+    threads = [threading.Thread(target=wrapped.list_batches) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert operations(trace) == ['list_batches'] * 8
+
+
+def test_measure():
+    assert _measure(None) == (0, 0)
+    assert _measure([{'a': 1}, {'a': 2}]) == (2, len(json.dumps([{'a': 1}, {'a': 2}])))
+    assert _measure({'a': 1}) == (1, len('{"a": 1}'))
+    frame = pd.DataFrame({'day': pd.to_datetime(['2024-01-01', '2024-01-02']), 'n': [1, 2]})
+    assert _measure(frame) == (2, len(frame.to_json(date_format='iso')))
+    circular = {}
+    circular['self'] = circular
+    assert _measure(circular) == (1, None)
+
+
+def test_finished_traces_serialise(tmp_path):
+    trace = RerunTrace('rerun')
+    trace.record('get_batch', 0.0015, 1, 42)
+    record = trace.finish().to_dict()
+
+    assert record['label'] == 'rerun' and record['duration_ms'] >= 0
+    assert record['calls'] == [{'operation': 'get_batch', 'duration_ms': 1.5, 'rows': 1, 'payload_bytes': 42,
+                                'error': None}]
+    assert RerunTrace().to_dict()['duration_ms'] is None
+
+    path = tmp_path / 'traces.jsonl'
+    append_jsonl(str(path), record)
+    append_jsonl(str(path), record)
+    assert [json.loads(line) for line in path.read_text().splitlines()] == [record, record]
+
+
+def test_the_ring_buffer_keeps_the_latest_traces():
+    buffer = new_ring_buffer()
+    for i in range(RING_BUFFER_SIZE + 5):
+        buffer.append(i)
+
+    assert list(buffer) == list(range(5, RING_BUFFER_SIZE + 5))
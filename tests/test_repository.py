@@ -0,0 +1,162 @@
+import threading
+
+import pytest
+
+from repository import SQLiteRepository, default_section_size
+
+
+@pytest.fixture
+def repository(tmp_path):
+    return SQLiteRepository(str(tmp_path / 'annotations.sqlite3'))
+
+
+@pytest.fixture
+def batch_id(repository):
+    return repository.load_batch('Batch', [f'comment {i}' for i in range(7)], section_size=3)
+
+
+def annotation(comment_id, user_id='a@b.c', label='hate', **extra):
+    return {'comment_id': comment_id, 'user_id': user_id, 'label': label, **extra}
+
+
+def test_default_section_size():
+    assert default_section_size(0) == 1
+    assert default_section_size(7) == 7
+    assert default_section_size(2500) == 250
+    assert default_section_size(2505) == 250
+
+
+def test_sections_cover_the_batch_in_original_order(repository, batch_id):
+    sections = [repository.get_section_comments(batch_id, n) for n in (1, 2, 3, 4)]
+
+    assert [[c['original_index'] for c in section] for section in sections] == [[0, 1, 2], [3, 4, 5], [6], []]
+    assert sections[0][0]['comment_text'] == 'comment 0'
+    assert repository.get_batch(batch_id)['comment_count'] == 7
+    assert repository.get_batch('missing') is None
+
+
+def test_assign_section_resumes_until_the_section_is_done(repository, batch_id):
+    assert repository.assign_section(batch_id, 'a') == {'assigned_section_number': 1, 'saved_progress_index': 0}
+    repository.update_progress(batch_id, 'a', 2)
+    assert repository.assign_section(batch_id, 'a') == {'assigned_section_number': 1, 'saved_progress_index': 2}
+
+    repository.update_progress(batch_id, 'a', 3)
+    assert repository.assign_section(batch_id, 'a') == {'assigned_section_number': 2, 'saved_progress_index': 0}
+
+
+def test_each_section_goes_to_one_annotator(repository, batch_id):
+    assigned = [repository.assign_section(batch_id, user)['assigned_section_number'] for user in 'abc']
+
+    assert assigned == [1, 2, 3]
+    assert repository.assign_section(batch_id, 'd') is None
+
+
+def test_concurrent_assignments_never_share_a_section(repository):
+    batch_id = repository.load_batch('Big', [f'comment {i}' for i in range(40)], section_size=2)
+    results = {}
+    start = threading.Barrier(20)
+
+    def annotator(user):
+        start.wait()
+        results[user] = repository.assign_section(batch_id, user)['assigned_section_number']
+
+    threads = [threading.Thread(target=annotator, args=(f'user{i}',)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results.values()) == list(range(1, 21))
+
+
+def test_progress_for_a_named_section_does_not_touch_the_current_one(repository, batch_id):
+    repository.assign_section(batch_id, 'a')
+    repository.update_progress(batch_id, 'a', 3, section_number=1)
+    repository.assign_section(batch_id, 'a')
+
+    # A late flush for section 1 lands on section 1
+    repository.update_progress(batch_id, 'a', 3, section_number=1)
+    assert repository.assign_section(batch_id, 'a') == {'assigned_section_number': 2, 'saved_progress_index': 0}
+
+
+def test_a_reserved_section_is_held_until_claimed(repository, batch_id):
+    assert repository.reserve_next_section(batch_id, 'a') == 1
+    assert repository.reserve_next_section(batch_id, 'a') == 1
+    assert repository.assign_section(batch_id, 'b')['assigned_section_number'] == 2
+
+    assert repository.claim_section_reservation(batch_id, 'a') == {'assigned_section_number': 1,
+                                                                    'saved_progress_index': 0}
+    assert repository.claim_section_reservation(batch_id, 'a') is None
+    assert repository.assign_section(batch_id, 'a')['assigned_section_number'] == 1
+
+
+def test_a_released_or_expired_reservation_is_free_again(repository, batch_id):
+    repository.reserve_next_section(batch_id, 'a')
+    repository.release_section_reservation(batch_id, 'a')
+    assert repository.assign_section(batch_id, 'b')['assigned_section_number'] == 1
+
+    assert repository.reserve_next_section(batch_id, 'a') == 2
+    repository._connection().execute("UPDATE section_reservations SET expires_at = 0")
+    assert repository.claim_section_reservation(batch_id, 'a') is None
+    assert repository.assign_section(batch_id, 'c')['assigned_section_number'] == 2
+
+
+def test_concurrent_claims_are_disjoint(repository, batch_id):
+    claimed = {}
+    start = threading.Barrier(4)
+
+    def annotator(user):
+        start.wait()
+        claimed[user] = [row['id'] for row in repository.claim_comments(batch_id, user, 2)]
+
+    threads = [threading.Thread(target=annotator, args=(user,)) for user in 'abcd']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ids = [comment_id for user_ids in claimed.values() for comment_id in user_ids]
+    assert len(ids) == len(set(ids)) == 7
+    assert repository.claim_next_comment(batch_id, 'e') is None
+
+
+def test_expired_claims_are_swept_and_live_ones_renewed(repository, batch_id):
+    first = repository.claim_next_comment(batch_id, 'a')
+    repository.claim_comments(batch_id, 'b', 2, lease_seconds=-1)
+
+    assert repository.renew_leases(batch_id, 'a') == 1
+    assert repository.renew_leases(batch_id, 'b') == 0
+    assert repository.release_expired_locks(limit=1) == 1
+    assert repository.release_expired_locks() == 1
+    assert repository.release_expired_locks() == 0
+
+    next_claim = repository.claim_comments(batch_id, 'c', 3)
+    assert first['id'] not in {row['id'] for row in next_claim}
+    assert [row['original_index'] for row in next_claim] == [1, 2, 3]
+
+
+def test_saves_are_idempotent_by_key(repository, batch_id):
+    comment_id = repository.get_section_comments(batch_id, 1)[0]['id']
+    row = annotation(comment_id, batch_id=batch_id, categories=['religion'], idempotency_key='k1')
+
+    repository.save_annotations([row, row])
+    repository.save_annotation(row)
+    repository.save_skip_events([{'comment_id': comment_id, 'user_id': 'a@b.c', 'idempotency_key': 's1'}] * 2)
+
+    conn = repository._connection()
+    assert conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM skip_events").fetchone()[0] == 1
+    assert repository.list_batches()[0]['annotated_count'] == 1
+
+
+def test_user_stats(repository, batch_id):
+    comments = repository.get_section_comments(batch_id, 1)
+    repository.save_annotations([
+        annotation(comments[0]['id'], categories=['religion', 'caste']),
+        annotation(comments[1]['id'], categories=['religion']),
+        annotation(comments[2]['id'], label='non-hate'),
+        annotation(comments[2]['id'], user_id='other'),
+    ])
+
+    assert repository.get_user_stats('a@b.c') == (3, {'hate': 2, 'non-hate': 1}, {'religion': 2, 'caste': 1})
+    assert repository.get_user_stats('nobody') == (0, {}, {})
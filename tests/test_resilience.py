@@ -0,0 +1,368 @@
+import random
+import threading
+
+import pytest
+
+from resilience import (
+    CircuitBreaker, CircuitOpenError, ResilientRepository, SingleFlight, backoff_delay, is_transient,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRepository:
+    """Answers every call from a script of results and exceptions, and records the calls."""
+
+    def __init__(self, **scripts):
+        self.scripts = {name: list(results) for name, results in scripts.items()}
+        self.calls = []
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            self.calls.append((name, args))
+            script = self.scripts.get(name)
+            result = script.pop(0) if script else None
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        return method
+
+
+class DatabaseError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+def resilient(repository, breaker=None, max_attempts=3):
+    sleeps = []
+    wrapped = ResilientRepository(repository, max_attempts=max_attempts, breaker=breaker,
+                                  sleep=sleeps.append, rng=random.Random(0))
+    return wrapped, sleeps
+
+
+def test_backoff_delay_is_full_jitter_capped_at_max_delay():
+    class Extremes:
+        def __init__(self, pick):
+            self.pick = pick
+
+        def uniform(self, low, high):
+            return self.pick(low, high)
+
+    assert backoff_delay(1, base_delay=0.2, max_delay=2.0, rng=Extremes(max)) == pytest.approx(0.2)
+    assert backoff_delay(3, base_delay=0.2, max_delay=2.0, rng=Extremes(max)) == pytest.approx(0.8)
+    assert backoff_delay(10, base_delay=0.2, max_delay=2.0, rng=Extremes(max)) == pytest.approx(2.0)
+    assert backoff_delay(10, base_delay=0.2, max_delay=2.0, rng=Extremes(min)) == 0
+    rng = random.Random(1)
+    assert all(0 <= backoff_delay(attempt, rng=rng) <= 2.0 for attempt in range(1, 50))
+
+
+def test_is_transient():
+    assert is_transient(ConnectionError())
+    assert is_transient(TimeoutError())
+    assert is_transient(DatabaseError('40001'))
+    assert is_transient(DatabaseError('08006'))
+    assert is_transient(DatabaseError('503'))
+    assert not is_transient(DatabaseError('23505'))
+    assert not is_transient(ValueError('bad input'))
+
+
+def test_transient_read_failures_are_retried_with_backoff():
+    repository = FakeRepository(get_batch=[ConnectionError(), ConnectionError(), {'id': 'b1'}])
+    wrapped, sleeps = resilient(repository)
+
+    assert wrapped.get_batch('b1') == {'id': 'b1'}
+    assert len(repository.calls) == 3
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.2 and 0 <= sleeps[1] <= 0.4
+    assert wrapped.stats()['retries'] == 2
+
+
+def test_gives_up_after_max_attempts():
+    repository = FakeRepository(update_progress=[ConnectionError()] * 5)
+    wrapped, sleeps = resilient(repository, max_attempts=3)
+
+    with pytest.raises(ConnectionError):
+        wrapped.update_progress('b1', 'u1', 4, 1)
+    assert len(repository.calls) == 3
+    assert wrapped.stats()['gave_up'] == 1
+
+
+def test_non_idempotent_writes_are_not_retried():
+    repository = FakeRepository(claim_next_comment=[ConnectionError(), {'id': 'c1'}])
+    wrapped, sleeps = resilient(repository)
+
+    with pytest.raises(ConnectionError):
+        wrapped.claim_next_comment('b1', 'u1')
+    assert len(repository.calls) == 1
+    assert sleeps == []
+
+
+def test_permanent_errors_are_raised_at_once():
+    repository = FakeRepository(get_batch=[DatabaseError('23505'), {'id': 'b1'}])
+    wrapped, sleeps = resilient(repository)
+
+    with pytest.raises(DatabaseError):
+        wrapped.get_batch('b1')
+    assert len(repository.calls) == 1
+    assert wrapped.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_save_annotation_gets_an_idempotency_key_so_it_can_be_retried():
+    repository = FakeRepository(save_annotations=[ConnectionError(), None])
+    wrapped, _ = resilient(repository)
+
+    wrapped.save_annotation({'comment_id': 'c1', 'user_id': 'u1', 'label': 'hate'})
+    (_, (first,)), (_, (second,)) = repository.calls
+    assert first[0]['idempotency_key']
+    assert first == second
+
+
+def test_breaker_opens_at_the_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=FakeClock())
+
+    assert breaker.record_failure() is False
+    assert breaker.record_failure() is False
+    assert breaker.record_failure() is True
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 1
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=FakeClock())
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_a_single_trial_through():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 29
+    assert not breaker.allow()
+    assert breaker.retry_in() == pytest.approx(1)
+    clock.now = 30
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_half_open_trial_success_closes_the_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    clock.now = 30
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_half_open_trial_failure_reopens_the_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30, clock=clock)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now = 30
+    assert breaker.allow()
+
+    assert breaker.record_failure() is True
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+    clock.now = 59
+    assert not breaker.allow()
+    clock.now = 60
+    assert breaker.allow()
+
+
+class CountingEvent(threading.Event):
+    """Event that knows how many threads are blocked on it."""
+
+    def __init__(self):
+        super().__init__()
+        self.waiting = threading.Semaphore(0)
+
+    def wait(self, timeout=None):
+        self.waiting.release()
+        return super().wait(timeout)
+
+
+def run_with_waiters(flights, fetch, waiters):
+    """Start one leader and `waiters` callers of the same key; fetch returns once every waiter is blocked."""
+    release = threading.Event()
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(flights.do('key', lambda: fetch(release)))
+        except Exception as e:
+            outcomes.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    while 'key' not in flights._calls:
+        pass
+    done = flights._calls['key'].done
+    followers = [threading.Thread(target=call) for _ in range(waiters)]
+    for thread in followers:
+        thread.start()
+    for _ in range(waiters):
+        assert done.waiting.acquire(timeout=5)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+    return outcomes
+
+
+@pytest.fixture
+def flights(monkeypatch):
+    class Call(SingleFlight._Call):
+        def __init__(self):
+            super().__init__()
+            self.done = CountingEvent()
+
+    monkeypatch.setattr(SingleFlight, '_Call', Call)
+    return SingleFlight()
+
+
+def test_single_flight_waiters_share_the_result(flights):
+    calls = []
+
+    def fetch(release):
+        calls.append(1)
+        release.wait(5)
+        return 'rows'
+
+    outcomes = run_with_waiters(flights, fetch, waiters=3)
+
+    assert len(calls) == 1
+    assert sorted(outcomes) == [('rows', False)] + [('rows', True)] * 3
+    assert flights._calls == {}
+
+
+def test_single_flight_waiters_share_the_error(flights):
+    error = ConnectionError('reset by peer')
+
+    def fetch(release):
+        release.wait(5)
+        raise error
+
+    outcomes = run_with_waiters(flights, fetch, waiters=3)
+
+    assert len(outcomes) == 4
+    assert all(outcome is error for outcome in outcomes)
+    assert flights._calls == {}
+
+
+def test_open_breaker_serves_the_last_good_read():
+    clock = FakeClock()
+    repository = FakeRepository(list_batches=[[{'id': 'b1'}], ConnectionError()])
+    wrapped, _ = resilient(repository, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock),
+                           max_attempts=1)
+
+    assert wrapped.list_batches() == [{'id': 'b1'}]
+    assert wrapped.list_batches() == [{'id': 'b1'}]
+    assert wrapped.breaker.state == CircuitBreaker.OPEN
+    assert wrapped.list_batches() == [{'id': 'b1'}]
+    assert len(repository.calls) == 2
+    assert wrapped.stats()['stale_served'] == 2
+    assert wrapped.stats()['short_circuited'] == 1
+
+
+def test_open_breaker_without_a_stale_entry_raises():
+    repository = FakeRepository(get_batch=[ConnectionError()])
+    wrapped, _ = resilient(repository, breaker=CircuitBreaker(failure_threshold=1, clock=FakeClock()),
+                           max_attempts=1)
+
+    with pytest.raises(ConnectionError):
+        wrapped.get_batch('b1')
+    with pytest.raises(CircuitOpenError):
+        wrapped.get_batch('b1')
+    with pytest.raises(CircuitOpenError):
+        wrapped.save_skip_events([])
+    assert len(repository.calls) == 1
+
+
+def test_stale_entries_are_per_arguments():
+    repository = FakeRepository(get_batch=[{'id': 'b1'}, ConnectionError()])
+    wrapped, _ = resilient(repository, max_attempts=1)
+
+    assert wrapped.get_batch('b1') == {'id': 'b1'}
+    with pytest.raises(ConnectionError):
+        wrapped.get_batch('b2')
+
+
+def test_direct_reads_are_retried_and_served_stale():
+    calls = []
+    results = [['member'], ConnectionError(), ConnectionError(), ConnectionError()]
+
+    def list_cluster_members(client, limit):
+        calls.append(limit)
+        result = results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    wrapped, sleeps = resilient(FakeRepository())
+    assert wrapped.call('list_cluster_members', list_cluster_members, 'client', limit=25) == ['member']
+    assert wrapped.call('list_cluster_members', list_cluster_members, 'client', limit=25) == ['member']
+    assert len(calls) == 4 and len(sleeps) == 2
+    assert wrapped.stats()['stale_served'] == 1
+
+
+def test_direct_calls_outside_the_policy_are_tried_once():
+    attempts = []
+
+    def sign_up(credentials):
+        attempts.append(credentials)
+        raise ConnectionError()
+
+    wrapped, sleeps = resilient(FakeRepository())
+    with pytest.raises(ConnectionError):
+        wrapped.call('auth_sign_up', sign_up, {'email': 'a@b.c'})
+    assert len(attempts) == 1 and sleeps == []
+
+
+def test_direct_calls_share_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, clock=FakeClock())
+    wrapped, _ = resilient(FakeRepository(get_batch=[ConnectionError()]), breaker=breaker, max_attempts=1)
+    with pytest.raises(ConnectionError):
+        wrapped.get_batch('b1')
+
+    called = []
+    with pytest.raises(CircuitOpenError):
+        wrapped.call('get_throughput', lambda: called.append(1))
+    assert called == []
+
+
+def test_traced_goes_through_the_resilient_layer_under_the_trace():
+    from instrumentation import RerunTrace, instrument, traced
+
+    results = [ConnectionError(), {'rows': 3}]
+
+    def fetch_batch_projections(client, window_hours):
+        result = results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    wrapped, sleeps = resilient(FakeRepository())
+    trace = RerunTrace()
+    assert traced(instrument(wrapped, trace), 'get_batch_projections', fetch_batch_projections,
+                  'client', window_hours=24) == {'rows': 3}
+    assert len(sleeps) == 1
+    assert [(call['operation'], call['error']) for call in trace.calls] == [('get_batch_projections', None)]
+    assert traced(wrapped, 'get_batch_projections', lambda: 'untimed') == 'untimed'
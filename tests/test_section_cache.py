@@ -0,0 +1,151 @@
+import gc
+import threading
+
+import pytest
+
+from section_cache import Section, SectionCache
+
+
+def comments(prefix, count=3, text_size=10):
+    return [{'id': f'{prefix}{i}', 'comment_text': f'{prefix}{i} ' + 'x' * text_size, 'original_index': i}
+            for i in range(count)]
+
+
+def size_of(prefix, **kwargs):
+    return Section(comments(prefix, **kwargs)).nbytes
+
+
+def test_handle_reads_like_a_list_of_comments():
+    cache = SectionCache()
+    handle = cache.put(('b1', 1), [{'id': 7, 'comment_text': 'hi', 'original_index': 4, 'hate_probability': 0.25},
+                                   {'id': 8, 'comment_text': 'yo', 'original_index': 5}])
+
+    assert len(handle) == 2 and handle
+    assert handle[0] == {'id': '7', 'comment_text': 'hi', 'original_index': 4, 'hate_probability': 0.25}
+    assert handle[1]['hate_probability'] is None
+
+
+def test_hits_share_one_copy():
+    cache = SectionCache()
+    loads = []
+    first = cache.acquire(('b1', 1), lambda: loads.append(1) or comments('a'))
+    second = cache.acquire(('b1', 1), lambda: loads.append(1) or comments('a'))
+
+    assert loads == [1]
+    assert first._section is second._section
+    assert cache.stats() == {'sections': 1, 'pinned': 1, 'bytes': first._section.nbytes, 'hits': 1, 'misses': 1}
+
+
+def test_empty_sections_are_not_cached():
+    cache = SectionCache()
+    assert cache.acquire(('b1', 9), lambda: []) is None
+    assert cache.stats()['sections'] == 0
+
+
+def test_a_failed_load_lets_the_next_caller_retry():
+    cache = SectionCache()
+
+    def fail():
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        cache.acquire(('b1', 1), fail)
+    assert len(cache.acquire(('b1', 1), lambda: comments('a'))) == 3
+
+
+def test_concurrent_misses_share_a_single_load():
+    cache = SectionCache()
+    started, release = threading.Event(), threading.Event()
+    loads, handles = [], []
+
+    def loader():
+        loads.append(1)
+        started.set()
+        release.wait(5)
+        return comments('a')
+
+    first = threading.Thread(target=lambda: handles.append(cache.acquire(('b1', 1), loader)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: handles.append(cache.acquire(('b1', 1), loader)))
+    second.start()
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert loads == [1]
+    assert handles[0]._section is handles[1]._section
+
+
+def test_pins_are_counted_per_handle():
+    cache = SectionCache()
+    first = cache.put(('b1', 1), comments('a'))
+    second = cache.acquire(('b1', 1), lambda: comments('a'))
+    assert cache._pins == {('b1', 1): 2}
+
+    del first
+    gc.collect()
+    assert cache.stats()['pinned'] == 1
+    assert cache._pins == {('b1', 1): 1}
+
+    del second
+    gc.collect()
+    assert cache.stats()['pinned'] == 0
+    assert cache.stats()['sections'] == 1
+
+
+def test_pinned_sections_survive_going_over_the_cap():
+    cache = SectionCache(max_bytes=size_of('a'))
+    first = cache.put(('b1', 1), comments('a'))
+    second = cache.put(('b1', 2), comments('b'))
+
+    assert cache.stats()['sections'] == 2
+    assert cache.stats()['bytes'] > cache.max_bytes
+    assert first[0]['id'] == 'a0' and second[0]['id'] == 'b0'
+
+
+def test_unpinned_sections_are_evicted_least_recently_used_first():
+    cache = SectionCache(max_bytes=2 * size_of('a'))
+    for number, prefix in enumerate('abc', 1):
+        cache.put(('b1', number), comments(prefix))
+    gc.collect()
+    # Section 1 was used again, so section 2 is now the oldest
+    cache.acquire(('b1', 1), lambda: comments('a'))
+    gc.collect()
+    cache.stats()
+
+    assert list(cache._sections) == [('b1', 3), ('b1', 1)]
+    assert cache.nbytes == sum(section.nbytes for section in cache._sections.values())
+
+
+def test_a_dropped_handle_unpins_so_its_section_can_be_evicted():
+    cache = SectionCache(max_bytes=size_of('a'))
+    handle = cache.put(('b1', 1), comments('a'))
+    keep = cache.put(('b1', 2), comments('b'))
+    assert cache.stats()['sections'] == 2
+
+    del handle
+    gc.collect()
+    # The unpin is applied by the next operation
+    assert cache.stats()['sections'] == 1
+    assert list(cache._sections) == [('b1', 2)]
+    assert keep[0]['id'] == 'b0'
+
+
+def test_collecting_a_handle_while_the_lock_is_held_does_not_deadlock():
+    cache = SectionCache()
+    handle = cache.put(('b1', 1), comments('a'))
+
+    def collect_inside_the_lock():
+        nonlocal handle
+        with cache._lock:
+            # The finalizer runs here, on the thread that holds the lock
+            del handle
+            gc.collect()
+
+    thread = threading.Thread(target=collect_inside_the_lock, daemon=True)
+    thread.start()
+    thread.join(2)
+
+    assert not thread.is_alive()
+    assert cache.stats()['pinned'] == 0
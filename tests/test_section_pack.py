@@ -0,0 +1,239 @@
+import gzip
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import section_pack
+from repository import SQLiteRepository
+from section_pack import (
+    PACK_SCHEMA_VERSION, PackError, annotate_offline, build_pack, current_comment, dumps_pack, export_section,
+    loads_pack, pack_results, read_pack, record_annotation, record_skip, upload_pack, write_pack,
+)
+
+BATCH = {'id': 'b1', 'name': 'Batch one'}
+COMMENTS = [
+    {'id': 'c1', 'comment_text': 'pehla comment'},
+    {'id': 'c2', 'comment_text': 'doosra comment', 'hate_probability': 0.9},
+    {'id': 'c3', 'comment_text': 'teesra comment'},
+]
+
+
+def new_pack(progress_index=0):
+    return build_pack(BATCH, 2, 'ann@example.com', COMMENTS, progress_index)
+
+
+def test_round_trip():
+    pack = new_pack(1)
+    record_annotation(pack, 'hate', ['race'], 'note', 1200)
+    data = dumps_pack(pack)
+
+    assert loads_pack(data) == pack
+    assert dumps_pack(loads_pack(data)) == data
+    assert pack['schema_version'] == PACK_SCHEMA_VERSION
+    assert [c['hate_probability'] for c in pack['comments']] == [None, 0.9, None]
+
+
+def test_unicode_texts_survive():
+    pack = build_pack(BATCH, 1, 'u', [{'id': 'c1', 'comment_text': 'यह ठीक नहीं है 😡'}], 0)
+    assert loads_pack(dumps_pack(pack))['comments'][0]['comment_text'] == 'यह ठीक नहीं है 😡'
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'not gzip at all',
+    gzip.compress(b'\xff\xfe'),
+    gzip.compress(b'{"kind": "an2ot8-section-pack"'),
+    gzip.compress(b'[1, 2, 3]'),
+    gzip.compress(json.dumps({'kind': 'something-else'}).encode()),
+])
+def test_unreadable_data_raises_pack_error(data):
+    with pytest.raises(PackError):
+        loads_pack(data)
+
+
+def test_newer_schema_raises_pack_error():
+    pack = {**new_pack(), 'schema_version': PACK_SCHEMA_VERSION + 1}
+    with pytest.raises(PackError, match='newer'):
+        loads_pack(dumps_pack(pack))
+
+
+def test_missing_fields_raise_pack_error():
+    pack = new_pack()
+    del pack['results'], pack['position']
+    with pytest.raises(PackError, match='position, results'):
+        loads_pack(dumps_pack(pack))
+
+
+def test_recording_moves_through_the_section():
+    pack = new_pack(1)
+    assert current_comment(pack)['id'] == 'c2'
+
+    record_annotation(pack, 'hate', ('race', 'caste'), 'note', 1500)
+    record_skip(pack, None)
+    assert current_comment(pack) is None
+    with pytest.raises(PackError):
+        record_skip(pack)
+
+    first, second = pack['results']
+    assert (first['comment_id'], first['action'], first['categories']) == ('c2', 'annotate', ['race', 'caste'])
+    assert (second['comment_id'], second['action']) == ('c3', 'skip')
+    assert first['idempotency_key'] != second['idempotency_key']
+
+
+def test_pack_results():
+    pack = new_pack()
+    record_skip(pack, 300)
+    record_annotation(pack, 'non-hate', [], '', 900)
+    annotations, skips, progress_index = pack_results(pack)
+
+    assert progress_index == 2
+    assert [(a['comment_id'], a['label'], a['duration_ms']) for a in annotations] == [('c2', 'non-hate', 900)]
+    assert [(s['comment_id'], s['duration_ms']) for s in skips] == [('c1', 300)]
+    # offline_at is when the comment was handled in the pack, not when it is uploaded
+    assert annotations[0]['offline_at'] == pack['results'][1]['at']
+    assert skips[0]['offline_at'] == pack['results'][0]['at']
+    assert datetime.fromisoformat(skips[0]['offline_at']).tzinfo is not None
+    assert all(row['idempotency_key'] for row in annotations + skips)
+
+
+def test_write_pack_replaces_the_file(tmp_path):
+    path = str(tmp_path / 'section.an2pack')
+    write_pack(path, new_pack())
+    pack = read_pack(path)
+    record_skip(pack)
+    write_pack(path, pack)
+
+    assert read_pack(path)['position'] == 1
+    assert [p.name for p in tmp_path.iterdir()] == ['section.an2pack']
+
+
+def scripted(*answers):
+    answers = list(answers)
+    return lambda message: answers.pop(0)
+
+
+def test_annotate_offline(tmp_path, monkeypatch):
+    path = str(tmp_path / 'section.an2pack')
+    write_pack(path, new_pack())
+    ticks = iter([0.0, 2.5, 10.0, 10.0 + section_pack.MAX_TIMED_SECONDS + 1, 20.0, 20.0, 30.0])
+    monkeypatch.setattr(section_pack, 'time', SimpleNamespace(monotonic=lambda: next(ticks)))
+    shown = []
+
+    annotate_offline(path, prompt=scripted('h', '3, 99, x,5', ' kuch notes ', 'k', 'z', 'q'), show=shown.append)
+
+    pack = read_pack(path)
+    assert pack['position'] == 2
+    annotation, skip = pack['results']
+    assert (annotation['label'], annotation['categories'], annotation['notes']) == \
+        ('hate', ['race', 'regionalism'], 'kuch notes')
+    assert annotation['duration_ms'] == 2500
+    # Too long on one comment: the annotator stepped away
+    assert (skip['action'], skip['duration_ms']) == ('skip', None)
+    assert 'Unknown choice.' in shown
+    assert any('hate (90% confident)' in line for line in shown)
+    assert shown[-1].startswith('Saved. 2 comment(s)')
+
+
+def test_annotate_offline_reports_a_finished_section(tmp_path):
+    path = str(tmp_path / 'section.an2pack')
+    write_pack(path, new_pack(len(COMMENTS)))
+    shown = []
+
+    annotate_offline(path, prompt=scripted(), show=shown.append)
+    assert 'is finished' in shown[-1]
+
+
+@pytest.fixture
+def repository(tmp_path):
+    return SQLiteRepository(str(tmp_path / 'annotations.sqlite3'))
+
+
+@pytest.fixture
+def batch_id(repository):
+    return repository.load_batch('Batch', [f'comment {i}' for i in range(6)], section_size=3)
+
+
+def annotations_of(repository, user_id):
+    rows = repository._connection().execute(
+        "SELECT comment_id, label, created_at, offline_at FROM annotations WHERE user_id = ? ORDER BY comment_id",
+        (user_id,),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def progress_of(repository, batch_id, user_id):
+    return repository.assign_section(batch_id, user_id)['saved_progress_index']
+
+
+def test_export_and_upload(repository, batch_id):
+    pack = export_section(repository, batch_id, 'ann')
+    assert (pack['section_number'], pack['position'], len(pack['comments'])) == (1, 0, 3)
+    record_annotation(pack, 'hate', ['race'])
+    record_skip(pack)
+
+    result = upload_pack(repository, loads_pack(dumps_pack(pack)), 'ann')
+
+    assert result == {'imported_annotations': 1, 'imported_skips': 1, 'progress_index': 2}
+    assert progress_of(repository, batch_id, 'ann') == 2
+    (row,) = annotations_of(repository, 'ann')
+    assert row['comment_id'] == pack['comments'][0]['id']
+    assert row['offline_at'] == pytest.approx(datetime.fromisoformat(pack['results'][0]['at']).timestamp())
+    assert row['created_at'] >= row['offline_at']
+
+
+def test_uploading_twice_is_harmless(repository, batch_id):
+    pack = export_section(repository, batch_id, 'ann')
+    record_annotation(pack, 'hate', [])
+    record_skip(pack)
+    upload_pack(repository, pack)
+
+    again = upload_pack(repository, pack)
+
+    assert again == {'imported_annotations': 0, 'imported_skips': 0, 'progress_index': 2}
+    assert len(annotations_of(repository, 'ann')) == 1
+    skips = repository._connection().execute("SELECT COUNT(*) FROM skip_events").fetchone()[0]
+    assert skips == 1
+
+
+def test_comments_labelled_online_are_not_imported_again(repository, batch_id):
+    pack = export_section(repository, batch_id, 'ann')
+    first = pack['comments'][0]['id']
+    repository.save_annotation({'comment_id': first, 'batch_id': batch_id, 'user_id': 'ann', 'label': 'non-hate'})
+    record_annotation(pack, 'hate', [])
+    record_annotation(pack, 'hate', [])
+
+    result = upload_pack(repository, pack)
+
+    assert result['imported_annotations'] == 1
+    labels = {row['comment_id']: row['label'] for row in annotations_of(repository, 'ann')}
+    assert labels[first] == 'non-hate'
+    assert labels[pack['comments'][1]['id']] == 'hate'
+
+
+def test_an_older_pack_does_not_move_progress_back(repository, batch_id):
+    pack = export_section(repository, batch_id, 'ann')
+    record_skip(pack)
+    repository.update_progress(batch_id, 'ann', 2, pack['section_number'])
+
+    assert upload_pack(repository, pack)['progress_index'] == 2
+
+
+def test_results_outside_the_section_are_ignored(repository, batch_id):
+    pack = export_section(repository, batch_id, 'ann')
+    other = repository.get_section_comments(batch_id, 2)[0]
+    pack['comments'][0] = {'id': other['id'], 'comment_text': other['comment_text'], 'hate_probability': None}
+    record_annotation(pack, 'hate', [])
+
+    assert upload_pack(repository, pack)['imported_annotations'] == 0
+    assert annotations_of(repository, 'ann') == []
+
+
+def test_upload_by_another_user_raises(repository, batch_id):
+    pack = export_section(repository, batch_id, 'ann')
+    record_annotation(pack, 'hate', [])
+
+    with pytest.raises(PackError, match='belongs to ann'):
+        upload_pack(repository, pack, 'someone-else')
+    assert annotations_of(repository, 'ann') == []
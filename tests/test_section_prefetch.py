@@ -0,0 +1,170 @@
+import threading
+
+from section_prefetch import SectionPrefetcher
+
+WAIT = 5
+
+
+class FakeBackend:
+    """reserve/fetch/release callables that can be held open by the test."""
+
+    def __init__(self, section_number=4, comments=({'id': 'c1'},), reserve_error=None, fetch_error=None,
+                 release_error=None):
+        self.section_number = section_number
+        self.comments = list(comments)
+        self.reserve_error = reserve_error
+        self.fetch_error = fetch_error
+        self.release_error = release_error
+        self.allow_reserve = threading.Event()
+        self.allow_fetch = threading.Event()
+        self.allow_reserve.set()
+        self.allow_fetch.set()
+        self.fetching = threading.Event()
+        self.released = threading.Event()
+        self.releases = []
+        self.fetches = []
+
+    def reserve(self, batch_id, user_id):
+        self.allow_reserve.wait(WAIT)
+        if self.reserve_error:
+            raise self.reserve_error
+        return self.section_number
+
+    def fetch(self, batch_id, section_number):
+        self.fetches.append(section_number)
+        self.fetching.set()
+        self.allow_fetch.wait(WAIT)
+        if self.fetch_error:
+            raise self.fetch_error
+        return self.comments
+
+    def release(self, batch_id, user_id):
+        self.releases.append((batch_id, user_id))
+        self.released.set()
+        if self.release_error:
+            raise self.release_error
+
+    def prefetcher(self):
+        return SectionPrefetcher('b1', 'a@b.c', self.reserve, self.fetch, self.release)
+
+
+def test_result_is_the_reserved_section_and_its_comments():
+    backend = FakeBackend()
+    prefetcher = backend.prefetcher()
+
+    assert prefetcher.result(timeout=WAIT) == (4, [{'id': 'c1'}])
+    assert backend.releases == []
+
+
+def test_nothing_left_to_reserve():
+    backend = FakeBackend(section_number=None)
+    prefetcher = backend.prefetcher()
+
+    assert prefetcher.result(timeout=WAIT) is None
+    assert backend.fetches == []
+    prefetcher.cancel()
+    assert not backend.released.wait(0.2)
+
+
+def test_result_waits_only_for_the_timeout():
+    backend = FakeBackend()
+    backend.allow_fetch.clear()
+    prefetcher = backend.prefetcher()
+
+    assert prefetcher.result(timeout=0.05) is None
+    backend.allow_fetch.set()
+    assert prefetcher.result(timeout=WAIT) == (4, [{'id': 'c1'}])
+
+
+def test_cancel_before_the_reservation_returns_releases_it_once():
+    backend = FakeBackend()
+    backend.allow_reserve.clear()
+    prefetcher = backend.prefetcher()
+
+    prefetcher.cancel()
+    backend.allow_reserve.set()
+
+    assert backend.released.wait(WAIT)
+    prefetcher._thread.join(WAIT)
+    assert backend.fetches == []
+    assert backend.releases == [('b1', 'a@b.c')]
+    assert prefetcher.result(timeout=WAIT) is None
+
+
+def test_cancel_during_the_download_releases_once():
+    backend = FakeBackend()
+    backend.allow_fetch.clear()
+    prefetcher = backend.prefetcher()
+    assert backend.fetching.wait(WAIT)
+
+    prefetcher.cancel()
+    backend.allow_fetch.set()
+    prefetcher._thread.join(WAIT)
+
+    assert backend.released.wait(WAIT)
+    assert backend.releases == [('b1', 'a@b.c')]
+    assert prefetcher.result(timeout=WAIT) is None
+
+
+def test_cancel_after_the_download_releases_once():
+    backend = FakeBackend()
+    prefetcher = backend.prefetcher()
+    assert prefetcher.result(timeout=WAIT)
+
+    prefetcher.cancel()
+
+    assert backend.released.wait(WAIT)
+    assert backend.releases == [('b1', 'a@b.c')]
+    assert prefetcher.result(timeout=WAIT) is None
+
+
+def test_cancel_while_the_worker_is_exiting_still_releases():
+    backend = FakeBackend()
+    prefetcher = backend.prefetcher()
+    prefetcher._thread.join(WAIT)
+
+    # The worker has passed its own cancelled check but has not exited yet
+    class Exiting:
+        def is_alive(self):
+            return True
+    prefetcher._thread = Exiting()
+    prefetcher.cancel()
+
+    assert backend.released.wait(WAIT)
+    assert backend.releases == [('b1', 'a@b.c')]
+
+
+def test_a_failed_download_is_not_served_and_its_reservation_is_given_back():
+    backend = FakeBackend(fetch_error=ConnectionError("reset"))
+    prefetcher = backend.prefetcher()
+
+    assert prefetcher.result(timeout=WAIT) is None
+    assert isinstance(prefetcher.error, ConnectionError)
+    prefetcher.cancel()
+    assert backend.released.wait(WAIT)
+    assert backend.releases == [('b1', 'a@b.c')]
+
+
+def test_a_failed_reservation_holds_nothing_to_release():
+    backend = FakeBackend(reserve_error=ConnectionError("reset"))
+    prefetcher = backend.prefetcher()
+
+    assert prefetcher.result(timeout=WAIT) is None
+    assert isinstance(prefetcher.error, ConnectionError)
+    prefetcher.cancel()
+    assert not backend.released.wait(0.2)
+
+
+def test_a_failed_release_is_recorded():
+    backend = FakeBackend(release_error=ConnectionError("reset"))
+    prefetcher = backend.prefetcher()
+    prefetcher.result(timeout=WAIT)
+
+    prefetcher.cancel()
+
+    assert backend.released.wait(WAIT)
+    for _ in range(100):
+        if prefetcher.error:
+            break
+        threading.Event().wait(0.01)
+    assert isinstance(prefetcher.error, ConnectionError)
@@ -0,0 +1,64 @@
+import pytest
+
+from repository import SQLiteRepository
+from sweep_locks import sweep
+
+
+class CountingRepository:
+    """Releases up to `limit` of `expired` claims per call, like release_expired_locks."""
+
+    def __init__(self, expired):
+        self.expired = expired
+        self.limits = []
+
+    def release_expired_locks(self, limit):
+        self.limits.append(limit)
+        released = min(limit, self.expired)
+        self.expired -= released
+        return released
+
+
+@pytest.fixture
+def repository(tmp_path):
+    return SQLiteRepository(str(tmp_path / 'annotations.sqlite3'))
+
+
+def test_sweeps_until_a_chunk_comes_back_short():
+    repository = CountingRepository(expired=25)
+
+    assert sweep(repository, chunk_size=10) == 25
+    assert repository.limits == [10, 10, 10]
+
+
+def test_an_exact_multiple_takes_one_empty_chunk_to_finish():
+    repository = CountingRepository(expired=20)
+
+    assert sweep(repository, chunk_size=10) == 20
+    assert len(repository.limits) == 3
+
+
+def test_max_chunks_bounds_one_run():
+    repository = CountingRepository(expired=25)
+
+    assert sweep(repository, chunk_size=10, max_chunks=2) == 20
+    assert repository.expired == 5
+
+
+def test_a_null_result_counts_as_nothing_released():
+    class NullRepository:
+        def release_expired_locks(self, limit):
+            return None
+
+    assert sweep(NullRepository(), chunk_size=10) == 0
+
+
+def test_only_expired_claims_are_released(repository):
+    batch_id = repository.load_batch('Batch', [f'comment {i}' for i in range(7)])
+    live = repository.claim_next_comment(batch_id, 'a')
+    repository.claim_comments(batch_id, 'b', 5, lease_seconds=-1)
+
+    assert sweep(repository, chunk_size=2) == 5
+
+    statuses = dict(repository._connection().execute("SELECT id, status FROM comments").fetchall())
+    assert statuses.pop(live['id']) == 'claimed'
+    assert set(statuses.values()) == {'unassigned'}
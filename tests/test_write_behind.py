@@ -0,0 +1,176 @@
+import sqlite3
+
+import pytest
+
+from write_behind import AnnotationJournal
+
+
+class FakeRepository:
+    """Stores what the journal flushes, ignoring rows whose idempotency key it has seen like the server does."""
+
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.annotations = {}
+        self.skips = {}
+        self.progress = {}
+        self.calls = []
+
+    def _call(self, name):
+        self.calls.append(name)
+        if name in self.fail_on:
+            raise ConnectionError(name)
+
+    def save_annotations(self, rows):
+        self._call('save_annotations')
+        for row in rows:
+            self.annotations.setdefault(row['idempotency_key'], row)
+
+    def save_skip_events(self, rows):
+        self._call('save_skip_events')
+        for row in rows:
+            self.skips.setdefault(row['idempotency_key'], row)
+
+    def update_progress(self, batch_id, user_id, progress_index, section_number=None):
+        self._call('update_progress')
+        self.progress[(batch_id, user_id, section_number)] = progress_index
+
+
+def annotation(comment_id, label='hate'):
+    return {'comment_id': comment_id, 'user_id': 'a@b.c', 'label': label}
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return AnnotationJournal(str(tmp_path / 'journal.sqlite3'))
+
+
+def test_flush_sends_annotations_before_progress(journal):
+    journal.append(annotation=annotation('c1'), progress=('b1', 'a@b.c', 1, 1))
+    journal.append(skip={'comment_id': 'c2', 'user_id': 'a@b.c'}, progress=('b1', 'a@b.c', 1, 2))
+    repository = FakeRepository()
+
+    assert journal.flush(repository) == 1
+    assert repository.calls == ['save_annotations', 'save_skip_events', 'update_progress']
+    assert repository.progress == {('b1', 'a@b.c', 1): 2}
+    assert journal.pending_count() == 0
+
+
+def test_progress_is_not_sent_when_the_annotations_fail(journal):
+    journal.append(annotation=annotation('c1'), progress=('b1', 'a@b.c', 1, 1))
+    repository = FakeRepository(fail_on={'save_annotations'})
+
+    with pytest.raises(ConnectionError):
+        journal.flush(repository)
+    assert repository.progress == {}
+    assert journal.pending_count() == 1
+
+    retry = FakeRepository()
+    journal.flush(retry)
+    assert list(retry.annotations) and retry.progress == {('b1', 'a@b.c', 1): 1}
+
+
+def test_progress_coalesces_to_the_highest_index_per_section(journal):
+    journal.append(progress=('b1', 'a@b.c', 1, 3))
+    journal.append(progress=('b1', 'a@b.c', 1, 5))
+    journal.append(progress=('b1', 'a@b.c', 1, 4))
+    journal.append(progress=('b1', 'a@b.c', 2, 0))
+    repository = FakeRepository()
+
+    journal.flush(repository)
+
+    assert repository.calls.count('update_progress') == 2
+    assert repository.progress == {('b1', 'a@b.c', 1): 5, ('b1', 'a@b.c', 2): 0}
+
+
+def test_each_annotation_is_kept_and_a_repeated_key_is_journalled_once(journal):
+    first = journal.append(annotation=annotation('c1'))
+    journal.append(annotation=annotation('c2'))
+    journal.append(annotation={**annotation('c1', 'non-hate'), 'idempotency_key': first})
+    repository = FakeRepository()
+
+    assert journal.flush(repository) == 2
+    assert {row['comment_id'] for row in repository.annotations.values()} == {'c1', 'c2'}
+    assert repository.annotations[first]['label'] == 'hate'
+
+
+def test_replaying_after_a_crash_does_not_duplicate(tmp_path):
+    path = str(tmp_path / 'journal.sqlite3')
+    journal = AnnotationJournal(path)
+    keys = [journal.append(annotation=annotation(f'c{i}')) for i in range(3)]
+    repository = FakeRepository()
+    save_annotations = repository.save_annotations
+
+    def accepted_then_lost(rows):
+        # The server stores the rows but the response never arrives
+        save_annotations(rows)
+        raise TimeoutError()
+    repository.save_annotations = accepted_then_lost
+
+    with pytest.raises(TimeoutError):
+        journal.flush(repository)
+    journal._conn.close()
+
+    reopened = AnnotationJournal(path)
+    assert reopened.pending_count() == 3
+    repository.save_annotations = save_annotations
+    assert reopened.flush(repository) == 3
+
+    assert sorted(repository.annotations) == sorted(keys)
+    assert reopened.pending_count() == 0
+
+
+def test_a_flush_sends_everything_in_batches(journal):
+    for i in range(7):
+        journal.append(annotation=annotation(f'c{i}'))
+    repository = FakeRepository()
+
+    assert journal.flush(repository, batch_size=3) == 7
+    assert repository.calls.count('save_annotations') == 3
+    assert len(repository.annotations) == 7
+
+
+def test_journals_from_before_section_keyed_progress_are_migrated_and_flushed_first(tmp_path):
+    path = str(tmp_path / 'journal.sqlite3')
+    old = sqlite3.connect(path)
+    old.executescript("""
+        CREATE TABLE pending_progress (
+            batch_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            progress_index INTEGER NOT NULL,
+            PRIMARY KEY (batch_id, user_id)
+        );
+        INSERT INTO pending_progress VALUES ('b1', 'a@b.c', 7);
+    """)
+    old.close()
+
+    journal = AnnotationJournal(path)
+    journal.append(progress=('b1', 'a@b.c', 2, 1))
+    repository = FakeRepository()
+    order = []
+    repository.update_progress = lambda batch_id, user_id, index, section_number=None: order.append(
+        (section_number, index))
+
+    journal.flush(repository)
+
+    assert order == [(None, 7), (2, 1)]
+    assert journal._conn.execute("SELECT COUNT(*) FROM pending_progress").fetchone() == (0,)
+    tables = {name for (name,) in journal._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert 'pending_progress_old' not in tables
+
+
+def test_a_newer_index_journalled_during_the_update_is_kept(journal):
+    journal.append(progress=('b1', 'a@b.c', 1, 2))
+    repository = FakeRepository()
+
+    def update_progress(batch_id, user_id, index, section_number=None):
+        # The annotator moves on while the request is in flight
+        journal.append(progress=('b1', 'a@b.c', 1, 3))
+        repository.progress[(batch_id, user_id, section_number)] = index
+    repository.update_progress = update_progress
+
+    journal.flush(repository)
+    assert repository.progress == {('b1', 'a@b.c', 1): 2}
+
+    retry = FakeRepository()
+    journal.flush(retry)
+    assert retry.progress == {('b1', 'a@b.c', 1): 3}
@@ -0,0 +1,184 @@
+"""Write-behind annotation queue backed by a local SQLite journal.
+
+Saving an annotation (or skipping a comment) appends it and the annotator's
+new progress index to a WAL-mode SQLite file and returns immediately. A
+background worker drains the journal to Supabase: annotations and skip events
+go up as one bulk insert each per flush and the progress index is coalesced to
+a single update per (batch, user, section).
+
+Every journalled annotation and skip carries an idempotency key. The insert
+ignores rows whose key already exists, so replaying a flush after a crash or a
+timed-out request never duplicates them.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_JOURNAL_PATH = ".annotation_journal.sqlite3"
+FLUSH_INTERVAL_SECONDS = 2.0
+MAX_BACKOFF_SECONDS = 60.0
+FLUSH_BATCH_SIZE = 500
+
+
+class AnnotationJournal:
+    """Durable local queue of annotations and progress updates waiting to be flushed."""
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pending_annotations (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pending_skips (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+        """)
+        self._create_progress_table()
+
+    def _create_progress_table(self):
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(pending_progress)")]
+        if columns and 'section_number' not in columns:
+            # Journals from before progress was keyed by section: keep their rows,
+            # flushed to whatever section is current as they always were.
+            self._conn.execute("ALTER TABLE pending_progress RENAME TO pending_progress_old")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pending_progress (
+                batch_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                section_number INTEGER,
+                progress_index INTEGER NOT NULL,
+                PRIMARY KEY (batch_id, user_id, section_number)
+            );
+        """)
+        if columns and 'section_number' not in columns:
+            self._conn.executescript("""
+                INSERT INTO pending_progress (batch_id, user_id, section_number, progress_index)
+                SELECT batch_id, user_id, NULL, progress_index FROM pending_progress_old;
+                DROP TABLE pending_progress_old;
+            """)
+
+    def append(self, annotation=None, progress=None, skip=None):
+        """Journal an annotation or skip event and/or a progress update in one transaction.
+
+        progress is (batch_id, user_id, section_number, progress_index). Each
+        section keeps its own pending index, so a section that could not be
+        flushed yet never overwrites the progress of the next one.
+
+        Returns the idempotency key assigned to the annotation or skip, if any.
+        """
+        key = None
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table, row in (('pending_annotations', annotation), ('pending_skips', skip)):
+                    if row is None:
+                        continue
+                    key = row.get('idempotency_key') or str(uuid.uuid4())
+                    self._conn.execute(
+                        f"INSERT OR IGNORE INTO {table} (idempotency_key, payload, created_at) VALUES (?, ?, ?)",
+                        (key, json.dumps({**row, 'idempotency_key': key}), time.time()),
+                    )
+                if progress is not None:
+                    batch_id, user_id, section_number, progress_index = progress
+                    # Progress within a section only moves forward, so coalesce to the highest index seen.
+                    self._conn.execute(
+                        """INSERT INTO pending_progress (batch_id, user_id, section_number, progress_index)
+                           VALUES (?, ?, ?, ?)
+                           ON CONFLICT (batch_id, user_id, section_number)
+                           DO UPDATE SET progress_index = MAX(progress_index, excluded.progress_index)""",
+                        (str(batch_id), user_id, section_number, progress_index),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return key
+
+    def pending_count(self):
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM pending_annotations").fetchone()
+        return count
+
+    def flush(self, repository, batch_size=FLUSH_BATCH_SIZE):
+        """Push everything journalled so far to the backend repository. Returns the number of annotations sent.
+
+        Annotations and skips are flushed before progress, and journal rows are
+        removed only after the server has accepted them, so a failure leaves the
+        journal intact for the next attempt.
+        """
+        sent = self._flush_table('pending_annotations', repository.save_annotations, batch_size)
+        self._flush_table('pending_skips', repository.save_skip_events, batch_size)
+
+        with self._lock:
+            # Rows journalled before progress was keyed by section go first
+            progress_rows = self._conn.execute(
+                "SELECT batch_id, user_id, section_number, progress_index FROM pending_progress"
+                " ORDER BY section_number IS NOT NULL"
+            ).fetchall()
+        for batch_id, user_id, section_number, progress_index in progress_rows:
+            repository.update_progress(batch_id, user_id, progress_index, section_number=section_number)
+            with self._lock:
+                # Keep the row if a newer index was journalled while we were updating.
+                self._conn.execute(
+                    """DELETE FROM pending_progress
+                       WHERE batch_id = ? AND user_id = ? AND section_number IS ? AND progress_index <= ?""",
+                    (batch_id, user_id, section_number, progress_index),
+                )
+        return sent
+
+    def _flush_table(self, table, save, batch_size):
+        sent = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT seq, payload FROM {table} ORDER BY seq LIMIT ?", (batch_size,)
+                ).fetchall()
+            if not rows:
+                return sent
+            save([json.loads(payload) for _, payload in rows])
+            with self._lock:
+                self._conn.execute(f"DELETE FROM {table} WHERE seq <= ?", (rows[-1][0],))
+            sent += len(rows)
+
+
+class WriteBehindWorker:
+    """Background thread that periodically flushes an AnnotationJournal with exponential backoff."""
+
+    def __init__(self, journal, repository, interval=FLUSH_INTERVAL_SECONDS):
+        self.journal = journal
+        self.repository = repository
+        self.interval = interval
+        self.last_error = None
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="annotation-write-behind", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        delay = self.interval
+        while True:
+            time.sleep(delay)
+            try:
+                self.flush()
+                delay = self.interval
+            except Exception as e:
+                self.last_error = e
+                delay = min(delay * 2, MAX_BACKOFF_SECONDS)
+
+    def flush(self):
+        """Flush synchronously on the caller's thread, e.g. on section completion or logout."""
+        with self._flush_lock:
+            sent = self.journal.flush(self.repository)
+        self.last_error = None
+        return sent